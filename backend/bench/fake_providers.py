@@ -0,0 +1,349 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode, parse_qsl
+import aiohttp
+from aiohttp import web
+
+# Helyi HelpScout és Graph API a collectorok méréséhez, pl.:
+#   python -m bench.fake_providers --port 9100 --conversations 500 --latency-ms 80 --throttle-rate 0.02
+# HelpScout: http://127.0.0.1:9100/v2, Graph: http://127.0.0.1:9101/v17.0 (külön port, mint két külön host).
+# A fiókok adatai a hitelesítő adatból (client_id, access_token, phone_number_id) determinisztikusan jönnek létre,
+# így a futások összehasonlíthatók.
+#
+# Valós válaszok felvétele és visszajátszása:
+#   python -m bench.fake_providers --record recordings/   (továbbítja a kéréseket a valódi API-knak)
+#   python -m bench.fake_providers --replay recordings/
+
+HELPSCOUT_UPSTREAM = 'https://api.helpscout.net'
+GRAPH_UPSTREAM = 'https://graph.facebook.com'
+GRAPH_VERSION = 'v17.0'
+# A válaszok kulcsából kihagyott paraméterek (fiókonként eltérnek, és nem kerülhetnek a felvételbe)
+SECRET_PARAMS = {'access_token'}
+_SECRET_VALUE = re.compile(r'(access_token=|"access_token":\s*")[^&"\s]+')
+
+
+class FakeConfig:
+    def __init__(self, args):
+        self.conversations = args.conversations
+        self.threads = args.threads
+        self.messages = args.messages
+        self.unread_ratio = args.unread_ratio
+        self.page_size = args.page_size
+        self.latency = args.latency_ms / 1000
+        self.jitter = args.jitter_ms / 1000
+        self.throttle_rate = args.throttle_rate
+        self.retry_after = args.retry_after
+        self.seed = args.seed
+        # Az időbélyegek ehhez képest készülnek, így az ismételt (delta) körök ugyanazt látják
+        self.now = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+class Mailbox:
+    # Egy fiók adatai; a beszélgetéseket oldalanként, igény szerint állítjuk elő, nem tartjuk memóriában
+    def __init__(self, config: FakeConfig, key: str):
+        self.config = config
+        self.key = hashlib.sha1(key.encode()).hexdigest()[:8]
+
+    def _random(self, index: int) -> random.Random:
+        return random.Random(f"{self.config.seed}:{self.key}:{index}")
+
+    def updated_at(self, index: int) -> datetime:
+        # Csökkenő sorrend: a 0. beszélgetés a legfrissebb
+        return self.config.now - timedelta(minutes=10 * index)
+
+    def unread(self, index: int) -> bool:
+        return self._random(index).random() < self.config.unread_ratio
+
+    def helpscout_conversation(self, index: int) -> dict:
+        rnd = self._random(index)
+        modified = self.updated_at(index)
+        unread = self.unread(index)
+        threads = []
+        for n in range(self.config.threads):
+            created = modified - timedelta(minutes=self.config.threads - n)
+            threads.append({
+                'id': index * 1000 + n,
+                'type': 'customer' if n % 2 == 0 else 'message',
+                'createdAt': created.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                # Olvasatlan beszélgetésben az utolsó szál nincs még megnézve
+                'seenByAgent': not (unread and n == self.config.threads - 1),
+            })
+        return {
+            'id': int(self.key, 16) % 100000 * 100000 + index,
+            'status': 'closed' if rnd.random() < 0.1 else 'active',
+            'modifiedAt': modified.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            '_embedded': {'threads': threads},
+        }
+
+    def graph_conversation(self, index: int, embedded_limit: int = None) -> dict:
+        updated = self.updated_at(index).strftime('%Y-%m-%dT%H:%M:%S+0000')
+        unread_count = self._random(index).randint(1, 5) if self.unread(index) else 0
+        conversation = {
+            'id': f"t_{self.key}_{index}",
+            'updated_time': updated,
+            'unread_count': unread_count,
+            'message_count': self.config.messages,
+            'participants': {'data': [{'id': self.key}, {'id': f"user_{index}"}]},
+        }
+        if embedded_limit is not None:
+            conversation['messages'] = self.graph_messages(index, 0, embedded_limit)
+        return conversation
+
+    def graph_messages(self, index: int, offset: int, limit: int, base: str = None) -> dict:
+        unread_count = self._random(index).randint(1, 5) if self.unread(index) else 0
+        updated = self.updated_at(index)
+        end = min(offset + limit, self.config.messages)
+        data = [{
+            'id': f"m_{self.key}_{index}_{n}",
+            'created_time': (updated - timedelta(minutes=n)).strftime('%Y-%m-%dT%H:%M:%S+0000'),
+            # A legújabb üzenetek az olvasatlanok
+            'seen': n >= unread_count,
+        } for n in range(offset, end)]
+        page = {'data': data}
+        if end < self.config.messages:
+            page['paging'] = {'next': _graph_next(base, f"t_{self.key}_{index}/messages", limit, end)}
+        return page
+
+
+def _graph_next(base: str, path: str, limit: int, after: int, **params) -> str:
+    return f"{base or ''}/{GRAPH_VERSION}/{path}?{urlencode({**params, 'limit': limit, 'after': after})}"
+
+
+class FakeProviders:
+    def __init__(self, config: FakeConfig, record_dir: str = None, replay_dir: str = None):
+        self.config = config
+        self.record_dir = record_dir
+        self.replay_dir = replay_dir
+        self.requests = 0
+        self.throttled = 0
+        self.by_route = {}
+        self._mailboxes = {}
+        self._by_key = {}
+        self._upstream = None
+
+    def mailbox(self, key: str) -> Mailbox:
+        mailbox = self._mailboxes.get(key)
+        if mailbox is None:
+            mailbox = self._mailboxes[key] = Mailbox(self.config, key)
+            self._by_key[mailbox.key] = mailbox
+        return mailbox
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get('/_stats', self.stats)
+        app.router.add_post('/_reset', self.reset)
+        if self.record_dir or self.replay_dir:
+            app.router.add_route('*', '/{path:v2/.*}', self.recorded)
+            app.router.add_route('*', '/{path:v[0-9.]+(?:/.*)?}', self.recorded)
+            return app
+        app.router.add_post('/v2/oauth2/token', self.helpscout_token)
+        app.router.add_get('/v2/conversations', self.helpscout_conversations)
+        app.router.add_post(f'/{GRAPH_VERSION}', self.graph_batch)
+        app.router.add_get(f'/{GRAPH_VERSION}/{{path:.+}}', self.graph_get)
+        return app
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        if request.path.startswith('/_'):
+            return await handler(request)
+        self.requests += 1
+        route = request.path.rsplit('/', 1)[-1] if '/' in request.path.strip('/') else 'batch'
+        self.by_route[route] = self.by_route.get(route, 0) + 1
+        if self.config.latency or self.config.jitter:
+            await asyncio.sleep(max(0.0, self.config.latency + random.uniform(-self.config.jitter, self.config.jitter)))
+        if self.config.throttle_rate and random.random() < self.config.throttle_rate:
+            self.throttled += 1
+            return web.json_response({'error': {'message': 'Too many requests', 'code': 4}}, status=429,
+                                     headers={'Retry-After': str(self.config.retry_after)})
+        return await handler(request)
+
+    async def stats(self, request: web.Request):
+        return web.json_response({'requests': self.requests, 'throttled': self.throttled, 'by_route': self.by_route})
+
+    async def reset(self, request: web.Request):
+        self.requests, self.throttled, self.by_route = 0, 0, {}
+        return web.json_response({'ok': True})
+
+    # HelpScout
+
+    async def helpscout_token(self, request: web.Request):
+        auth = request.headers.get('Authorization', '')
+        try:
+            client_id = base64.b64decode(auth.split(' ', 1)[1]).decode().split(':', 1)[0]
+        except (IndexError, ValueError):
+            return web.json_response({'error': 'invalid_client'}, status=401)
+        return web.json_response({'access_token': f"hs-{client_id}", 'token_type': 'bearer', 'expires_in': 7200})
+
+    async def helpscout_conversations(self, request: web.Request):
+        auth = request.headers.get('Authorization', '')
+        if not auth.startswith('Bearer hs-'):
+            return web.json_response({'error': 'invalid_token'}, status=401)
+        mailbox = self.mailbox(auth[len('Bearer hs-'):])
+        query = request.query
+        page = int(query.get('page', 1))
+        size = min(int(query.get('pageSize', 50)), self.config.page_size)
+        # Az időrend szerinti sorrend miatt a modifiedSince egy előtagot jelent
+        count = self.config.conversations
+        since = query.get('modifiedSince')
+        if since:
+            since_at = datetime.fromisoformat(since.replace('Z', '+00:00'))
+            count = sum(1 for i in range(count) if mailbox.updated_at(i) > since_at)
+        conversations = [mailbox.helpscout_conversation(i) for i in range((page - 1) * size, min(page * size, count))]
+        if query.get('status', 'active') == 'active':
+            conversations = [c for c in conversations if c['status'] == 'active']
+        return web.json_response({
+            '_embedded': {'conversations': conversations},
+            'page': {'size': size, 'totalElements': count, 'totalPages': max(1, -(-count // size)), 'number': page},
+        })
+
+    # Graph
+
+    def _graph_response(self, path: str, params: dict, base: str):
+        # (státusz, törzs); a batch alkérések is ezen mennek át
+        token = params.get('access_token', '')
+        limit = min(int(params.get('limit', 25)), self.config.page_size)
+        after = int(params.get('after', 0))
+        parts = path.strip('/').split('/')
+        if len(parts) != 2:
+            return 400, {'error': {'message': f"Unknown path {path}", 'code': 100}}
+        node, edge = parts
+        if node == 'me' and edge == 'conversations':
+            mailbox = self.mailbox(token)
+            match = re.search(r'messages\.limit\((\d+)\)', params.get('fields', ''))
+            embedded = int(match.group(1)) if match else None
+            end = min(after + limit, self.config.conversations)
+            page = {'data': [mailbox.graph_conversation(i, embedded) for i in range(after, end)]}
+            if end < self.config.conversations:
+                page['paging'] = {'next': _graph_next(base, 'me/conversations', limit, end, fields=params.get('fields', ''),
+                                                      access_token=token)}
+            return 200, page
+        if node.startswith('t_') and edge == 'messages':
+            key, index = node[2:].rsplit('_', 1)
+            mailbox = self._by_key.get(key)
+            if mailbox is None:
+                return 404, {'error': {'message': f"Unknown conversation {node}", 'code': 100}}
+            return 200, mailbox.graph_messages(int(index), after, limit, base)
+        if edge in ('messages', 'conversations'):
+            # WhatsApp: {phone_number_id}/messages és /conversations
+            mailbox = self.mailbox(node)
+            end = min(after + limit, self.config.conversations)
+            if edge == 'messages':
+                data = [{'id': f"wamid.{mailbox.key}.{i}", 'timestamp': mailbox.updated_at(i).timestamp()}
+                        for i in range(after, end)]
+            else:
+                data = [mailbox.graph_conversation(i) for i in range(after, end)]
+            page = {'data': data}
+            if end < self.config.conversations:
+                page['paging'] = {'next': _graph_next(base, f"{node}/{edge}", limit, end, access_token=token)}
+            return 200, page
+        return 400, {'error': {'message': f"Unknown path {path}", 'code': 100}}
+
+    async def graph_get(self, request: web.Request):
+        status, body = self._graph_response(request.match_info['path'], dict(request.query), _base(request))
+        return web.json_response(body, status=status)
+
+    async def graph_batch(self, request: web.Request):
+        form = await request.post()
+        token = form.get('access_token', '')
+        base = _base(request)
+        results = []
+        for item in json.loads(form.get('batch', '[]')):
+            path, _, query = item['relative_url'].partition('?')
+            params = dict(parse_qsl(query, keep_blank_values=True))
+            params.setdefault('access_token', token)
+            status, body = self._graph_response(path, params, base)
+            results.append({'code': status, 'body': json.dumps(body)})
+        return web.json_response(results)
+
+    # Felvétel és visszajátszás
+
+    def _recording_path(self, request: web.Request, body: bytes) -> str:
+        query = sorted((k, v) for k, v in request.query.items() if k not in SECRET_PARAMS)
+        if request.content_type == 'application/x-www-form-urlencoded' and body:
+            # Graph batch: az alkérések számítanak, a token nem
+            form = sorted((k, v) for k, v in parse_qsl(body.decode(), keep_blank_values=True) if k not in SECRET_PARAMS)
+        else:
+            form = body.decode('utf-8', errors='replace')
+        key = json.dumps([request.method, request.path, query, form])
+        return os.path.join(self.record_dir or self.replay_dir, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    async def recorded(self, request: web.Request):
+        body = await request.read()
+        path = self._recording_path(request, body)
+        upstream = HELPSCOUT_UPSTREAM if request.path.startswith('/v2') else GRAPH_UPSTREAM
+        if self.replay_dir:
+            if not os.path.exists(path):
+                return web.json_response({'error': f"No recording for {request.method} {request.path}"}, status=404)
+            with open(path) as f:
+                recording = json.load(f)
+            # A felvett lapozó URL-ek a valódi hostra mutatnak, ide irányítjuk őket
+            text = recording['body'].replace(upstream, _base(request))
+            return web.Response(text=text, status=recording['status'], content_type='application/json')
+
+        if self._upstream is None:
+            self._upstream = aiohttp.ClientSession()
+        headers = {k: v for k, v in request.headers.items() if k in ('Authorization', 'Content-Type')}
+        async with self._upstream.request(request.method, upstream + request.path_qs, data=body or None,
+                                          headers=headers) as response:
+            text = await response.text()
+            status = response.status
+        os.makedirs(self.record_dir, exist_ok=True)
+        with open(path, 'w') as f:
+            # A felvételbe nem kerül token (a lapozó URL-ekben sem)
+            json.dump({'method': request.method, 'path': request.path, 'status': status,
+                       'body': _SECRET_VALUE.sub(r'\1REDACTED', text)}, f)
+        return web.Response(text=text.replace(upstream, _base(request)), status=status, content_type='application/json')
+
+
+def _base(request: web.Request) -> str:
+    return f"{request.scheme}://{request.host}"
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--conversations', type=int, default=200, help='conversations per mailbox')
+    parser.add_argument('--threads', type=int, default=3, help='HelpScout threads per conversation')
+    parser.add_argument('--messages', type=int, default=20, help='Graph messages per conversation')
+    parser.add_argument('--unread-ratio', type=float, default=0.2)
+    parser.add_argument('--page-size', type=int, default=100, help='largest page the fakes return')
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of the injected 429s (seconds)')
+    parser.add_argument('--seed', default='bench')
+
+
+async def serve(args):
+    providers = FakeProviders(FakeConfig(args), args.record, args.replay)
+    runner = web.AppRunner(providers.app(), access_log=None)
+    await runner.setup()
+    # Két port ugyanarra az alkalmazásra: a kliens hostonkénti kapcsolatkorlátja így külön vonatkozik rájuk
+    for port in (args.port, args.port + 1):
+        await web.TCPSite(runner, args.host, port).start()
+    print(f"Fake providers on http://{args.host}:{args.port}/v2 (HelpScout) and "
+          f"http://{args.host}:{args.port + 1}/{GRAPH_VERSION} (Graph)", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        if providers._upstream is not None:
+            await providers._upstream.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local HelpScout and Graph API stand-ins for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100, help='HelpScout port; Graph listens on port + 1')
+    parser.add_argument('--record', metavar='DIR', help='proxy to the real APIs and save the responses')
+    parser.add_argument('--replay', metavar='DIR', help='serve responses saved with --record')
+    add_arguments(parser)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,106 @@
+import hashlib
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Az skpy.Skype helyettesítője a benchmarkhoz: ugyanazokat a mezőket és hívásokat adja, amiket a
+# SkypeService használ (conn tokenek, chats.recent(), chat.getMsgs() oldalanként). A hívások
+# blokkolnak (time.sleep), mint az skpy HTTP kérései, így a szálkészlet viselkedése is mérhető.
+
+
+class FakeSkypeConfig:
+    def __init__(self, chats: int = 50, messages: int = 100, page_size: int = 30, unread_ratio: float = 0.2,
+                 latency_ms: float = 50, seed: str = 'bench'):
+        self.chats = chats
+        self.messages = messages
+        self.page_size = page_size
+        self.unread_ratio = unread_ratio
+        self.latency = latency_ms / 1000
+        self.seed = seed
+        self.now = datetime.utcnow().replace(microsecond=0)
+
+
+config = FakeSkypeConfig()
+_lock = threading.Lock()
+requests = 0
+
+
+def configure(**kwargs):
+    global config
+    config = FakeSkypeConfig(**kwargs)
+
+
+def _request():
+    # Egy skpy HTTP kérés: számoljuk és várunk
+    global requests
+    with _lock:
+        requests += 1
+    if config.latency:
+        time.sleep(config.latency)
+
+
+class FakeMessage:
+    def __init__(self, msg_id: str, msg_time: datetime, read: bool):
+        self.id = msg_id
+        self.time = msg_time
+        self.read = read
+
+
+class FakeChat:
+    def __init__(self, user: str, index: int):
+        self.id = f"19:{user}_{index}@thread.skype"
+        self._rnd = random.Random(f"{config.seed}:{user}:{index}")
+        self._unread = self._rnd.randint(1, 5) if self._rnd.random() < config.unread_ratio else 0
+        self._base = int(hashlib.sha1(self.id.encode()).hexdigest()[:6], 16) * 10 ** 6
+        self._updated = config.now - timedelta(minutes=10 * index)
+        self._offset = 0
+
+    def getMsgs(self):
+        # Mint az skpy: minden hívás a következő (régebbi) oldalt adja, a végén üres listát
+        _request()
+        end = min(self._offset + config.page_size, config.messages)
+        page = [FakeMessage(str(self._base + config.messages - n), self._updated - timedelta(minutes=n), n >= self._unread)
+                for n in range(self._offset, end)]
+        self._offset = end
+        return page
+
+
+class FakeChats:
+    def __init__(self, user: str):
+        self.user = user
+
+    def recent(self):
+        _request()
+        return {chat.id: chat for chat in (FakeChat(self.user, i) for i in range(config.chats))}
+
+
+class FakeConnection:
+    def __init__(self):
+        self.userId = None
+        self.tokens = {}
+        self.tokenExpiry = {}
+        self.msgsHost = None
+        self.syncStates = {}
+
+    def getRegToken(self):
+        _request()
+        self.tokens['reg'] = f"reg-{self.userId}"
+        self.tokenExpiry['reg'] = datetime.now() + timedelta(days=1)
+        self.msgsHost = 'https://client-s.gateway.messenger.live.com/v1'
+
+
+class Skype:
+    def __init__(self, user=None, pwd=None, tokenFile=None, connect=True):
+        self.conn = FakeConnection()
+        if connect and user:
+            # Bejelentkezés: skype és reg token, ahogy az skpy beállítja
+            _request()
+            self.conn.userId = user
+            self.conn.tokens['skype'] = f"skype-{user}"
+            self.conn.tokenExpiry['skype'] = datetime.now() + timedelta(days=1)
+            self.conn.getRegToken()
+
+    @property
+    def chats(self) -> FakeChats:
+        return FakeChats(self.conn.userId)
@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from bench.fake_providers import add_arguments
+
+# Collector benchmark: fake szolgáltatók ellen futó frissítési körök növekvő fiókszámmal, pl.:
+#   cd backend && python -m bench.run --accounts 1,10,100,1000 --output bench.json
+#   python -m bench.run --baseline bench.json          (változás után, eltérés %-ban)
+# Minden méret külön folyamat (bench.sweep), a fake szerver (bench.fake_providers) közös.
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Összehasonlításnál ezek számítanak; mind "kisebb a jobb"
+COMPARED = ('wall_seconds', 'upstream_requests', 'peak_rss_mb', 'cpu_ms_per_account')
+
+
+def _fake_options(args) -> list:
+    # A fake szerver beállításai változatlanul továbbmennek
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    options = []
+    for name in vars(parser.parse_args([])):
+        options += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    return options
+
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Fake providers exited with code {process.returncode}")
+        try:
+            with urllib.request.urlopen(f"{url}/_stats", timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit(f"Fake providers did not start on {url}")
+
+
+def start_fake(args):
+    command = [sys.executable, '-m', 'bench.fake_providers', '--port', str(args.port)] + _fake_options(args)
+    if args.replay:
+        command += ['--replay', args.replay]
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{args.port}"
+    try:
+        _wait_ready(url, process)
+    except BaseException:
+        process.terminate()
+        raise
+    return process, url
+
+
+def run_scale(args, accounts: int, url: str) -> list:
+    command = [sys.executable, '-m', 'bench.sweep', '--accounts', str(accounts), '--fake-url', url,
+               '--sweeps', str(args.sweeps), '--providers', args.providers,
+               '--skype-chats', str(args.conversations), '--skype-messages', str(args.messages),
+               '--skype-latency-ms', str(args.latency_ms)]
+    if args.real_limits:
+        command.append('--real-limits')
+    completed = subprocess.run(command, cwd=BACKEND_DIR, stdout=subprocess.PIPE, text=True)
+    if completed.returncode != 0:
+        raise SystemExit(f"Sweep with {accounts} accounts failed (exit code {completed.returncode})")
+    return [json.loads(line) for line in completed.stdout.splitlines() if line.startswith('{')]
+
+
+def _key(result: dict):
+    return result['accounts'], result['mode']
+
+
+def _delta(value, base) -> str:
+    if not base:
+        return ''
+    return f" ({(value - base) / base * 100:+.0f}%)"
+
+
+def print_table(results: list, baseline: list = None):
+    previous = {_key(result): result for result in baseline or []}
+    header = f"{'accounts':>8} {'mode':<6} {'wall s':>16} {'requests':>16} {'429':>5} {'errors':>6} {'peak RSS MB':>16} {'CPU ms/account':>18}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        base = previous.get(_key(result), {})
+        cells = [f"{result[name]:g}{_delta(result[name], base.get(name))}" for name in COMPARED]
+        print(f"{result['accounts']:>8} {result['mode']:<6} {cells[0]:>16} {cells[1]:>16} {result['throttled']:>5} "
+              f"{result['errors']:>6} {cells[2]:>16} {cells[3]:>18}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Collector benchmark against local provider stand-ins')
+    parser.add_argument('--accounts', default='1,10,100,1000', help='comma separated account counts')
+    parser.add_argument('--sweeps', type=int, default=2, help='first one is a full sync, the rest are deltas')
+    parser.add_argument('--providers', default='HelpScout,WhatsApp,Messenger,Skype')
+    parser.add_argument('--real-limits', action='store_true', help='keep the production client side rate limits')
+    parser.add_argument('--port', type=int, default=9100, help='fake HelpScout port; Graph uses port + 1')
+    parser.add_argument('--fake-url', help='use an already running bench.fake_providers instead of starting one')
+    parser.add_argument('--replay', metavar='DIR', help='serve recorded responses (see bench.fake_providers --record)')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--baseline', help='compare against a saved --output file')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    process, url = (None, args.fake_url.rstrip('/')) if args.fake_url else start_fake(args)
+    results = []
+    try:
+        for accounts in (int(n) for n in args.accounts.split(',') if n.strip()):
+            print(f"Running {args.sweeps} sweep(s) with {accounts} accounts...", file=sys.stderr, flush=True)
+            results += run_scale(args, accounts, url)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print_table(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'options': vars(args), 'results': results}, f, indent=2)
+        print(f"Saved {len(results)} results to {args.output}", file=sys.stderr)
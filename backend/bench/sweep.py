@@ -0,0 +1,171 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+
+# Egy méret (fiókszám) mérése külön folyamatban, hogy a csúcs memória (ru_maxrss) csak ehhez a futáshoz tartozzon.
+# A bench.run indítja; kézzel:
+#   python -m bench.sweep --accounts 100 --fake-url http://127.0.0.1:9100
+# Az eredmény körönként egy JSON sor a kimeneten.
+
+PROVIDERS = ('HelpScout', 'WhatsApp', 'Messenger', 'Skype')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run collector sweeps against the fake providers')
+    parser.add_argument('--accounts', type=int, required=True)
+    parser.add_argument('--fake-url', default='http://127.0.0.1:9100', help='HelpScout fake; Graph is on port + 1')
+    parser.add_argument('--providers', default=','.join(PROVIDERS), help='account types, assigned round-robin')
+    parser.add_argument('--sweeps', type=int, default=2, help='first one is a full sync, the rest are deltas')
+    parser.add_argument('--real-limits', action='store_true', help='keep the production rate limits')
+    parser.add_argument('--skype-chats', type=int, default=50)
+    parser.add_argument('--skype-messages', type=int, default=100)
+    parser.add_argument('--skype-latency-ms', type=float, default=50)
+    parser.add_argument('--database-url', help='default: a fresh SQLite file per run')
+    return parser.parse_args(argv)
+
+
+def configure_env(args, db_dir: str):
+    # Az import előtt, mert a modulok betöltéskor olvassák a beállításokat
+    base = args.fake_url.rstrip('/')
+    scheme, _, hostport = base.partition('://')
+    host, _, port = hostport.rpartition(':')
+    os.environ['HELPSCOUT_API_URL'] = f"{base}/v2"
+    os.environ['GRAPH_API_URL'] = f"{scheme}://{host}:{int(port) + 1}/v17.0"
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(db_dir, 'bench.db')}"
+    os.environ['LOG_STDOUT'] = 'false'
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    os.environ.setdefault('TRACE_SLOW_SWEEP_SECONDS', '0')
+    if not args.real_limits:
+        # A kliens oldali keret a valódi szolgáltatókhoz igazodik; a fake ellen a collector saját költségét mérjük
+        for provider in ('HELPSCOUT', 'GRAPH', 'SKYPE'):
+            for name in ('RPS', 'TOTAL_RPS'):
+                os.environ.setdefault(f'RATE_LIMIT_{provider}_{name}', '100000')
+            os.environ.setdefault(f'RATE_LIMIT_{provider}_BURST', '100000')
+
+
+def _metric_sums(metric, label: str, suffix: str = '_sum') -> dict:
+    sums = {}
+    for family in metric.collect():
+        for sample in family.samples:
+            if sample.name.endswith(suffix):
+                key = sample.labels[label]
+                sums[key] = sums.get(key, 0.0) + sample.value
+    return sums
+
+
+async def _fake_stats(session, base: str, reset: bool = False) -> dict:
+    async with session.request('POST' if reset else 'GET', f"{base}/{'_reset' if reset else '_stats'}") as response:
+        return await response.json()
+
+
+def seed_accounts(database: str, count: int, providers):
+    import storage
+    now = '2024-01-01T00:00:00'
+    credentials = {
+        'HelpScout': lambda i: {'client_id': f"bench-{i}", 'client_secret': 'secret'},
+        'WhatsApp': lambda i: {'api_key': f"wa-{i}", 'phone_number_id': f"{100000 + i}"},
+        'Messenger': lambda i: {'access_token': f"fb-{i}"},
+        'Skype': lambda i: {'username': f"bench{i}", 'password': 'secret'},
+    }
+    with storage.writing(database) as conn:
+        for i in range(count):
+            account_type = providers[i % len(providers)]
+            account_id = conn.insert_id(
+                "INSERT INTO accounts (account_type, account_name, credentials, refresh_interval, created_at) "
+                "VALUES (:account_type, :account_name, :credentials, :refresh_interval, :created_at)",
+                {'account_type': account_type, 'account_name': f"bench {i}", 'credentials': json.dumps(credentials[account_type](i)),
+                 'refresh_interval': 5, 'created_at': now}
+            )
+            conn.execute(
+                "INSERT INTO account_stats (account_id, total_messages, unread_messages, last_updated) VALUES (:account_id, 0, 0, :now)",
+                {'account_id': account_id, 'now': now}
+            )
+
+
+async def run(args):
+    # A backend modulok a környezet beállítása után töltődnek be
+    import aiohttp
+    import executor
+    import http_client
+    import metrics
+    import migrations
+    import services
+    import storage
+    from circuit_breaker import circuit_breakers
+    from stats_writer import stats_writer
+    from bench import fake_skpy
+
+    providers = [p.strip() for p in args.providers.split(',') if p.strip()]
+    unknown = [p for p in providers if p not in PROVIDERS]
+    if unknown:
+        raise SystemExit(f"Unknown providers: {', '.join(unknown)}")
+
+    # Az skpy saját HTTP klienst használ, ezért folyamaton belül cseréljük le
+    fake_skpy.configure(chats=args.skype_chats, messages=args.skype_messages, latency_ms=args.skype_latency_ms)
+    services.Skype = fake_skpy.Skype
+
+    database = storage.get_database_url()
+    migrations.migrate(database)
+    seed_accounts(database, args.accounts, providers)
+    stats_writer.database = database
+    circuit_breakers.database = database
+    await http_client.start()
+    stats_writer.start()
+
+    base = args.fake_url.rstrip('/')
+    async with aiohttp.ClientSession() as control:
+        try:
+            for number in range(args.sweeps):
+                await _fake_stats(control, base, reset=True)
+                skype_before = fake_skpy.requests
+                errors_before = _metric_sums(metrics.COLLECTOR_DURATION, 'result', '_count').get('error', 0)
+                phases_before = _metric_sums(metrics.COLLECTOR_PHASE, 'phase')
+                usage_before = resource.getrusage(resource.RUSAGE_SELF)
+                started = time.perf_counter()
+
+                await services.update_account_stats()
+                await stats_writer.flush()
+
+                wall = time.perf_counter() - started
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                cpu = (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime)
+                fake = await _fake_stats(control, base)
+                phases = _metric_sums(metrics.COLLECTOR_PHASE, 'phase')
+                errors = _metric_sums(metrics.COLLECTOR_DURATION, 'result', '_count').get('error', 0) - errors_before
+                result = {
+                    'accounts': args.accounts,
+                    'sweep': number + 1,
+                    'mode': 'full' if number == 0 else 'delta',
+                    'wall_seconds': round(wall, 4),
+                    'upstream_requests': fake['requests'] + fake_skpy.requests - skype_before,
+                    'throttled': fake['throttled'],
+                    'errors': int(errors),
+                    'cpu_seconds': round(cpu, 4),
+                    'cpu_ms_per_account': round(cpu * 1000 / args.accounts, 3),
+                    # Linuxon KiB-ban; a folyamat eddigi csúcsa
+                    'peak_rss_mb': round(usage.ru_maxrss / 1024, 1),
+                    'phase_seconds': {name: round(phases.get(name, 0.0) - phases_before.get(name, 0.0), 4)
+                                      for name in metrics.PHASES},
+                }
+                print(json.dumps(result), flush=True)
+        finally:
+            await stats_writer.stop()
+            await http_client.close()
+            executor.shutdown()
+            storage.close_all()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix='msg_dashboard_bench_') as db_dir:
+        configure_env(args, db_dir)
+        # Csak a hibák, a standard hibakimenetre; a kimenet a mérési eredményeké
+        logging.basicConfig(level=os.environ['LOG_LEVEL'], stream=sys.stderr)
+        asyncio.run(run(args))
@@ -0,0 +1,98 @@
+import os
+import asyncio
+import logging
+import traceback
+import storage
+from stats_cache import load_stats_rows, load_stats_version
+
+logger = logging.getLogger('broadcaster')
+
+# Más workerek írásait ilyen gyakran vesszük észre (a saját írásainkat azonnal)
+STREAM_POLL_SECONDS = float(os.environ.get('STREAM_POLL_SECONDS', '2'))
+# Ennyi elküldetlen esemény után a lassú kliens új teljes snapshotot kap
+STREAM_QUEUE_SIZE = int(os.environ.get('STREAM_QUEUE_SIZE', '100'))
+
+
+class StatsBroadcaster:
+    def __init__(self, poll_interval: float = STREAM_POLL_SECONDS):
+        self.database = None
+        self.poll_interval = poll_interval
+        self._subscribers = set()
+        self._snapshot = None
+        self._version = None
+        self._task = None
+        self._loop = None
+        self._wakeup = None
+        self._start_lock = asyncio.Lock()
+
+    def notify(self):
+        # Collector írás után hívjuk; bármelyik szálból biztonságos
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def subscribe(self) -> asyncio.Queue:
+        async with self._start_lock:
+            if self._task is None or self._task.done():
+                self._loop = asyncio.get_running_loop()
+                self._wakeup = asyncio.Event()
+                self._version = await storage.run_read(load_stats_version, self.database)
+                self._snapshot = await storage.run_read(load_stats_rows, self.database)
+                self._task = asyncio.create_task(self._run())
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        queue.put_nowait(('snapshot', list(self._snapshot.values())))
+        self._subscribers.add(queue)
+        logger.info(f"Stream client connected ({len(self._subscribers)} total)")
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+        logger.info(f"Stream client disconnected ({len(self._subscribers)} total)")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._subscribers.clear()
+
+    def _publish(self, event: str, data):
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                # A kliens lemaradt: eldobjuk a sorát és a teljes állapotot küldjük újra
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(('snapshot', list(self._snapshot.values())))
+
+    async def _run(self):
+        # Csak addig fut, amíg van csatlakozott kliens; N kliens egyetlen adatbázis olvasás
+        while self._subscribers:
+            try:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+                version = await storage.run_read(load_stats_version, self.database)
+                if version == self._version:
+                    continue
+                self._version = version
+                rows = await storage.run_read(load_stats_rows, self.database)
+
+                changed = [row for account_id, row in rows.items() if self._snapshot.get(account_id) != row]
+                removed = [account_id for account_id in self._snapshot if account_id not in rows]
+                self._snapshot = rows
+                if changed or removed:
+                    self._publish('delta', {"updated": changed, "removed": removed})
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Stats broadcast failed: {str(e)}")
+                logger.error(f"Full traceback: {traceback.format_exc()}")
+                await asyncio.sleep(self.poll_interval)
+        self._task = None
+
+
+broadcaster = StatsBroadcaster()
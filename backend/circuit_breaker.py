@@ -0,0 +1,140 @@
+import os
+import logging
+import time
+from datetime import datetime
+import storage
+
+logger = logging.getLogger('circuit_breaker')
+
+# Ennyi egymást követő hiba után a fiókot kivesszük a körökből
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '3'))
+# Nyitott áramkörnél ennyi idő múlva jöhet egy próbafrissítés; minden újabb hiba duplázza
+BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', '300'))
+BREAKER_MAX_RESET_SECONDS = float(os.environ.get('BREAKER_MAX_RESET_SECONDS', '3600'))
+# Egy fiók frissítésének felső időkorlátja; szolgáltatónként felülírható, pl. COLLECTOR_TIMEOUT_SKYPE=300
+COLLECTOR_TIMEOUT_SECONDS = float(os.environ.get('COLLECTOR_TIMEOUT_SECONDS', '120'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def collector_timeout(provider: str) -> float:
+    return float(os.environ.get(f'COLLECTOR_TIMEOUT_{provider.upper()}', COLLECTOR_TIMEOUT_SECONDS))
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, account_id: int, retry_at: float, last_error: str = None):
+        retry = datetime.fromtimestamp(retry_at).isoformat(timespec='seconds')
+        super().__init__(f"Account {account_id} is failing ({last_error}), next attempt after {retry}")
+        self.account_id = account_id
+        self.retry_at = retry_at
+
+
+class Circuit:
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.last_error = None
+        self.opened_until = 0.0
+        self.reset_timeout = BREAKER_RESET_SECONDS
+
+
+def save_circuit(database: str, account_id: int, circuit: Circuit):
+    with storage.writing(database) as conn:
+        conn.execute('''
+            INSERT INTO account_health (account_id, state, failures, last_error, last_failure_at, opened_until, updated_at)
+            VALUES (:account_id, :state, :failures, :last_error, :last_failure_at, :opened_until, :updated_at)
+            ON CONFLICT (account_id) DO UPDATE SET
+                state = excluded.state,
+                failures = excluded.failures,
+                last_error = excluded.last_error,
+                last_failure_at = excluded.last_failure_at,
+                opened_until = excluded.opened_until,
+                updated_at = excluded.updated_at
+        ''', {'account_id': account_id, 'state': circuit.state, 'failures': circuit.failures,
+              'last_error': circuit.last_error, 'last_failure_at': datetime.now().isoformat(),
+              'opened_until': circuit.opened_until, 'updated_at': time.time()})
+
+
+def clear_circuit(database: str, account_id: int):
+    with storage.writing(database) as conn:
+        conn.execute("DELETE FROM account_health WHERE account_id = :account_id", {'account_id': account_id})
+
+
+def load_circuits(database: str) -> dict:
+    with storage.reading(database) as conn:
+        rows = conn.execute("SELECT account_id, state, failures, last_error, opened_until FROM account_health").fetchall()
+    circuits = {}
+    for account_id, state, failures, last_error, opened_until in rows:
+        circuit = Circuit()
+        # Egy félbemaradt próba (másik vezetőnél) újra nyitott állapotnak számít
+        circuit.state = CLOSED if state == CLOSED else OPEN
+        circuit.failures = failures
+        circuit.last_error = last_error
+        circuit.opened_until = opened_until or 0.0
+        circuits[account_id] = circuit
+    return circuits
+
+
+class CircuitBreakers:
+    # Fiókonkénti áramkör: closed -> (N hiba) open -> (várakozás) half_open -> egy próba -> closed/open.
+    # Az állapot az account_health táblában is megvan, így a /stats bármelyik workeren mutatja,
+    # és vezetőváltás után sem kezdjük elölről.
+    def __init__(self):
+        self.database = None
+        self._circuits = {}
+
+    async def load(self):
+        self._circuits = await storage.run_read(load_circuits, self.database)
+        if self._circuits:
+            logger.info(f"Loaded {len(self._circuits)} failing accounts")
+
+    def is_open(self, account_id: int) -> bool:
+        circuit = self._circuits.get(account_id)
+        return circuit is not None and circuit.state == OPEN and time.time() < circuit.opened_until
+
+    def allow(self, account_id: int):
+        # Nyitott áramkörnél CircuitOpenError; a várakozás letelte után egyetlen próbát engedünk
+        circuit = self._circuits.get(account_id)
+        if circuit is None or circuit.state == CLOSED:
+            return
+        if circuit.state == OPEN and time.time() >= circuit.opened_until:
+            circuit.state = HALF_OPEN
+            logger.info(f"Circuit for account {account_id} half-open, trying one refresh")
+            return
+        raise CircuitOpenError(account_id, circuit.opened_until, circuit.last_error)
+
+    async def record_success(self, account_id: int) -> bool:
+        circuit = self._circuits.pop(account_id, None)
+        if circuit is None:
+            return False
+        if circuit.state != CLOSED:
+            logger.info(f"Circuit for account {account_id} closed after successful refresh")
+        await storage.run_write(clear_circuit, self.database, account_id)
+        return True
+
+    async def record_failure(self, account_id: int, error: str):
+        circuit = self._circuits.setdefault(account_id, Circuit())
+        circuit.failures += 1
+        circuit.last_error = error
+        if circuit.state == HALF_OPEN:
+            # A próba sem sikerült: hosszabb várakozás
+            circuit.reset_timeout = min(circuit.reset_timeout * 2, BREAKER_MAX_RESET_SECONDS)
+            self._open(account_id, circuit)
+        elif circuit.state == CLOSED and circuit.failures >= BREAKER_FAILURE_THRESHOLD:
+            self._open(account_id, circuit)
+        await storage.run_write(save_circuit, self.database, account_id, circuit)
+
+    def _open(self, account_id: int, circuit: Circuit):
+        circuit.state = OPEN
+        circuit.opened_until = time.time() + circuit.reset_timeout
+        logger.warning(f"Circuit for account {account_id} opened for {circuit.reset_timeout:.0f}s "
+                       f"after {circuit.failures} failures: {circuit.last_error}")
+
+    async def reset(self, account_id: int):
+        self._circuits.pop(account_id, None)
+        await storage.run_write(clear_circuit, self.database, account_id)
+
+
+circuit_breakers = CircuitBreakers()
@@ -0,0 +1,282 @@
+import os
+import asyncio
+import json
+import logging
+import time
+import traceback
+import storage
+import metrics
+
+logger = logging.getLogger('event_queue')
+
+# Ennyi feldolgozatlan eseménynél az append QueueFull-t dob (a webhook 503-at ad, a küldő újrapróbál)
+EVENT_QUEUE_MAX_DEPTH = int(os.environ.get('EVENT_QUEUE_MAX_DEPTH', '100000'))
+# Csoportos commit: az ennyi idő alatt érkező appendek egy tranzakcióba kerülnek
+EVENT_QUEUE_APPEND_MS = int(os.environ.get('EVENT_QUEUE_APPEND_MS', '10'))
+# A feldolgozó egy tranzakcióban legfeljebb ennyi eseményt vesz ki
+EVENT_QUEUE_BATCH = int(os.environ.get('EVENT_QUEUE_BATCH', '5000'))
+EVENT_QUEUE_POLL_MS = int(os.environ.get('EVENT_QUEUE_POLL_MS', '250'))
+# A feldolgozott események ennyi ideig maradnak meg, addig szűrjük az újraküldött duplikátumokat
+EVENT_QUEUE_RETENTION_SECONDS = int(os.environ.get('EVENT_QUEUE_RETENTION_SECONDS', '86400'))
+EVENT_QUEUE_PURGE_SECONDS = 60
+# Egy hibás eseményt ennyiszer próbálunk újra, utána félretesszük (failed_at), hogy ne tartsa fel a sort
+EVENT_QUEUE_MAX_ATTEMPTS = int(os.environ.get('EVENT_QUEUE_MAX_ATTEMPTS', '5'))
+
+
+class QueueFull(Exception):
+    def __init__(self, depth: int):
+        super().__init__(f"Event queue full ({depth} events waiting)")
+        self.depth = depth
+
+
+def append_events(database: str, rows):
+    # rows: (idempotency_key, kind, payload); azonos kulcsú esemény csak egyszer kerül be
+    now = time.time()
+    with storage.writing(database) as conn:
+        conn.executemany('''
+            INSERT INTO event_queue (idempotency_key, kind, payload, created_at)
+            VALUES (:key, :kind, :payload, :created_at)
+            ON CONFLICT (idempotency_key) DO NOTHING
+        ''', [{'key': key, 'kind': kind, 'payload': json.dumps(payload), 'created_at': now} for key, kind, payload in rows])
+
+
+def _apply(conn, handler, kind: str, events: list):
+    # events: (id, payload, attempts). Sikeres azonosítók és (id, attempts, hiba) listája.
+    # Először a teljes köteg egyben; ha egy esemény hibás, eseményenként újra, hogy a többi átmenjen.
+    try:
+        with conn.savepoint('event_batch'):
+            handler(conn, [payload for _, payload, _ in events])
+        return [event_id for event_id, _, _ in events], []
+    except Exception as e:
+        if len(events) == 1:
+            return [], [(events[0][0], events[0][2], e)]
+        logger.warning(f"Applying {len(events)} queued {kind} events failed ({type(e).__name__}), retrying one by one")
+    done, failed = [], []
+    for event_id, payload, attempts in events:
+        try:
+            with conn.savepoint('event_one'):
+                handler(conn, [payload])
+            done.append(event_id)
+        except Exception as e:
+            failed.append((event_id, attempts, e))
+    return done, failed
+
+
+def consume_events(database: str, handlers: dict, limit: int, max_attempts: int = EVENT_QUEUE_MAX_ATTEMPTS):
+    # A kivétel, a feldolgozás és a consumed_at beállítása egy tranzakció: leállásnál az események a sorban
+    # maradnak, és a következő kör újra feldolgozza őket. A hibás események nem tartják fel a többit:
+    # próbálkozásonként számoljuk őket, a korlát után failed_at jelöli (dead letter).
+    # Visszaad: (feldolgozott, hibás, véglegesen félretett)
+    with storage.writing(database) as conn:
+        conn.lock('event_queue')
+        rows = conn.execute('''
+            SELECT id, kind, payload, attempts FROM event_queue
+            WHERE consumed_at IS NULL AND failed_at IS NULL ORDER BY id LIMIT :limit
+        ''', {'limit': limit}).fetchall()
+        if not rows:
+            return 0, 0, 0
+        by_kind = {}
+        for event_id, kind, payload, attempts in rows:
+            by_kind.setdefault(kind, []).append((event_id, json.loads(payload), attempts))
+        done, failed = [], []
+        for kind, events in by_kind.items():
+            handler = handlers.get(kind)
+            if handler is None:
+                logger.warning(f"No handler for {len(events)} queued {kind} events, dropping them")
+                done += [event_id for event_id, _, _ in events]
+                continue
+            kind_done, kind_failed = _apply(conn, handler, kind, events)
+            done += kind_done
+            failed += kind_failed
+        now = time.time()
+        conn.executemany("UPDATE event_queue SET consumed_at = :now WHERE id = :id",
+                         [{'id': event_id, 'now': now} for event_id in done])
+        updates = []
+        for event_id, attempts, error in failed:
+            exhausted = attempts + 1 >= max_attempts
+            message = f"{type(error).__name__}: {str(error)}"
+            if exhausted:
+                logger.error(f"Queued event {event_id} failed {attempts + 1} times, moving it aside: {message}")
+            updates.append({'id': event_id, 'error': message[:1000], 'failed_at': now if exhausted else None})
+        conn.executemany('''
+            UPDATE event_queue SET attempts = attempts + 1, last_error = :error, failed_at = :failed_at
+            WHERE id = :id
+        ''', updates)
+        return len(done), len(failed), sum(1 for update in updates if update['failed_at'] is not None)
+
+
+def load_queue_stats(database: str):
+    with storage.reading(database) as conn:
+        depth, oldest = conn.execute(
+            "SELECT COUNT(*), MIN(created_at) FROM event_queue WHERE consumed_at IS NULL AND failed_at IS NULL"
+        ).fetchone()
+        failed = conn.execute("SELECT COUNT(*) FROM event_queue WHERE failed_at IS NOT NULL").fetchone()[0]
+    return int(depth), oldest, int(failed)
+
+
+def purge_consumed(database: str, older_than: float) -> int:
+    with storage.writing(database) as conn:
+        result = conn.execute(
+            "DELETE FROM event_queue WHERE consumed_at < :older_than OR failed_at < :older_than",
+            {'older_than': older_than}
+        )
+        return result.rowcount
+
+
+class EventQueue:
+    # Tartós sor a beérkezés (webhookok) és az összesítés között. Az append csak a commit után tér
+    # vissza, így a küldőnek adott 200 után leállás esetén sem vész el esemény; a feldolgozás
+    # legalább egyszeri, a duplikátumokat az idempotencia kulcs szűri.
+    def __init__(self, max_depth: int = EVENT_QUEUE_MAX_DEPTH, append_ms: int = EVENT_QUEUE_APPEND_MS,
+                 batch: int = EVENT_QUEUE_BATCH, poll_ms: int = EVENT_QUEUE_POLL_MS):
+        self.database = None
+        self.max_depth = max_depth
+        self.append_interval = append_ms / 1000
+        self.batch = batch
+        self.poll_interval = poll_ms / 1000
+        self.handlers = {}
+        self.listeners = {}
+        self.depth = 0
+        self.oldest = None
+        self.failed = 0
+        self.appended = 0
+        self.consumed = 0
+        self._pending = []
+        self._pending_count = 0
+        self._tasks = []
+        self._append_wakeup = None
+        self._consume_wakeup = None
+        self._consume_lock = None
+
+    def register(self, kind: str, handler, on_consumed=None):
+        # handler(conn, payloads) a feldolgozó tranzakción belül fut; on_consumed() a commit után
+        self.handlers[kind] = handler
+        if on_consumed is not None:
+            self.listeners[kind] = on_consumed
+
+    def start(self):
+        if not self._tasks:
+            self._append_wakeup = asyncio.Event()
+            self._consume_wakeup = asyncio.Event()
+            self._consume_lock = asyncio.Lock()
+            self._tasks = [asyncio.create_task(self._run_appender()), asyncio.create_task(self._run_consumer())]
+            logger.info(f"Event queue started (max depth: {self.max_depth}, batch: {self.batch})")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # A még nem commitolt appendek kiírása; a sorban maradtakat a következő indulás dolgozza fel
+        await self._write_pending()
+
+    def stats(self) -> dict:
+        return {
+            'depth': self.depth,
+            'lag_seconds': round(time.time() - self.oldest, 3) if self.oldest else 0.0,
+            'pending_appends': self._pending_count,
+            'appended': self.appended,
+            'consumed': self.consumed,
+            'failed': self.failed,
+            'max_depth': self.max_depth,
+        }
+
+    async def load_stats(self) -> dict:
+        # A mélység az összes worker appendjeit tartalmazza, nem csak ezét
+        self.depth, self.oldest, self.failed = await storage.run_read(load_queue_stats, self.database)
+        stats = self.stats()
+        metrics.observe_queue(stats['depth'], stats['lag_seconds'])
+        return stats
+
+    async def append(self, rows: list):
+        if not rows:
+            return
+        if self.depth + self._pending_count + len(rows) > self.max_depth:
+            raise QueueFull(self.depth + self._pending_count)
+        if not self._tasks:
+            # Nincs futó appender (pl. önálló szkript): azonnal írunk
+            await storage.run_write(append_events, self.database, rows)
+            self.appended += len(rows)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((rows, future))
+        self._pending_count += len(rows)
+        self._append_wakeup.set()
+        await future
+
+    async def _write_pending(self):
+        groups, self._pending, self._pending_count = self._pending, [], 0
+        if not groups:
+            return
+        rows = [row for group, _ in groups for row in group]
+        try:
+            await storage.run_write(append_events, self.database, rows)
+        except Exception as e:
+            logger.error(f"Appending {len(rows)} events failed: {str(e)}")
+            for _, future in groups:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.appended += len(rows)
+        self.depth += len(rows)
+        if self.oldest is None:
+            self.oldest = time.time()
+        for _, future in groups:
+            if not future.done():
+                future.set_result(None)
+        if self.depth >= self.batch:
+            self._consume_wakeup.set()
+
+    async def _run_appender(self):
+        while True:
+            await self._append_wakeup.wait()
+            # Rövid várakozás, hogy a löket appendjei egy commitba kerüljenek
+            await asyncio.sleep(self.append_interval)
+            self._append_wakeup.clear()
+            await self._write_pending()
+
+    async def consume(self) -> int:
+        async with self._consume_lock:
+            # Üres sornál nem nyitunk írási tranzakciót
+            await self.load_stats()
+            if not self.depth:
+                return 0
+            try:
+                consumed, failed, dead = await storage.run_write(consume_events, self.database, self.handlers, self.batch)
+            except Exception as e:
+                logger.error(f"Consuming queued events failed: {str(e)}")
+                logger.error(f"Full traceback: {traceback.format_exc()}")
+                return 0
+            if failed:
+                logger.warning(f"{failed} queued events failed, {dead} of them moved aside after {EVENT_QUEUE_MAX_ATTEMPTS} attempts, "
+                               f"the rest will be retried")
+            self.failed += dead
+            self.depth = max(self.depth - consumed - dead, 0)
+            if consumed:
+                self.consumed += consumed
+                for listener in self.listeners.values():
+                    listener()
+            return consumed
+
+    async def _run_consumer(self):
+        purged_at = 0.0
+        while True:
+            try:
+                await asyncio.wait_for(self._consume_wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._consume_wakeup.clear()
+            try:
+                # Nagy löketnél több köteg is lehet a sorban
+                while await self.consume() >= self.batch:
+                    pass
+                if time.monotonic() - purged_at >= EVENT_QUEUE_PURGE_SECONDS:
+                    purged_at = time.monotonic()
+                    await storage.run_write(purge_consumed, self.database, time.time() - EVENT_QUEUE_RETENTION_SECONDS)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Event queue maintenance failed: {str(e)}")
+
+
+event_queue = EventQueue()
@@ -0,0 +1,51 @@
+import os
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('executor')
+
+# A blokkoló (szinkron SDK) hívások szálkészletének mérete
+COLLECTOR_THREADS = int(os.environ.get('COLLECTOR_THREADS', '16'))
+# Szolgáltatónként egyszerre futó blokkoló hívások száma,
+# felülírható pl. COLLECTOR_LIMIT_SKYPE=2 változóval
+DEFAULT_PROVIDER_LIMIT = int(os.environ.get('COLLECTOR_PROVIDER_LIMIT', '4'))
+
+_executor = None
+_semaphores = {}
+
+
+def provider_limit(provider: str) -> int:
+    return int(os.environ.get(f'COLLECTOR_LIMIT_{provider.upper()}', DEFAULT_PROVIDER_LIMIT))
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=COLLECTOR_THREADS, thread_name_prefix='collector')
+        logger.info(f"Collector thread pool created with {COLLECTOR_THREADS} threads")
+    return _executor
+
+
+def _get_semaphore(provider: str) -> asyncio.Semaphore:
+    semaphore = _semaphores.get(provider)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(provider_limit(provider))
+        _semaphores[provider] = semaphore
+    return semaphore
+
+
+async def run_blocking(provider: str, func, *args, **kwargs):
+    # A hívás a szálkészletben fut, így az event loop közben kiszolgálja a többi kérést
+    async with _get_semaphore(provider):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    _semaphores.clear()
@@ -0,0 +1,130 @@
+import os
+import asyncio
+import json
+import logging
+from urllib.parse import urlencode, urlsplit, parse_qsl
+import rate_limit
+import tracing
+from rate_limit import HttpResponse, backoff_delay, rate_limiter, RETRY_MAX_ATTEMPTS
+
+logger = logging.getLogger('graph_api')
+
+GRAPH_API_VERSION = 'v17.0'
+# Felülírható helyi teszteléshez és benchmarkhoz (bench/fake_providers.py)
+GRAPH_API_URL = os.environ.get('GRAPH_API_URL', f"https://graph.facebook.com/{GRAPH_API_VERSION}").rstrip('/')
+# A Batch API legfeljebb 50 alkérést fogad egy POST-ban
+GRAPH_BATCH_SIZE = min(int(os.environ.get('GRAPH_BATCH_SIZE', '50')), 50)
+# Egyszerre futó batch POST-ok egy gyűjtésen belül
+GRAPH_BATCH_CONCURRENCY = int(os.environ.get('GRAPH_BATCH_CONCURRENCY', '2'))
+# Egy lista lapozásának felső korlátja, hogy egy hibás kurzor ne lapozzon a végtelenségig
+GRAPH_MAX_PAGES = int(os.environ.get('GRAPH_MAX_PAGES', '100'))
+
+
+class GraphError(Exception):
+    def __init__(self, status: int, data=None):
+        message = data.get('error', {}).get('message') if isinstance(data, dict) else None
+        super().__init__(f"Graph API error {status}: {message or data}")
+        self.status = status
+
+
+def relative_url(url: str) -> str:
+    # A paging.next teljes URL-jéből batch alkérés: verzió és access_token nélkül
+    parts = urlsplit(url)
+    path = parts.path.lstrip('/')
+    if path.startswith('v') and '/' in path and path.split('/', 1)[0][1:].replace('.', '').isdigit():
+        path = path.split('/', 1)[1]
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k != 'access_token']
+    return f"{path}?{urlencode(query)}" if query else path
+
+
+class GraphClient:
+    def __init__(self, session, access_token: str, rate_key: str):
+        self.session = session
+        self.access_token = access_token
+        self.rate_key = rate_key
+        self.requests = 0
+
+    async def get(self, path: str, **params) -> dict:
+        url = path if path.startswith('http') else f"{GRAPH_API_URL}/{path}"
+        if 'access_token=' not in url:
+            params['access_token'] = self.access_token
+        self.requests += 1
+        response = await rate_limit.request(self.session, 'GET', url, 'graph', self.rate_key, params=params)
+        data = response.json()
+        if response.status != 200:
+            raise GraphError(response.status, data)
+        return data
+
+    async def paginate(self, page: dict, stop=None):
+        # A paging.next kurzorokat követjük; stop(item) igaz értékénél megállunk (delta mód)
+        items = []
+        for number in range(GRAPH_MAX_PAGES):
+            for item in page.get('data', []):
+                if stop is not None and stop(item):
+                    return items
+                items.append(item)
+            next_url = page.get('paging', {}).get('next')
+            if not next_url:
+                return items
+            with tracing.span('page', page=number + 2):
+                page = await self.get(next_url)
+        logger.warning(f"Stopped paging after {GRAPH_MAX_PAGES} pages")
+        return items
+
+    async def batch(self, urls: list) -> list:
+        # Relatív URL-ek listája -> válaszok (dict vagy GraphError) ugyanabban a sorrendben,
+        # 50-es kötegekben; N alkérés N/50 körút a graph.facebook.com felé
+        results = [None] * len(urls)
+        chunks = [list(range(i, min(i + GRAPH_BATCH_SIZE, len(urls)))) for i in range(0, len(urls), GRAPH_BATCH_SIZE)]
+        semaphore = asyncio.Semaphore(GRAPH_BATCH_CONCURRENCY)
+
+        async def _run(indexes):
+            async with semaphore:
+                with tracing.span('batch', requests=len(indexes)):
+                    await self._batch_chunk(urls, indexes, results)
+
+        await asyncio.gather(*[_run(chunk) for chunk in chunks])
+        return results
+
+    async def _batch_chunk(self, urls, indexes, results):
+        pending = indexes
+        for attempt in range(RETRY_MAX_ATTEMPTS + 1):
+            body = {
+                'access_token': self.access_token,
+                'include_headers': 'false',
+                'batch': json.dumps([{'method': 'GET', 'relative_url': urls[i]} for i in pending]),
+            }
+            self.requests += 1
+            # A Graph minden alkérést külön számol a keretbe
+            response = await rate_limit.request(self.session, 'POST', GRAPH_API_URL, 'graph', self.rate_key,
+                                                cost=len(pending), data=body)
+            data = response.json()
+            if response.status != 200 or not isinstance(data, list):
+                error = GraphError(response.status, data)
+                for i in pending:
+                    results[i] = error
+                return
+
+            retry = []
+            for i, item in zip(pending, data):
+                if item is None:
+                    # Időtúllépés miatt ki nem szolgált alkérés
+                    retry.append(i)
+                    continue
+                sub = HttpResponse(item.get('code', 500), {}, (item.get('body') or '').encode())
+                if sub.retryable and attempt < RETRY_MAX_ATTEMPTS:
+                    rate_limiter.observe('graph', self.rate_key, sub)
+                    retry.append(i)
+                elif sub.status == 200:
+                    results[i] = sub.json()
+                else:
+                    results[i] = GraphError(sub.status, sub.json())
+            if not retry:
+                return
+            delay = backoff_delay(attempt)
+            logger.warning(f"Retrying {len(retry)} of {len(pending)} batch requests in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            pending = retry
+        for i in pending:
+            if results[i] is None:
+                results[i] = GraphError(504, 'batch request not answered')
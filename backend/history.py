@@ -0,0 +1,120 @@
+import os
+import math
+import re
+from datetime import datetime, timezone
+import storage
+
+# Egy válaszban visszaadott pontok felső korlátja; nagyobb tartománynál a vödör nő
+MAX_HISTORY_POINTS = int(os.environ.get('MAX_HISTORY_POINTS', '1000'))
+DEFAULT_HISTORY_RANGE = int(os.environ.get('DEFAULT_HISTORY_RANGE_SECONDS', str(24 * 3600)))
+
+_BUCKET_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# Egy vödörben nyers és tömörített sorok is lehetnek. Azonos ts-nél a tömörített sor a későbbi:
+# az a [ts, ts + felbontás) időszak utolsó értékét tárolja, ezért a legnagyobb felbontásút vesszük.
+_HISTORY_SQL = '''
+    WITH buckets AS (
+        SELECT
+            account_id,
+            {bucket_expr} * :bucket AS bucket,
+            SUM(samples) AS samples,
+            MIN(total_min) AS total_min,
+            MAX(total_max) AS total_max,
+            SUM(total_sum) AS total_sum,
+            MIN(unread_min) AS unread_min,
+            MAX(unread_max) AS unread_max,
+            SUM(unread_sum) AS unread_sum,
+            MAX(ts) AS last_ts
+        FROM stats_history
+        WHERE ts >= :start AND ts < :end AND {account_filter}
+        GROUP BY account_id, bucket
+    )
+    SELECT
+        b.bucket, b.samples,
+        b.total_min, b.total_max, b.total_sum,
+        (SELECT h.total_last FROM stats_history h WHERE h.account_id = b.account_id AND h.ts = b.last_ts
+         ORDER BY h.resolution DESC LIMIT 1),
+        b.unread_min, b.unread_max, b.unread_sum,
+        (SELECT h.unread_last FROM stats_history h WHERE h.account_id = b.account_id AND h.ts = b.last_ts
+         ORDER BY h.resolution DESC LIMIT 1)
+    FROM buckets b
+    ORDER BY b.bucket
+'''
+
+
+def parse_time(value):
+    # Unix időbélyeg vagy ISO 8601; időzóna nélkül UTC-nek vesszük
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def parse_bucket(value):
+    # '300', '5m', '1h', '1d'
+    if value is None or value == '':
+        return None
+    match = re.fullmatch(r'(\d+)\s*([smhd]?)', value.strip().lower())
+    if not match:
+        raise ValueError(f"Invalid bucket: {value}")
+    seconds = int(match.group(1)) * _BUCKET_UNITS[match.group(2) or 's']
+    if seconds <= 0:
+        raise ValueError(f"Invalid bucket: {value}")
+    return seconds
+
+
+def effective_bucket(start: float, end: float, bucket: int = None, max_points: int = MAX_HISTORY_POINTS) -> int:
+    min_bucket = max(1, math.ceil((end - start) / max_points))
+    if bucket is None or bucket < min_bucket:
+        bucket = min_bucket
+    return bucket
+
+
+def query_history(database: str, start: float, end: float, bucket: int, account_id: int = None):
+    if account_id is not None:
+        account_filter = 'account_id = :account_id'
+    else:
+        account_filter = 'account_id IN (SELECT id FROM accounts WHERE is_active = TRUE)'
+    with storage.reading(database) as conn:
+        sql = _HISTORY_SQL.format(account_filter=account_filter, bucket_expr=conn.storage.floor('ts / :bucket'))
+        rows = conn.execute(sql, {
+            'bucket': bucket, 'start': start, 'end': end, 'account_id': account_id,
+        }).fetchall()
+
+    # Több fiók esetén vödrönként összeadjuk a fiókok értékeit
+    merged = {}
+    for row in rows:
+        # PostgreSQL-ben a BIGINT összege Decimal, ezért egységesen számmá alakítjuk
+        (ts, samples, total_min, total_max, total_sum, total_last,
+         unread_min, unread_max, unread_sum, unread_last) = [float(value) if value is not None else None for value in row]
+        samples = int(samples)
+        point = merged.get(ts)
+        if point is None:
+            merged[ts] = [samples, total_min, total_max, total_sum / samples, total_last,
+                          unread_min, unread_max, unread_sum / samples, unread_last]
+        else:
+            point[0] += samples
+            point[1] += total_min
+            point[2] += total_max
+            point[3] += total_sum / samples
+            point[4] += total_last
+            point[5] += unread_min
+            point[6] += unread_max
+            point[7] += unread_sum / samples
+            point[8] += unread_last
+
+    return [
+        {
+            'timestamp': datetime.fromtimestamp(ts, timezone.utc).isoformat(),
+            'samples': point[0],
+            'total_messages': {'min': point[1], 'max': point[2], 'avg': point[3], 'last': point[4]},
+            'unread_messages': {'min': point[5], 'max': point[6], 'avg': point[7], 'last': point[8]},
+        }
+        for ts, point in sorted(merged.items())
+    ]
@@ -0,0 +1,52 @@
+import os
+import logging
+import aiohttp
+
+logger = logging.getLogger('http_client')
+
+# Összes nyitott kapcsolat és hostonkénti kapcsolatok felső korlátja
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '100'))
+HTTP_POOL_PER_HOST = int(os.environ.get('HTTP_POOL_PER_HOST', '20'))
+# DNS cache és keep-alive élettartama (másodperc)
+HTTP_DNS_CACHE_TTL = int(os.environ.get('HTTP_DNS_CACHE_TTL', '300'))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get('HTTP_KEEPALIVE_TIMEOUT', '60'))
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', '30'))
+
+_session = None
+
+
+def _create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=HTTP_POOL_PER_HOST,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        use_dns_cache=True,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+    )
+    logger.info(f"HTTP client created (pool: {HTTP_POOL_SIZE}, per host: {HTTP_POOL_PER_HOST})")
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+    )
+
+
+async def start():
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+    return _session
+
+
+def get_session() -> aiohttp.ClientSession:
+    # Futó event loopból hívható; ha a startup még nem hozta létre, itt jön létre
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+    return _session
+
+
+async def close():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
@@ -0,0 +1,143 @@
+import os
+import logging
+import socket
+import time
+import uuid
+from abc import ABC, abstractmethod
+import storage
+
+logger = logging.getLogger('leader')
+
+# Ennyi ideig érvényes a bérlet megújítás nélkül; utána egy másik worker átveheti
+LEADER_LEASE_TTL_SECONDS = float(os.environ.get('LEADER_LEASE_TTL_SECONDS', '30'))
+# Ilyen gyakran újítja meg a vezető a bérletet, a többiek ilyen gyakran próbálják megszerezni
+LEADER_HEARTBEAT_SECONDS = float(os.environ.get('LEADER_HEARTBEAT_SECONDS', '10'))
+
+
+def _holder_id() -> str:
+    # Gép + folyamat + véletlen rész, hogy egy újraindult worker ne örökölje a régi bérletet
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class Lease(ABC):
+    # Egy név, egyszerre egy tulajdonos; az acquire() megszerzésre és megújításra is szolgál
+    def __init__(self, name: str, database: str):
+        self.name = name
+        self.database = database
+        self.holder = _holder_id()
+
+    @abstractmethod
+    def acquire(self) -> bool:
+        pass
+
+    @abstractmethod
+    def release(self):
+        pass
+
+
+class TableLease(Lease):
+    # SQLite: a bérlet egy sor a leases táblában lejárati idővel; a BEGIN IMMEDIATE sorosítja a workereket
+    def __init__(self, name: str, database: str, ttl: float = LEADER_LEASE_TTL_SECONDS):
+        super().__init__(name, database)
+        self.ttl = ttl
+
+    def acquire(self) -> bool:
+        now = time.time()
+        with storage.writing(self.database) as conn:
+            # Csak akkor írjuk felül, ha a miénk, vagy a korábbi tulajdonos nem újította meg időben
+            conn.execute('''
+                INSERT INTO leases (name, holder, expires_at, heartbeat_at)
+                VALUES (:name, :holder, :expires_at, :now)
+                ON CONFLICT (name) DO UPDATE SET
+                    holder = excluded.holder,
+                    expires_at = excluded.expires_at,
+                    heartbeat_at = excluded.heartbeat_at
+                WHERE leases.holder = excluded.holder OR leases.expires_at < :now
+            ''', {'name': self.name, 'holder': self.holder, 'expires_at': now + self.ttl, 'now': now})
+            row = conn.execute("SELECT holder FROM leases WHERE name = :name", {'name': self.name}).fetchone()
+        return row is not None and row[0] == self.holder
+
+    def release(self):
+        with storage.writing(self.database) as conn:
+            conn.execute("DELETE FROM leases WHERE name = :name AND holder = :holder",
+                         {'name': self.name, 'holder': self.holder})
+
+
+class AdvisoryLease(Lease):
+    # PostgreSQL: munkamenet szintű advisory lock egy külön, nyitva tartott kapcsolaton.
+    # Ha a folyamat vagy a kapcsolat elhal, a szerver azonnal elengedi a zárat, nem kell lejáratra várni.
+    def __init__(self, name: str, database: str):
+        super().__init__(name, database)
+        self._conn = None
+
+    def acquire(self) -> bool:
+        if self._conn is not None:
+            # Szívverés: ha a kapcsolat megszakadt, a zárat is elvesztettük
+            try:
+                self._conn.exec_driver_sql("SELECT 1")
+                self._conn.commit()
+                return True
+            except storage.DatabaseError as e:
+                logger.warning(f"Lost connection holding lease {self.name}: {str(e)}")
+                self._discard()
+                return False
+
+        conn = storage.get_storage(self.database).engine.connect()
+        try:
+            got = conn.exec_driver_sql(
+                "SELECT pg_try_advisory_lock(hashtext(%(name)s))", {'name': self.name}
+            ).scalar()
+            # Ne maradjon nyitott tranzakció a kapcsolaton ("idle in transaction")
+            conn.commit()
+        except BaseException:
+            conn.close()
+            raise
+        if not got:
+            conn.close()
+            return False
+        self._conn = conn
+        self._record()
+        return True
+
+    def _record(self):
+        # Csak tájékoztatás (ki a vezető); a kizárást az advisory lock adja
+        try:
+            now = time.time()
+            with storage.writing(self.database) as conn:
+                conn.execute('''
+                    INSERT INTO leases (name, holder, expires_at, heartbeat_at)
+                    VALUES (:name, :holder, NULL, :now)
+                    ON CONFLICT (name) DO UPDATE SET
+                        holder = excluded.holder,
+                        expires_at = excluded.expires_at,
+                        heartbeat_at = excluded.heartbeat_at
+                ''', {'name': self.name, 'holder': self.holder, 'now': now})
+        except storage.DatabaseError as e:
+            logger.warning(f"Could not record lease holder for {self.name}: {str(e)}")
+
+    def _discard(self):
+        try:
+            self._conn.invalidate()
+            self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+
+    def release(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.exec_driver_sql("SELECT pg_advisory_unlock(hashtext(%(name)s))", {'name': self.name})
+            self._conn.commit()
+            self._conn.close()
+        except storage.DatabaseError as e:
+            logger.warning(f"Error releasing lease {self.name}: {str(e)}")
+            self._discard()
+        self._conn = None
+
+
+def create_lease(name: str, database: str = None) -> Lease:
+    backend = storage.get_storage(database)
+    if backend.dialect == 'postgresql':
+        return AdvisoryLease(name, backend.url)
+    return TableLease(name, backend.url)
@@ -0,0 +1,195 @@
+import os
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+from datetime import datetime, timezone
+
+# Alapszint és modulonkénti felülírás, pl. LOG_LEVELS=helpscout=DEBUG,rate_limit=WARNING
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')
+# json: soronként egy JSON rekord; text: a korábbi olvasható formátum
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+# Üres értéknél csak stdout; több workernél ez ajánlott, a forgatás folyamatonként történik
+LOG_FILE = os.environ.get('LOG_FILE')
+LOG_STDOUT = os.environ.get('LOG_STDOUT', 'true').lower() not in ('0', 'false', 'no')
+# Méret szerinti forgatás; LOG_ROTATE_WHEN (pl. midnight) megadásakor idő szerinti
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', '5'))
+LOG_ROTATE_WHEN = os.environ.get('LOG_ROTATE_WHEN', '')
+# Elemenkénti (üzenet, beszélgetés) DEBUG soroknak csak ekkora hányada kerül ki
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+# A háttérben író szál sora; teli sornál a rekord eldobódik, a hívó nem vár
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+
+# Elemenkénti sorokhoz: logger.debug(..., extra=SAMPLED)
+SAMPLED = {'sampled': True}
+
+_RESERVED = set(logging.makeLogRecord({}).__dict__) | {'message', 'asctime', 'sampled'}
+
+# password, client_secret, access_token, skype_token, api_key, ...
+_SECRET_KEYS = r'\w*(?:password|passwd|secret|token|api_key|authorization)'
+_REDACTIONS = [
+    # 'password': 'x' és "access_token": "x" (repr-ben és JSON-ban is)
+    (re.compile(r"""(['"]%s['"]\s*:\s*)(['"])(?:(?!\2).)*\2""" % _SECRET_KEYS, re.IGNORECASE), r'\1\2***\2'),
+    # access_token=x URL-ekben és form adatban
+    (re.compile(r'(\b%s=)[^&\s\'"]+' % _SECRET_KEYS, re.IGNORECASE), r'\1***'),
+    (re.compile(r'(\b(?:Bearer|Basic)\s+)[A-Za-z0-9\-._~+/=]+', re.IGNORECASE), r'\1***'),
+]
+
+
+_SENSITIVE = re.compile(r'passw|secret|token|api_key|authorization|bearer|basic', re.IGNORECASE)
+
+
+def redact(text: str) -> str:
+    # A legtöbb sorban nincs mit kitakarni: egy kereséssel kiszűrjük őket
+    if not _SENSITIVE.search(text):
+        return text
+    for pattern, replacement in _REDACTIONS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class RedactingFilter(logging.Filter):
+    # Az író szálon fut; a QueueHandler addigra egy szöveggé formázta az üzenetet (a traceback-kel együtt)
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = redact(record.getMessage())
+        record.args = None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    # A hívó szálon fut, a sorba tétel előtt: az eldobott sor nem kerül formázásra és a sorba
+    def __init__(self, rate: float = LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, 'sampled', False) and record.levelno <= logging.DEBUG:
+            return random.random() < self.rate
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+        }
+        # extra={...} mezők külön kulcsként
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and key not in data:
+                data[key] = value
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # Teli sornál nem blokkolunk és nem írunk stderr-re hibát, csak számoljuk az eldobott rekordokat
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Leállításkor teli sor mellett is megvárjuk, hogy a sentinel bekerüljön
+        self.queue.put(self._sentinel)
+
+
+_listener = None
+_queue_handler = None
+
+
+def _file_handler(path: str) -> logging.Handler:
+    if LOG_ROTATE_WHEN:
+        return logging.handlers.TimedRotatingFileHandler(path, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT,
+                                                         encoding='utf-8')
+    return logging.handlers.RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                                encoding='utf-8')
+
+
+def parse_levels(spec: str) -> dict:
+    levels = {}
+    for item in spec.split(','):
+        name, _, level = item.strip().partition('=')
+        if name and level:
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(default_file: str = None):
+    # A gyökér loggerre egyetlen, nem blokkoló QueueHandler kerül; a fájl- és stdout írást
+    # egy háttérszál (QueueListener) végzi
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+    formatter = JsonFormatter() if LOG_FORMAT == 'json' else \
+        logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = []
+    if LOG_STDOUT:
+        handlers.append(logging.StreamHandler(sys.stdout))
+    path = LOG_FILE if LOG_FILE is not None else default_file
+    if path:
+        handlers.append(_file_handler(path))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        handler.addFilter(RedactingFilter())
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _queue_handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(LOG_LEVEL)
+    for name, level in parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = _Listener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging():
+    # A sorban maradt rekordok kiírása, majd a fájlok lezárása
+    global _listener, _queue_handler
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def set_level(name: str, level: str):
+    # Futás közbeni módosítás (csak az adott workerben); üres névvel a gyökér logger
+    logging.getLogger(name or None).setLevel(level.upper())
+
+
+def get_levels() -> dict:
+    levels = {'root': logging.getLevelName(logging.getLogger().level)}
+    for name, item in sorted(logging.root.manager.loggerDict.items()):
+        if isinstance(item, logging.Logger) and item.level != logging.NOTSET:
+            levels[name] = logging.getLevelName(item.level)
+    return levels
+
+
+def stats() -> dict:
+    return {
+        'queued': _queue_handler.queue.qsize() if _queue_handler else 0,
+        'dropped': _queue_handler.dropped if _queue_handler else 0,
+    }
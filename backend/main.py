@@ -1,7 +1,7 @@
 import os
+import hmac
 import logging
-import sys
-import traceback
+import logging_setup
 
 # Adatbázis elérési út beállítása
 if os.environ.get('RENDER'):
@@ -9,31 +9,42 @@ if os.environ.get('RENDER'):
 else:
     DB_DIR = os.path.dirname(__file__)
 
-# Logging beállítása
+# Logging beállítása: háttérszálon író, forgatott JSON napló (LOG_* változók)
 log_file = os.path.join(DB_DIR, 'debug.log')
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler(log_file, mode='a', encoding='utf-8')
-    ]
-)
+logging_setup.setup_logging(log_file)
 
 # Logger létrehozása
 logger = logging.getLogger('msg_api')
-logger.setLevel(logging.DEBUG)
 
-from fastapi import FastAPI, HTTPException, Request
+# Az adminisztratív végpontokhoz (X-Admin-Token fejléc); üres értéknél ezek ki vannak kapcsolva
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+from fastapi import FastAPI, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.middleware.base import BaseHTTPMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response, PlainTextResponse
 from pydantic import BaseModel, ValidationError
 from typing import List, Optional
-from datetime import datetime
-import sqlite3
+from datetime import datetime, timezone
 import json
-from services import update_account_stats
+import asyncio
+import time
+from scheduler import scheduler
+from circuit_breaker import circuit_breakers
+from broadcaster import broadcaster
+from stats_writer import stats_writer
+from stats_cache import stats_cache, etag_matches
+import webhooks
+from webhooks import webhook_ingestor
+from event_queue import event_queue, QueueFull
+import sync_state
+import history
+import executor
+import http_client
+import storage
+import migrations
+import metrics
+import profiler
+import tracing
 
 # Explicit export for Gunicorn
 app = FastAPI()
@@ -66,6 +77,16 @@ async def cors_middleware(request: Request, call_next):
     
     return response
 
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # Útvonal minta szerint (/accounts/{account_id}), hogy a címkék száma ne nőjön azonosítónként
+    route = request.scope.get("route")
+    metrics.observe_api(request.method, route.path if route else "unmatched", response.status_code,
+                        time.perf_counter() - started)
+    return response
+
 @app.get("/")
 @app.head("/")
 async def root():
@@ -74,61 +95,82 @@ async def root():
 @app.options("/stats")
 @app.options("/accounts")
 @app.options("/accounts/{account_id}")
+@app.options("/accounts/{account_id}/conversations")
+@app.options("/stats/history")
+@app.options("/stats/stream")
 @app.options("/stats/refresh")
+@app.options("/stats/queue")
+@app.options("/admin/logging")
+@app.options("/debug/profile")
+@app.options("/debug/traces")
+@app.options("/debug/traces/{trace_id}")
+@app.options("/stats/refresh/{job_id}")
 async def options_handler():
     return {"status": "ok"}
 
 # Adatbázis inicializálás
 def init_db():
-    db_path = os.path.join(DB_DIR, 'messages.db')
-    logger.info(f"Initializing database at: {db_path}")
+    database = storage.get_database_url()
+    logger.info(f"Initializing database at: {storage.describe(database)}")
     try:
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS accounts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                account_type TEXT NOT NULL,
-                account_name TEXT NOT NULL,
-                credentials TEXT NOT NULL,
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at TEXT NOT NULL
-            )
-        ''')
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS account_stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                account_id INTEGER NOT NULL,
-                total_messages INTEGER,
-                unread_messages INTEGER,
-                last_unread_date TEXT,
-                last_updated TEXT,
-                FOREIGN KEY (account_id) REFERENCES accounts(id)
-            )
-        ''')
-        conn.commit()
-        logger.info("Database initialized successfully")
+        version = migrations.migrate(database)
+        logger.info(f"Database initialized successfully (schema version {version})")
     except Exception as e:
         logger.error(f"Error initializing database: {str(e)}")
         raise
-    finally:
-        conn.close()
-    return db_path
+    return database
+
+# Globális változó az adatbázis eléréséhez (SQLite fájl vagy PostgreSQL URL)
+DATABASE = init_db()
+broadcaster.database = DATABASE
+stats_cache.database = DATABASE
+stats_writer.database = DATABASE
+circuit_breakers.database = DATABASE
+webhook_ingestor.database = DATABASE
+event_queue.database = DATABASE
 
-# Globális változó az adatbázis elérési útjához
-DB_PATH = init_db()
+# Ennyi csend után üres SSE kommentet küldünk, hogy a proxyk ne zárják le a kapcsolatot
+STREAM_KEEPALIVE_SECONDS = float(os.environ.get('STREAM_KEEPALIVE_SECONDS', '15'))
 
 # Modellek
 class AccountBase(BaseModel):
     account_type: str
     account_name: str
     credentials: dict
+    refresh_interval: Optional[int] = None
 
 class Account(AccountBase):
     id: int
     is_active: bool
     created_at: str
 
+class ConversationState(BaseModel):
+    external_id: str
+    message_count: int
+    unread_count: int
+    oldest_unread: Optional[str]
+    modified_at: Optional[str]
+    updated_at: str
+
+class HistoryValue(BaseModel):
+    min: Optional[float]
+    max: Optional[float]
+    avg: Optional[float]
+    last: Optional[float]
+
+class HistoryPoint(BaseModel):
+    timestamp: str
+    samples: int
+    total_messages: HistoryValue
+    unread_messages: HistoryValue
+
+class StatsHistory(BaseModel):
+    account_id: Optional[int]
+    start: str
+    end: str
+    bucket: int
+    points: List[HistoryPoint]
+
 class AccountStats(BaseModel):
     account_id: int
     account_name: str
@@ -137,15 +179,50 @@ class AccountStats(BaseModel):
     unread_messages: int
     last_unread_date: Optional[str]
     last_updated: str
+    # A legutóbbi frissítés nem sikerült: a számok a last_updated időpontjából valók
+    stale: bool = False
+    circuit: str = 'closed'
+    last_error: Optional[str] = None
 
 @app.on_event("startup")
 async def startup_event():
     init_db()
+    await http_client.start()
+    stats_writer.start()
+    event_queue.start()
+    scheduler.start()
+    metrics.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await broadcaster.stop()
+    await scheduler.stop()
+    await event_queue.stop()
+    await stats_writer.stop()
+    await metrics.stop()
+    executor.shutdown()
+    await http_client.close()
+    storage.close_all()
+    logging_setup.shutdown_logging()
+
+def _insert_account(account: AccountBase, credentials_json: str, now: str) -> int:
+    with storage.writing(DATABASE) as conn:
+        account_id = conn.insert_id(
+            "INSERT INTO accounts (account_type, account_name, credentials, refresh_interval, created_at) "
+            "VALUES (:account_type, :account_name, :credentials, :refresh_interval, :created_at)",
+            {'account_type': account.account_type, 'account_name': account.account_name, 'credentials': credentials_json,
+             'refresh_interval': account.refresh_interval, 'created_at': now}
+        )
+        
+        # Inicializáljuk az account_stats táblát is
+        conn.execute(
+            "INSERT INTO account_stats (account_id, total_messages, unread_messages, last_updated) VALUES (:account_id, 0, 0, :now)",
+            {'account_id': account_id, 'now': now}
+        )
+    return account_id
 
 @app.post("/accounts", response_model=Account)
 async def create_account(account: AccountBase):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
     now = datetime.now().isoformat()
     
     try:
@@ -156,48 +233,42 @@ async def create_account(account: AccountBase):
         # Ellenőrizzük a kötelező mezőket
         if not account.account_type or not account.account_name:
             raise HTTPException(status_code=400, detail="A fiók típusa és neve kötelező")
+
+        if account.refresh_interval is not None and account.refresh_interval <= 0:
+            raise HTTPException(status_code=400, detail="A frissítési időköznek pozitívnak kell lennie")
             
         # Mentsük a credentials-t JSON formátumban
         credentials_json = json.dumps(account.credentials)
         
-        c.execute(
-            "INSERT INTO accounts (account_type, account_name, credentials, created_at) VALUES (?, ?, ?, ?)",
-            (account.account_type, account.account_name, credentials_json, now)
-        )
-        account_id = c.lastrowid
-        conn.commit()
-        
-        # Inicializáljuk az account_stats táblát is
-        c.execute(
-            "INSERT INTO account_stats (account_id, total_messages, unread_messages, last_updated) VALUES (?, 0, 0, ?)",
-            (account_id, now)
-        )
-        conn.commit()
+        account_id = await storage.run_write(_insert_account, account, credentials_json, now)
+        stats_cache.invalidate()
+        broadcaster.notify()
+        webhook_ingestor.invalidate_routes()
         
         return {
             "id": account_id,
             "account_type": account.account_type,
             "account_name": account.account_name,
             "credentials": account.credentials,
+            "refresh_interval": account.refresh_interval,
             "is_active": True,
             "created_at": now
         }
-    except sqlite3.Error as e:
+    except HTTPException:
+        raise
+    except storage.DatabaseError as e:
         raise HTTPException(status_code=500, detail=f"Adatbázis hiba: {str(e)}")
     except ValidationError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Váratlan hiba történt: {str(e)}")
-    finally:
-        conn.close()
 
 @app.get("/accounts", response_model=List[Account])
 async def get_accounts():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id, account_type, account_name, credentials, is_active, created_at FROM accounts WHERE is_active = TRUE")
-    rows = c.fetchall()
-    conn.close()
+    rows = await storage.fetch_all(
+        "SELECT id, account_type, account_name, credentials, is_active, created_at, refresh_interval FROM accounts WHERE is_active = TRUE",
+        database=DATABASE
+    )
     
     return [
         Account(
@@ -206,120 +277,280 @@ async def get_accounts():
             account_name=row[2],
             credentials=eval(row[3]),
             is_active=row[4],
-            created_at=row[5]
+            created_at=row[5],
+            refresh_interval=row[6]
         ) for row in rows
     ]
 
-@app.delete("/accounts/{account_id}")
-async def delete_account(account_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    try:
+def _deactivate_account(account_id: int) -> bool:
+    with storage.writing(DATABASE) as conn:
         # Ellenőrizzük, hogy létezik-e a fiók
-        c.execute("SELECT id FROM accounts WHERE id = ?", (account_id,))
-        if not c.fetchone():
-            raise HTTPException(status_code=404, detail="A fiók nem található")
+        params = {'account_id': account_id}
+        if not conn.execute("SELECT id FROM accounts WHERE id = :account_id", params).fetchone():
+            return False
             
         # Töröljük a statisztikákat
-        c.execute("DELETE FROM account_stats WHERE account_id = ?", (account_id,))
+        conn.execute("DELETE FROM account_stats WHERE account_id = :account_id", params)
+        conn.execute("DELETE FROM stats_history WHERE account_id = :account_id", params)
+        conn.execute("DELETE FROM conversations WHERE account_id = :account_id", params)
+        conn.execute("DELETE FROM sync_watermarks WHERE account_id = :account_id", params)
+        conn.execute("DELETE FROM account_health WHERE account_id = :account_id", params)
+        conn.execute("DELETE FROM webhook_activity WHERE account_id = :account_id", params)
+        conn.execute("DELETE FROM webhook_unread WHERE account_id = :account_id", params)
         
         # Inaktiváljuk a fiókot
-        c.execute("UPDATE accounts SET is_active = FALSE WHERE id = ?", (account_id,))
-        
-        conn.commit()
+        conn.execute("UPDATE accounts SET is_active = FALSE WHERE id = :account_id", params)
+    return True
+
+@app.delete("/accounts/{account_id}")
+async def delete_account(account_id: int):
+    try:
+        if not await storage.run_write(_deactivate_account, account_id):
+            raise HTTPException(status_code=404, detail="A fiók nem található")
+        stats_cache.invalidate()
+        broadcaster.notify()
+        webhook_ingestor.invalidate_routes()
         return {"message": "A fiók sikeresen törölve"}
-    except sqlite3.Error as e:
-        conn.rollback()
+    except storage.DatabaseError as e:
         raise HTTPException(status_code=500, detail=f"Adatbázis hiba: {str(e)}")
     except HTTPException as e:
         raise e
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=f"Váratlan hiba történt: {str(e)}")
-    finally:
-        conn.close()
+
+@app.get("/accounts/{account_id}/conversations", response_model=List[ConversationState])
+async def get_account_conversations(account_id: int, unread_only: bool = False, limit: int = 100, offset: int = 0):
+    # A collectorok által tárolt beszélgetés-állapotból, új API hívás nélkül
+    if limit <= 0 or limit > 1000 or offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid limit or offset")
+    try:
+        rows = await storage.run_read(sync_state.list_conversations, DATABASE, account_id, unread_only, limit, offset)
+    except storage.DatabaseError as e:
+        logger.error(f"Database error in /accounts/{account_id}/conversations: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    return [
+        ConversationState(
+            external_id=row[0],
+            message_count=row[1],
+            unread_count=row[2],
+            oldest_unread=row[3],
+            modified_at=row[4],
+            updated_at=row[5]
+        ) for row in rows
+    ]
 
 @app.get("/stats", response_model=List[AccountStats])
-async def get_stats():
-    logger.info("=== Starting /stats request ===")
+async def get_stats(request: Request):
+    # Verziózott, előre szerializált snapshot; változatlan adatra 304, adatbázis nélkül
     try:
-        logger.info(f"Connecting to database at: {DB_PATH}")
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        logger.info("Executing stats query...")
-        c.execute("""
-            SELECT 
-                s.account_id,
-                a.account_name,
-                a.account_type,
-                s.total_messages,
-                s.unread_messages,
-                s.last_unread_date,
-                s.last_updated
-            FROM account_stats s
-            JOIN accounts a ON s.account_id = a.id
-            WHERE a.is_active = TRUE
-        """)
-        rows = c.fetchall()
-        logger.info(f"Found {len(rows)} rows")
-        
-        result = [
-            AccountStats(
-                account_id=row[0],
-                account_name=row[1],
-                account_type=row[2],
-                total_messages=row[3],
-                unread_messages=row[4],
-                last_unread_date=row[5],
-                last_updated=row[6]
-            ) for row in rows
-        ]
-        logger.info("Successfully processed stats data")
-        return result
-    except sqlite3.Error as e:
+        snapshot = stats_cache.fresh() or await storage.run_read(stats_cache.get)
+    except storage.DatabaseError as e:
         logger.error(f"Database error in /stats: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
-    except Exception as e:
-        logger.error(f"Unexpected error in /stats: {str(e)}")
-        import traceback
-        logger.error(f"Full traceback: {traceback.format_exc()}")
-        raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
-    finally:
-        if 'conn' in locals():
-            conn.close()
-            logger.info("Database connection closed")
-
-@app.post("/stats/refresh")
-async def refresh_stats():
-    logger.info("=== Starting stats refresh ===")
+
+    headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    body, encoding, etag = snapshot.encode(request.headers.get("accept-encoding"))
+    headers["ETag"] = etag
+    if etag_matches(request.headers.get("if-none-match"), snapshot.etag):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/stats/stream")
+async def stream_stats(request: Request):
+    # Server-Sent Events: csatlakozáskor teljes snapshot, utána csak a megváltozott fiókok
+    queue = await broadcaster.subscribe()
+
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            broadcaster.unsubscribe(queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+@app.get("/stats/history", response_model=StatsHistory)
+async def get_stats_history(
+    account_id: Optional[int] = None,
+    start: Optional[str] = Query(None, alias="from"),
+    end: Optional[str] = Query(None, alias="to"),
+    bucket: Optional[str] = None
+):
+    # Szerveroldali vödrözés; account_id nélkül az aktív fiókok összege
     try:
-        # Ellenőrizzük az aktív fiókokat
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT id, account_type, account_name, credentials FROM accounts WHERE is_active = TRUE")
-        accounts = c.fetchall()
-        logger.info(f"Found {len(accounts)} active accounts")
-        
-        for account in accounts:
-            logger.info(f"Account details:")
-            logger.info(f"ID: {account[0]}")
-            logger.info(f"Type: {account[1]}")
-            logger.info(f"Name: {account[2]}")
-            logger.debug(f"Credentials: {account[3]}")
-        
-        conn.close()
-        
-        logger.info("Starting update_account_stats...")
-        await update_account_stats()
-        logger.info("Stats refresh completed successfully")
-        return {"message": "Stats refresh completed"}
-    except Exception as e:
-        logger.error(f"Error during stats refresh: {str(e)}")
-        logger.error(f"Error type: {type(e)}")
-        import traceback
-        logger.error(f"Full traceback: {traceback.format_exc()}")
-        raise HTTPException(status_code=500, detail=str(e))
+        end_ts = history.parse_time(end) or datetime.now(timezone.utc).timestamp()
+        start_ts = history.parse_time(start) or end_ts - history.DEFAULT_HISTORY_RANGE
+        bucket_seconds = history.parse_bucket(bucket)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if start_ts >= end_ts:
+        raise HTTPException(status_code=400, detail="'from' must be earlier than 'to'")
+
+    bucket_seconds = history.effective_bucket(start_ts, end_ts, bucket_seconds)
+    try:
+        points = await storage.run_read(history.query_history, DATABASE, start_ts, end_ts, bucket_seconds, account_id)
+    except storage.DatabaseError as e:
+        logger.error(f"Database error in /stats/history: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    return {
+        "account_id": account_id,
+        "start": datetime.fromtimestamp(start_ts, timezone.utc).isoformat(),
+        "end": datetime.fromtimestamp(end_ts, timezone.utc).isoformat(),
+        "bucket": bucket_seconds,
+        "points": points,
+    }
+
+@app.post("/stats/refresh", status_code=202)
+async def refresh_stats(account_id: Optional[int] = None):
+    # A frissítést a vezető worker futtatja a háttérben, azonnal visszaadjuk a job azonosítót
+    try:
+        job = await scheduler.submit([account_id] if account_id is not None else None)
+    except storage.DatabaseError as e:
+        logger.error(f"Error submitting refresh job: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    logger.info(f"Stats refresh job {job.id} submitted ({job.status})")
+    return job.to_dict()
+
+@app.get("/stats/refresh/{job_id}")
+async def get_refresh_job(job_id: str):
+    try:
+        job = await scheduler.get_job(job_id)
+    except storage.DatabaseError as e:
+        logger.error(f"Error loading refresh job {job_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    if not job:
+        raise HTTPException(status_code=404, detail="Refresh job not found")
+    return job.to_dict()
+
+@app.get("/stats/queue")
+async def get_queue_stats():
+    # A webhook eseménysor mélysége és késése (a legrégebbi feldolgozatlan esemény kora)
+    try:
+        return await event_queue.load_stats()
+    except storage.DatabaseError as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus formátum; több workernél az összes worker értékei összesítve (PROMETHEUS_MULTIPROC_DIR)
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+async def _accept_events(events: list):
+    # Csak a sorba írás után nyugtázunk; telített sornál 503, a Meta és a HelpScout is újraküldi az eseményt
+    try:
+        await webhook_ingestor.submit(events)
+    except QueueFull as e:
+        logger.warning(f"Rejecting {len(events)} webhook events: {str(e)}")
+        raise HTTPException(status_code=503, detail="Webhook queue full", headers={"Retry-After": "5"})
+    except storage.DatabaseError as e:
+        logger.error(f"Error queueing webhook events: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    return {"received": len(events)}
+
+@app.get("/webhooks/meta")
+async def verify_meta_webhook(request: Request):
+    # Feliratkozáskori ellenőrzés: a hub.challenge értékét kell visszaküldeni
+    params = request.query_params
+    if not webhooks.verify_meta_subscription(params.get("hub.mode"), params.get("hub.verify_token")):
+        raise HTTPException(status_code=403, detail="Invalid verify token")
+    return PlainTextResponse(params.get("hub.challenge", ""))
+
+@app.post("/webhooks/meta")
+async def receive_meta_webhook(request: Request):
+    body = await request.body()
+    if not webhooks.valid_meta_signature(body, request.headers.get("X-Hub-Signature-256")):
+        raise HTTPException(status_code=403, detail="Invalid signature")
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+    return await _accept_events(webhooks.parse_meta(payload, await webhook_ingestor.routes()))
+
+@app.post("/webhooks/helpscout")
+async def receive_helpscout_webhook(request: Request):
+    body = await request.body()
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+    # A titok fiókonként eltérhet, az aláírás egyben a fiókot is azonosítja
+    mailbox_id = payload.get("mailboxId") if isinstance(payload, dict) else None
+    routes = await webhook_ingestor.routes()
+    account_id = routes.helpscout_account(body, request.headers.get("X-HelpScout-Signature"), mailbox_id)
+    if account_id is None:
+        raise HTTPException(status_code=403, detail="Invalid signature")
+    return await _accept_events(webhooks.parse_helpscout(request.headers.get("X-HelpScout-Event", ""), payload, account_id))
+
+def _require_admin(request: Request):
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.get("/admin/logging")
+async def get_logging(request: Request):
+    _require_admin(request)
+    return {"levels": logging_setup.get_levels(), **logging_setup.stats()}
+
+@app.put("/admin/logging")
+async def set_logging_level(request: Request, level: str, logger_name: str = Query("", alias="logger")):
+    # Futás közben, újraindítás nélkül; csak a kérést kiszolgáló workerre hat
+    _require_admin(request)
+    try:
+        logging_setup.set_level(logger_name, level)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid log level: {level}")
+    logger.info(f"Log level of {logger_name or 'root'} set to {level.upper()}")
+    return {"levels": logging_setup.get_levels()}
+
+@app.post("/debug/profile")
+async def profile_worker(request: Request, seconds: float = 10, format: str = "text"):
+    # A kérést kiszolgáló worker profilja: text/pstats (cProfile, event loop) vagy collapsed (mintavétel, minden szál)
+    _require_admin(request)
+    if not 0 < seconds <= profiler.DEBUG_PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {profiler.DEBUG_PROFILE_MAX_SECONDS}")
+    if format not in profiler.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format: {format}")
+    try:
+        content = await profiler.profile(seconds, format)
+    except profiler.ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    media_type = "application/octet-stream" if format == "pstats" else "text/plain"
+    return Response(content=content, media_type=media_type, headers={"X-Worker-Pid": str(os.getpid())})
+
+@app.get("/debug/traces")
+async def get_traces(request: Request):
+    # A TRACE_SLOW_SWEEP_SECONDS-nél lassabb frissítési körök, a legújabb elöl
+    _require_admin(request)
+    try:
+        traces = await storage.run_read(tracing.list_traces, DATABASE)
+    except storage.DatabaseError as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    return {"threshold_seconds": tracing.TRACE_SLOW_SWEEP_SECONDS, "traces": traces}
+
+@app.get("/debug/traces/{trace_id}")
+async def get_trace(request: Request, trace_id: str, format: str = "json"):
+    # json: span fa; collapsed: flamegraph.pl / speedscope bemenet
+    _require_admin(request)
+    if format not in ("json", "collapsed"):
+        raise HTTPException(status_code=400, detail=f"Invalid format: {format}")
+    try:
+        trace = await storage.run_read(tracing.load_trace, DATABASE, trace_id)
+    except storage.DatabaseError as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    if format == "collapsed":
+        return PlainTextResponse(tracing.collapsed_stacks(trace))
+    return trace
 
 if __name__ == "__main__":
     import uvicorn
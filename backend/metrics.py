@@ -0,0 +1,156 @@
+import os
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import urlsplit
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess,
+)
+import tracing
+
+logger = logging.getLogger('metrics')
+
+# Több workernél (--workers 4) minden folyamat ebbe a könyvtárba írja az értékeit, a /metrics
+# ezekből összesít. Indításkor üres könyvtár kell (lásd run.sh); nélküle csak a kiszolgáló worker számai látszanak.
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir')
+# Az event loop késését ilyen gyakran mérjük
+METRICS_LOOP_LAG_INTERVAL = float(os.environ.get('METRICS_LOOP_LAG_INTERVAL_SECONDS', '0.5'))
+
+# Gyűjtés: másodperctől a collector időkorlátjáig
+COLLECTOR_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+UPSTREAM_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+API_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+
+COLLECTOR_PHASE = Histogram(
+    'collector_phase_duration_seconds', 'get_stats duration per account and phase (auth, fetch, parse, persist)',
+    ['provider', 'account', 'phase'], buckets=COLLECTOR_BUCKETS)
+COLLECTOR_DURATION = Histogram(
+    'collector_duration_seconds', 'Total get_stats duration per account',
+    ['provider', 'account', 'result'], buckets=COLLECTOR_BUCKETS)
+UPSTREAM_DURATION = Histogram(
+    'upstream_request_duration_seconds', 'Upstream HTTP request latency (one attempt, without rate limit wait)',
+    ['provider', 'host'], buckets=UPSTREAM_BUCKETS)
+UPSTREAM_REQUESTS = Counter(
+    'upstream_requests_total', 'Upstream HTTP requests by status (error: network error or timeout)',
+    ['provider', 'host', 'status'])
+API_DURATION = Histogram(
+    'api_request_duration_seconds', 'API request latency by route',
+    ['method', 'route', 'status'], buckets=API_BUCKETS)
+QUERY_DURATION = Histogram(
+    'db_query_duration_seconds', 'Database statement execution time',
+    ['dialect', 'statement'], buckets=QUERY_BUCKETS)
+# Folyamatonként (pid címkével), mert a késés workerenként más
+LOOP_LAG = Gauge(
+    'event_loop_lag_seconds', 'Event loop scheduling delay of the last probe',
+    multiprocess_mode='liveall')
+
+# A sor az adatbázisban közös, minden worker ugyanazt látja; a futó workerek legnagyobb értéke számít
+EVENT_QUEUE_DEPTH = Gauge(
+    'event_queue_depth', 'Webhook events waiting in the durable queue',
+    multiprocess_mode='livemax')
+EVENT_QUEUE_LAG = Gauge(
+    'event_queue_lag_seconds', 'Age of the oldest waiting webhook event',
+    multiprocess_mode='livemax')
+
+PHASES = ('auth', 'fetch', 'parse', 'persist')
+
+# A futó frissítés fázisidői; a get_stats-ből indított taskok is ezt a szótárt látják
+_phases = ContextVar('collector_phases', default=None)
+
+
+@contextmanager
+def collect(provider: str, account_id):
+    # refresh_account köré: a fázisok és a teljes idő fiókonként kerül a hisztogramokba
+    phases = dict.fromkeys(PHASES, 0.0)
+    token = _phases.set(phases)
+    started = time.perf_counter()
+    result = 'error'
+    try:
+        yield
+        result = 'success'
+    finally:
+        _phases.reset(token)
+        account = str(account_id)
+        COLLECTOR_DURATION.labels(provider, account, result).observe(time.perf_counter() - started)
+        for phase, seconds in phases.items():
+            COLLECTOR_PHASE.labels(provider, account, phase).observe(seconds)
+
+
+@contextmanager
+def phase(name: str):
+    # Egy fázis több szakaszból is állhat (pl. lapozás közben feldolgozás), az idők összeadódnak.
+    # Lassú kör nyomkövetésénél a fázis egy span is a fiók alatt.
+    phases = _phases.get()
+    if phases is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        with tracing.span(name):
+            yield
+    finally:
+        phases[name] += time.perf_counter() - started
+
+
+def observe_upstream(provider: str, url: str, status, seconds: float):
+    host = urlsplit(url).hostname or 'unknown'
+    UPSTREAM_DURATION.labels(provider, host).observe(seconds)
+    UPSTREAM_REQUESTS.labels(provider, host, str(status)).inc()
+
+
+def observe_query(dialect: str, sql: str, seconds: float):
+    # Utasítás típusa (SELECT, INSERT, ...) szerint, nem szövegenként
+    statement = sql.lstrip().split(None, 1)[0].upper() if sql else 'unknown'
+    QUERY_DURATION.labels(dialect, statement).observe(seconds)
+
+
+def observe_queue(depth: int, lag: float):
+    EVENT_QUEUE_DEPTH.set(depth)
+    EVENT_QUEUE_LAG.set(lag)
+
+
+def observe_api(method: str, route: str, status: int, seconds: float):
+    API_DURATION.labels(method, route, str(status)).observe(seconds)
+
+
+async def _run_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + METRICS_LOOP_LAG_INTERVAL
+        await asyncio.sleep(METRICS_LOOP_LAG_INTERVAL)
+        LOOP_LAG.set(max(loop.time() - expected, 0.0))
+
+
+_lag_task = None
+
+
+def start():
+    global _lag_task
+    if _lag_task is None:
+        _lag_task = asyncio.create_task(_run_loop_lag())
+        logger.info(f"Metrics enabled ({'multiprocess: ' + PROMETHEUS_MULTIPROC_DIR if PROMETHEUS_MULTIPROC_DIR else 'single process'})")
+
+
+async def stop():
+    global _lag_task
+    if _lag_task is not None:
+        _lag_task.cancel()
+        await asyncio.gather(_lag_task, return_exceptions=True)
+        _lag_task = None
+    if PROMETHEUS_MULTIPROC_DIR:
+        # A leállt worker élő gauge-ai ne maradjanak az összesítésben
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def render() -> bytes:
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
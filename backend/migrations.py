@@ -0,0 +1,351 @@
+import logging
+from datetime import datetime
+import storage
+
+logger = logging.getLogger('migrations')
+
+# Verziózott sémaváltozások. Új változás: új függvény(ek) és egy új sor a MIGRATIONS végén,
+# a már kiadott lépéseket nem módosítjuk.
+
+
+def _baseline_sqlite(conn):
+    # A korábbi init_db: a régebbi, verziótábla nélküli adatbázisokat is a mostani sémára hozza
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS accounts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            account_type TEXT NOT NULL,
+            account_name TEXT NOT NULL,
+            credentials TEXT NOT NULL,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    # Régebbi adatbázisoknál hiányzik a fiókonkénti frissítési időköz
+    if 'refresh_interval' not in conn.column_names('accounts'):
+        conn.execute("ALTER TABLE accounts ADD COLUMN refresh_interval INTEGER")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats_history (
+            account_id INTEGER NOT NULL,
+            resolution INTEGER NOT NULL,
+            ts REAL NOT NULL,
+            samples INTEGER NOT NULL DEFAULT 1,
+            total_min INTEGER,
+            total_max INTEGER,
+            total_sum INTEGER,
+            total_last INTEGER,
+            unread_min INTEGER,
+            unread_max INTEGER,
+            unread_sum INTEGER,
+            unread_last INTEGER,
+            PRIMARY KEY (account_id, resolution, ts)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stats_history_account_ts ON stats_history (account_id, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stats_history_ts ON stats_history (ts)")
+    # Régi séma: minden frissítés új sort írt; áttérünk fiókonként egy aktuális sorra,
+    # a korábbi sorok az idősorba kerülnek. A last_updated helyi idejű (datetime.now()), ezért
+    # a 'utc' módosító váltja át unix időre, ahogy a Python timestamp() is tenné.
+    if 'id' in conn.column_names('account_stats'):
+        logger.info("Migrating account_stats to one snapshot row per account")
+        conn.execute('''
+            INSERT OR IGNORE INTO stats_history
+                (account_id, resolution, ts, samples,
+                 total_min, total_max, total_sum, total_last,
+                 unread_min, unread_max, unread_sum, unread_last)
+            SELECT account_id, 0, CAST(strftime('%s', last_updated, 'utc') AS REAL), 1,
+                   total_messages, total_messages, total_messages, total_messages,
+                   unread_messages, unread_messages, unread_messages, unread_messages
+            FROM account_stats
+            WHERE last_updated IS NOT NULL
+        ''')
+        conn.execute("ALTER TABLE account_stats RENAME TO account_stats_old")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS account_stats (
+            account_id INTEGER PRIMARY KEY,
+            total_messages INTEGER,
+            unread_messages INTEGER,
+            last_unread_date TEXT,
+            last_updated TEXT,
+            FOREIGN KEY (account_id) REFERENCES accounts(id)
+        )
+    ''')
+    if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'account_stats_old'").fetchone():
+        conn.execute('''
+            INSERT OR REPLACE INTO account_stats
+                (account_id, total_messages, unread_messages, last_unread_date, last_updated)
+            SELECT account_id, total_messages, unread_messages, last_unread_date, last_updated
+            FROM account_stats_old
+            WHERE id IN (SELECT MAX(id) FROM account_stats_old GROUP BY account_id)
+        ''')
+        conn.execute("DROP TABLE account_stats_old")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS auth_tokens (
+            cache_key TEXT PRIMARY KEY,
+            token TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_watermarks (
+            account_id INTEGER PRIMARY KEY,
+            watermark TEXT,
+            full_sync_at TEXT,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY (account_id) REFERENCES accounts(id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            account_id INTEGER NOT NULL,
+            external_id TEXT NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            oldest_unread TEXT,
+            cursor TEXT,
+            modified_at TEXT,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (account_id, external_id),
+            FOREIGN KEY (account_id) REFERENCES accounts(id)
+        )
+    ''')
+    if 'modified_at' not in conn.column_names('conversations'):
+        conn.execute("ALTER TABLE conversations ADD COLUMN modified_at TEXT")
+    # Összesítéshez (MIN oldest_unread) és a lenyitható listához
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_oldest_unread ON conversations (account_id, oldest_unread)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_modified ON conversations (account_id, modified_at)")
+
+
+def _baseline_postgresql(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS accounts (
+            id SERIAL PRIMARY KEY,
+            account_type TEXT NOT NULL,
+            account_name TEXT NOT NULL,
+            credentials TEXT NOT NULL,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TEXT NOT NULL,
+            refresh_interval INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS account_stats (
+            account_id INTEGER PRIMARY KEY REFERENCES accounts(id),
+            total_messages INTEGER,
+            unread_messages INTEGER,
+            last_unread_date TEXT,
+            last_updated TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats_history (
+            account_id INTEGER NOT NULL,
+            resolution INTEGER NOT NULL,
+            ts DOUBLE PRECISION NOT NULL,
+            samples INTEGER NOT NULL DEFAULT 1,
+            total_min BIGINT,
+            total_max BIGINT,
+            total_sum BIGINT,
+            total_last BIGINT,
+            unread_min BIGINT,
+            unread_max BIGINT,
+            unread_sum BIGINT,
+            unread_last BIGINT,
+            PRIMARY KEY (account_id, resolution, ts)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stats_history_account_ts ON stats_history (account_id, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stats_history_ts ON stats_history (ts)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS auth_tokens (
+            cache_key TEXT PRIMARY KEY,
+            token TEXT NOT NULL,
+            expires_at DOUBLE PRECISION NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_watermarks (
+            account_id INTEGER PRIMARY KEY REFERENCES accounts(id),
+            watermark TEXT,
+            full_sync_at TEXT,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            account_id INTEGER NOT NULL REFERENCES accounts(id),
+            external_id TEXT NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            oldest_unread TEXT,
+            cursor TEXT,
+            modified_at TEXT,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (account_id, external_id)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_oldest_unread ON conversations (account_id, oldest_unread)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_modified ON conversations (account_id, modified_at)")
+
+
+def _coordination(real: str):
+    # Több worker/gép közös állapota: ki futtatja a collectorokat, és a frissítési jobok sora
+    def step(conn):
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at {real},
+                heartbeat_at {real} NOT NULL
+            )
+        ''')
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS refresh_jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                account_ids TEXT,
+                created_at TEXT NOT NULL,
+                started_at TEXT,
+                finished_at TEXT,
+                accounts_total INTEGER NOT NULL DEFAULT 0,
+                accounts_done INTEGER NOT NULL DEFAULT 0,
+                errors TEXT,
+                owner TEXT,
+                updated_at {real} NOT NULL
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_refresh_jobs_status ON refresh_jobs (status, created_at)")
+    return step
+
+
+def _account_health(real: str):
+    # Hibás fiókok áramköre és utolsó hibája; sikeres frissítés után a sor törlődik
+    def step(conn):
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS account_health (
+                account_id INTEGER PRIMARY KEY,
+                state TEXT NOT NULL,
+                failures INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                last_failure_at TEXT,
+                opened_until {real},
+                updated_at {real} NOT NULL
+            )
+        ''')
+    return step
+
+
+def _webhook_activity(real: str):
+    # Utolsó webhook esemény fiókonként; ezeknél a fiókoknál ritkább a lekérdezés
+    def step(conn):
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS webhook_activity (
+                account_id INTEGER PRIMARY KEY,
+                last_event_at {real} NOT NULL
+            )
+        ''')
+    return step
+
+
+def _event_queue(real: str, serial: str):
+    # Tartós eseménysor a webhookok és az összesítés között; a feldolgozott sorok a duplikátumszűréshez
+    # még egy ideig megmaradnak
+    def step(conn):
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS event_queue (
+                id {serial},
+                idempotency_key TEXT UNIQUE,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at {real} NOT NULL,
+                consumed_at {real}
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_event_queue_pending ON event_queue (id) WHERE consumed_at IS NULL")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_event_queue_consumed ON event_queue (consumed_at)")
+    return step
+
+
+def _debug_traces(real: str):
+    # A lassú frissítési körök span fái (gyűrűpuffer, a legutóbbi TRACE_BUFFER_SIZE darab)
+    def step(conn):
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS debug_traces (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                started_at {real} NOT NULL,
+                duration {real} NOT NULL,
+                span_count INTEGER NOT NULL,
+                trace TEXT NOT NULL
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_debug_traces_started ON debug_traces (started_at)")
+    return step
+
+
+def _event_queue_failures(real: str):
+    # Hibás események: próbálkozások száma, utolsó hiba; a korlát után failed_at jelöli (dead letter)
+    def step(conn):
+        columns = conn.column_names('event_queue')
+        if 'attempts' not in columns:
+            conn.execute("ALTER TABLE event_queue ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        if 'last_error' not in columns:
+            conn.execute("ALTER TABLE event_queue ADD COLUMN last_error TEXT")
+        if 'failed_at' not in columns:
+            conn.execute(f"ALTER TABLE event_queue ADD COLUMN failed_at {real}")
+    return step
+
+
+def _webhook_unread(conn):
+    # Meta webhookok: partnerenként a webhookból számolt olvasatlanok, hogy a válasz nullázhassa őket
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_unread (
+            account_id INTEGER NOT NULL,
+            peer TEXT NOT NULL,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (account_id, peer)
+        )
+    ''')
+
+
+# (verzió, leírás, {dialektus: függvény})
+MIGRATIONS = [
+    (1, 'baseline schema', {'sqlite': _baseline_sqlite, 'postgresql': _baseline_postgresql}),
+    (2, 'leader lease and refresh job queue', {'sqlite': _coordination('REAL'), 'postgresql': _coordination('DOUBLE PRECISION')}),
+    (3, 'account health for circuit breakers', {'sqlite': _account_health('REAL'), 'postgresql': _account_health('DOUBLE PRECISION')}),
+    (4, 'webhook activity', {'sqlite': _webhook_activity('REAL'), 'postgresql': _webhook_activity('DOUBLE PRECISION')}),
+    (5, 'durable event queue', {'sqlite': _event_queue('REAL', 'INTEGER PRIMARY KEY AUTOINCREMENT'),
+                                'postgresql': _event_queue('DOUBLE PRECISION', 'BIGSERIAL PRIMARY KEY')}),
+    (6, 'slow sweep traces', {'sqlite': _debug_traces('REAL'), 'postgresql': _debug_traces('DOUBLE PRECISION')}),
+    (7, 'event queue retries and dead letters', {'sqlite': _event_queue_failures('REAL'),
+                                                 'postgresql': _event_queue_failures('DOUBLE PRECISION')}),
+    (8, 'webhook unread per peer', {'sqlite': _webhook_unread, 'postgresql': _webhook_unread}),
+]
+
+
+def migrate(database: str = None) -> int:
+    backend = storage.get_storage(database)
+    with backend.writing() as conn:
+        # Több API példány egyszerre indulhat; a zár alatt csak egy futtatja a lépéseket
+        conn.lock('schema_migrations')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TEXT NOT NULL
+            )
+        ''')
+        applied = {row[0] for row in conn.execute("SELECT version FROM schema_migrations").fetchall()}
+        current = max(applied, default=0)
+        for version, name, steps in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info(f"Applying migration {version} ({name}) on {backend.dialect}")
+            steps[backend.dialect](conn)
+            conn.execute(
+                "INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :applied_at)",
+                {'version': version, 'name': name, 'applied_at': datetime.now().isoformat()}
+            )
+            current = version
+    return current
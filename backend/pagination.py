@@ -0,0 +1,55 @@
+import os
+import asyncio
+import logging
+from rate_limit import request
+import tracing
+
+logger = logging.getLogger('pagination')
+
+# Egyszerre letöltött oldalak száma egy lekérdezésen belül
+PAGE_FETCH_CONCURRENCY = int(os.environ.get('PAGE_FETCH_CONCURRENCY', '4'))
+
+
+class PageFetchError(Exception):
+    def __init__(self, status: int, message: str = None):
+        super().__init__(message or f"Page request failed with status {status}")
+        self.status = status
+
+
+async def _fetch_page(session, url, headers, params, provider: str, key: str):
+    # A keretet és az újrapróbálást a közös rate limiter kezeli, az oldalak közösen várakoznak
+    with tracing.span('page', page=params.get('page')):
+        response = await request(session, 'GET', url, provider, key, headers=headers, params=params)
+    if response.status != 200:
+        raise PageFetchError(response.status)
+    body = response.json()
+    # Üres vagy nem objektum törzs (pl. proxy hibaoldal 200-zal) is a modul saját hibája legyen
+    if not isinstance(body, dict):
+        raise PageFetchError(response.status, f"Page response is not a JSON object ({type(body).__name__})")
+    return body
+
+
+async def fetch_all_pages(session, url: str, headers: dict, params: dict, provider: str, key: str = None,
+                          max_concurrency: int = PAGE_FETCH_CONCURRENCY):
+    # HAL formátumú (HelpScout) lapozott lista: az első oldalból derül ki az oldalak száma,
+    # a többit korlátozott párhuzamossággal töltjük le
+    first = await _fetch_page(session, url, headers, {**params, 'page': 1}, provider, key)
+    total_pages = first.get('page', {}).get('totalPages', 1) or 1
+    if total_pages <= 1:
+        return [first]
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _limited(page: int):
+        async with semaphore:
+            return await _fetch_page(session, url, headers, {**params, 'page': page}, provider, key)
+
+    logger.info(f"Fetching {total_pages - 1} more pages from {url}")
+    tasks = [asyncio.ensure_future(_limited(page)) for page in range(2, total_pages + 1)]
+    try:
+        rest = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return [first, *rest]
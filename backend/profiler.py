@@ -0,0 +1,89 @@
+import os
+import asyncio
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+import sys
+import threading
+import time
+from executor import run_blocking
+
+logger = logging.getLogger('profiler')
+
+# Egy profilozás felső korlátja (másodperc)
+DEBUG_PROFILE_MAX_SECONDS = int(os.environ.get('DEBUG_PROFILE_MAX_SECONDS', '120'))
+# Mintavételes módban ilyen gyakran olvassuk ki a szálak vermét
+DEBUG_PROFILE_SAMPLE_MS = float(os.environ.get('DEBUG_PROFILE_SAMPLE_MS', '5'))
+# Szöveges kimenetben ennyi függvény, kumulált idő szerint
+DEBUG_PROFILE_TOP = 80
+
+FORMATS = ('text', 'pstats', 'collapsed')
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+_lock = threading.Lock()
+
+
+async def _cprofile(seconds: float) -> pstats.Stats:
+    # A cProfile csak a bekapcsoló szálat méri: ez az event loop, vagyis az összes API kérés,
+    # collector és háttér task; a szálkészletben futó blokkoló hívásokat a mintavételes mód látja
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profile.disable()
+    return pstats.Stats(profile)
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ',')
+
+
+def _sample(seconds: float, interval: float) -> dict:
+    # Minden szál vermének periodikus kiolvasása; a mintavevő szálat magát kihagyjuk
+    own = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(_frame_name(frame))
+                frame = frame.f_back
+            frames.append(names.get(ident, str(ident)))
+            key = ';'.join(reversed(frames))
+            stacks[key] = stacks.get(key, 0) + 1
+        time.sleep(interval)
+    return stacks
+
+
+async def profile(seconds: float, fmt: str = 'text') -> bytes:
+    # Workerenként egyszerre egy profilozás; a kimenet az éppen kérést kiszolgáló workeré
+    if not _lock.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running in this worker")
+    try:
+        logger.info(f"Profiling worker {os.getpid()} for {seconds:g}s ({fmt})")
+        if fmt == 'collapsed':
+            # Külön szálon, hogy az event loop közben zavartalanul fusson (és mintát adjon)
+            stacks = await run_blocking('profiler', _sample, seconds, DEBUG_PROFILE_SAMPLE_MS / 1000)
+            return ''.join(f"{stack} {count}\n" for stack, count in sorted(stacks.items())).encode()
+        stats = await _cprofile(seconds)
+        if fmt == 'pstats':
+            # snakeviz / python -m pstats bemenet
+            return marshal.dumps(stats.stats)
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats('cumulative').print_stats(DEBUG_PROFILE_TOP)
+        return out.getvalue().encode()
+    finally:
+        _lock.release()
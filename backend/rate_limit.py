@@ -0,0 +1,300 @@
+import os
+import asyncio
+import json
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import aiohttp
+import metrics
+import tracing
+
+logger = logging.getLogger('rate_limit')
+
+# Keret hitelesítő adatonként (kérés/másodperc, löket) és szolgáltatónként összesen.
+# Felülírható pl. RATE_LIMIT_HELPSCOUT_RPS=5, RATE_LIMIT_HELPSCOUT_BURST=10,
+# RATE_LIMIT_GRAPH_TOTAL_RPS=100 változókkal.
+DEFAULT_LIMITS = {
+    # HelpScout: 400 kérés/perc fiókonként
+    'helpscout': {'rps': 6.0, 'burst': 10, 'total_rps': 50.0},
+    # Graph: a tényleges keretet a használati fejlécekből követjük
+    'graph': {'rps': 20.0, 'burst': 40, 'total_rps': 100.0},
+    'skype': {'rps': 5.0, 'burst': 10, 'total_rps': 20.0},
+}
+DEFAULT_RPS = float(os.environ.get('RATE_LIMIT_DEFAULT_RPS', '10'))
+# Ha ennyi vagy kevesebb kérés marad a keretből, megállunk a keret megújulásáig
+RATE_LIMIT_MIN_REMAINING = int(os.environ.get('RATE_LIMIT_MIN_REMAINING', '2'))
+# E fölötti kihasználtságnál (%) lassítunk, 100%-nál a szolgáltató már tilt
+RATE_LIMIT_SLOWDOWN_PERCENT = float(os.environ.get('RATE_LIMIT_SLOWDOWN_PERCENT', '75'))
+# Lassításnál a ráta szorzója; sikeres, terhelés nélküli válasz után lépésenként visszaáll
+RATE_LIMIT_DECREASE_FACTOR = 0.5
+RATE_LIMIT_RECOVERY_STEP = 0.05
+RATE_LIMIT_MIN_RPS = 0.1
+# Újrapróbálás 429, 5xx és hálózati hiba esetén: exponenciális várakozás teljes jitterrel
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', '5'))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY_SECONDS', '0.5'))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY_SECONDS', '60'))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Graph: ezek a hibakódok 400/403 státusszal is korlátozást jelentenek
+GRAPH_THROTTLE_CODES = {4, 17, 32, 613, 80001, 80002, 80004, 80005, 80006, 80008}
+
+
+def _limit(provider: str, name: str, default: float) -> float:
+    value = os.environ.get(f'RATE_LIMIT_{provider.upper()}_{name.upper()}')
+    if value is not None:
+        return float(value)
+    return DEFAULT_LIMITS.get(provider, {}).get(name, default)
+
+
+def backoff_delay(attempt: int) -> float:
+    # Teljes jitter: a sok egyszerre visszautasított kérés ne egyszerre próbálkozzon újra
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _seconds(value):
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    # Retry-After HTTP dátumként is érkezhet
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _header_int(headers, prefix: str):
+    # HelpScout: X-RateLimit-Remaining-Minute, mások: X-RateLimit-Remaining; a legszigorúbbat vesszük
+    result = None
+    for name, value in headers.items():
+        if name.lower().startswith(prefix):
+            try:
+                result = int(value) if result is None else min(result, int(value))
+            except ValueError:
+                pass
+    return result
+
+
+def _reset_seconds(headers):
+    wait = _seconds(headers.get('X-RateLimit-Retry-After'))
+    if wait is not None:
+        return wait
+    reset = headers.get('X-RateLimit-Reset')
+    if reset is None:
+        return None
+    try:
+        reset = float(reset)
+    except ValueError:
+        return None
+    # Unix időbélyeg vagy hátralévő másodperc
+    return max(reset - time.time(), 0.0) if reset > 1e9 else reset
+
+
+def _graph_usage(headers):
+    # X-App-Usage: {"call_count": 28, "total_time": 25, "total_cputime": 25} (százalék)
+    # X-Business-Use-Case-Usage: {"<id>": [{"call_count": .., "estimated_time_to_regain_access": perc}]}
+    percent, regain = None, None
+    app_usage = headers.get('X-App-Usage')
+    if app_usage:
+        try:
+            usage = json.loads(app_usage)
+            percent = max(usage.get(k, 0) for k in ('call_count', 'total_time', 'total_cputime'))
+        except (ValueError, AttributeError):
+            pass
+    business_usage = headers.get('X-Business-Use-Case-Usage')
+    if business_usage:
+        try:
+            for entries in json.loads(business_usage).values():
+                for usage in entries:
+                    value = max(usage.get(k, 0) for k in ('call_count', 'total_time', 'total_cputime'))
+                    percent = value if percent is None else max(percent, value)
+                    minutes = usage.get('estimated_time_to_regain_access') or 0
+                    if minutes:
+                        regain = max(regain or 0, minutes * 60)
+        except (ValueError, AttributeError):
+            pass
+    return percent, regain
+
+
+class HttpResponse:
+    # A teljes válasz beolvasva, így a kapcsolat azonnal visszakerül a poolba és újrapróbálható
+    def __init__(self, status: int, headers, body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        if not self.body:
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+    def text(self) -> str:
+        return self.body.decode('utf-8', errors='replace')
+
+    @property
+    def throttled(self) -> bool:
+        if self.status == 429:
+            return True
+        if self.status in (400, 403):
+            data = self.json()
+            error = data.get('error') if isinstance(data, dict) else None
+            return isinstance(error, dict) and error.get('code') in GRAPH_THROTTLE_CODES
+        return False
+
+    @property
+    def retryable(self) -> bool:
+        return self.status in RETRY_STATUSES or self.throttled
+
+
+class TokenBucket:
+    # GCRA: minden hívó lefoglal egy időpontot és addig alszik, így nem kell zár az event loopon belül
+    def __init__(self, name: str, rate: float, burst: int):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self._tat = 0.0
+        self.blocked_until = 0.0
+
+    def _reserve(self, cost: int) -> float:
+        now = time.monotonic()
+        start = max(now, self.blocked_until)
+        interval = 1.0 / self.rate
+        tat = max(self._tat, start)
+        send_at = max(start, tat + (cost - self.burst) * interval)
+        self._tat = tat + cost * interval
+        return send_at - now
+
+    async def acquire(self, cost: int = 1):
+        # cost: egy kötegelt kérés annyi kérésnek számít, ahány alkérést tartalmaz
+        delay = self._reserve(cost)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            # Közben a szolgáltató tiltást küldhetett (Retry-After)
+            delay = self.blocked_until - time.monotonic()
+
+    def block(self, seconds: float):
+        until = time.monotonic() + seconds
+        if until > self.blocked_until:
+            self.blocked_until = until
+            logger.warning(f"Rate limit for {self.name}: pausing for {seconds:.1f}s")
+
+    def slow_down(self):
+        rate = max(RATE_LIMIT_MIN_RPS, self.rate * RATE_LIMIT_DECREASE_FACTOR)
+        if rate < self.rate:
+            self.rate = rate
+            logger.info(f"Rate limit for {self.name}: slowing down to {rate:.2f} req/s")
+
+    def recover(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_LIMIT_RECOVERY_STEP)
+
+
+class RateLimiter:
+    def __init__(self):
+        self._buckets = {}
+
+    def _bucket(self, provider: str, key: str = None) -> TokenBucket:
+        name = f"{provider}:{key}" if key else provider
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            if key:
+                rate = _limit(provider, 'rps', DEFAULT_RPS)
+                burst = int(_limit(provider, 'burst', max(1, int(rate))))
+            else:
+                rate = _limit(provider, 'total_rps', DEFAULT_RPS * 10)
+                burst = int(rate)
+            bucket = TokenBucket(name, rate, burst)
+            self._buckets[name] = bucket
+        return bucket
+
+    async def acquire(self, provider: str, key: str = None, cost: int = 1):
+        # Szolgáltató szintű (pl. Graph alkalmazás) és hitelesítő adatonkénti keret is
+        await self._bucket(provider).acquire(cost)
+        if key:
+            await self._bucket(provider, key).acquire(cost)
+
+    def observe(self, provider: str, key: str, response: HttpResponse):
+        bucket = self._bucket(provider, key)
+        headers = response.headers
+        pressure = False
+
+        if response.throttled or response.status == 503:
+            pressure = True
+            bucket.slow_down()
+            wait = _seconds(headers.get('Retry-After')) or _reset_seconds(headers)
+            if wait:
+                bucket.block(wait)
+
+        remaining = _header_int(headers, 'x-ratelimit-remaining')
+        if remaining is not None:
+            limit = _header_int(headers, 'x-ratelimit-limit')
+            if remaining <= RATE_LIMIT_MIN_REMAINING:
+                pressure = True
+                bucket.block(_reset_seconds(headers) or 1.0)
+            elif limit and remaining * 100 < limit * (100 - RATE_LIMIT_SLOWDOWN_PERCENT):
+                pressure = True
+                bucket.slow_down()
+
+        percent, regain = _graph_usage(headers)
+        if percent is not None and percent >= RATE_LIMIT_SLOWDOWN_PERCENT:
+            pressure = True
+            # Az X-App-Usage az alkalmazás egészére vonatkozik, nem csak erre a tokenre
+            target = self._bucket(provider) if headers.get('X-App-Usage') else bucket
+            target.slow_down()
+            if percent >= 100:
+                target.block(regain or 60.0)
+
+        if not pressure and response.status < 400:
+            bucket.recover()
+            self._bucket(provider).recover()
+
+    def reset(self):
+        self._buckets.clear()
+
+
+rate_limiter = RateLimiter()
+
+
+async def request(session: aiohttp.ClientSession, method: str, url: str, provider: str, key: str = None,
+                  retries: int = RETRY_MAX_ATTEMPTS, cost: int = 1, **kwargs) -> HttpResponse:
+    # Keret szerinti várakozás, majd 429/5xx/hálózati hibánál újrapróbálás.
+    # A végleges hibás választ visszaadjuk, a hívó dönt róla.
+    with tracing.span('http', method=method, host=urlsplit(url).hostname):
+        response = await _request(session, method, url, provider, key, retries, cost, **kwargs)
+        tracing.annotate(status=response.status)
+        return response
+
+
+async def _request(session: aiohttp.ClientSession, method: str, url: str, provider: str, key: str,
+                   retries: int, cost: int, **kwargs) -> HttpResponse:
+    for attempt in range(retries + 1):
+        await rate_limiter.acquire(provider, key, cost)
+        # A keretre várakozás nem számít bele a szolgáltató válaszidejébe
+        started = time.perf_counter()
+        try:
+            async with session.request(method, url, **kwargs) as raw:
+                response = HttpResponse(raw.status, raw.headers, await raw.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.observe_upstream(provider, url, 'error', time.perf_counter() - started)
+            if attempt >= retries:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"{provider} request failed ({type(e).__name__}: {str(e)}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+
+        metrics.observe_upstream(provider, url, response.status, time.perf_counter() - started)
+        rate_limiter.observe(provider, key, response)
+        if not response.retryable or attempt >= retries:
+            return response
+        delay = backoff_delay(attempt)
+        logger.warning(f"{provider} returned {response.status}, retry {attempt + 1}/{retries} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+    return response
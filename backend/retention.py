@@ -0,0 +1,115 @@
+import os
+import logging
+import time
+import storage
+
+logger = logging.getLogger('retention')
+
+# Felbontások másodpercben; 0 = nyers mérési pont
+RAW = 0
+FIVE_MINUTES = 300
+HOURLY = 3600
+
+# Meddig tartjuk meg a nyers pontokat és az 5 perces összesítéseket (másodperc)
+RAW_RETENTION = int(os.environ.get('HISTORY_RAW_RETENTION_SECONDS', str(48 * 3600)))
+FIVE_MINUTE_RETENTION = int(os.environ.get('HISTORY_5M_RETENTION_SECONDS', str(30 * 24 * 3600)))
+COMPACTION_INTERVAL = int(os.environ.get('HISTORY_COMPACTION_INTERVAL_SECONDS', '600'))
+
+_ROLLUP_SQL = '''
+    WITH grouped AS (
+        SELECT
+            account_id,
+            {bucket_expr} * :dst AS bucket,
+            SUM(samples) AS samples,
+            MIN(total_min) AS total_min,
+            MAX(total_max) AS total_max,
+            SUM(total_sum) AS total_sum,
+            MIN(unread_min) AS unread_min,
+            MAX(unread_max) AS unread_max,
+            SUM(unread_sum) AS unread_sum,
+            MAX(ts) AS last_ts
+        FROM stats_history
+        WHERE resolution = :src AND ts < :cutoff
+        GROUP BY account_id, bucket
+    )
+    INSERT INTO stats_history
+        (account_id, resolution, ts, samples,
+         total_min, total_max, total_sum, total_last,
+         unread_min, unread_max, unread_sum, unread_last)
+    SELECT
+        g.account_id, :dst, g.bucket, g.samples,
+        g.total_min, g.total_max, g.total_sum, h.total_last,
+        g.unread_min, g.unread_max, g.unread_sum, h.unread_last
+    FROM grouped g
+    JOIN stats_history h
+        ON h.account_id = g.account_id AND h.resolution = :src AND h.ts = g.last_ts
+    WHERE TRUE
+    ON CONFLICT (account_id, resolution, ts) DO UPDATE SET
+        samples = stats_history.samples + excluded.samples,
+        total_min = {total_min},
+        total_max = {total_max},
+        total_sum = stats_history.total_sum + excluded.total_sum,
+        total_last = excluded.total_last,
+        unread_min = {unread_min},
+        unread_max = {unread_max},
+        unread_sum = stats_history.unread_sum + excluded.unread_sum,
+        unread_last = excluded.unread_last
+'''
+
+_RAW_POINT_SQL = '''
+    INSERT INTO stats_history
+        (account_id, resolution, ts, samples,
+         total_min, total_max, total_sum, total_last,
+         unread_min, unread_max, unread_sum, unread_last)
+    VALUES (:account_id, 0, :ts, 1, :total, :total, :total, :total, :unread, :unread, :unread, :unread)
+    ON CONFLICT (account_id, resolution, ts) DO UPDATE SET
+        samples = excluded.samples,
+        total_min = excluded.total_min,
+        total_max = excluded.total_max,
+        total_sum = excluded.total_sum,
+        total_last = excluded.total_last,
+        unread_min = excluded.unread_min,
+        unread_max = excluded.unread_max,
+        unread_sum = excluded.unread_sum,
+        unread_last = excluded.unread_last
+'''
+
+
+def _rollup_sql(backend) -> str:
+    return _ROLLUP_SQL.format(
+        bucket_expr=backend.floor('ts / :dst'),
+        total_min=backend.least('stats_history.total_min', 'excluded.total_min'),
+        total_max=backend.greatest('stats_history.total_max', 'excluded.total_max'),
+        unread_min=backend.least('stats_history.unread_min', 'excluded.unread_min'),
+        unread_max=backend.greatest('stats_history.unread_max', 'excluded.unread_max'),
+    )
+
+
+def record_points(conn, points):
+    # Nyers pontok egy executemany-vel: (account_id, total_messages, unread_messages, ts); a hívó commitol
+    conn.executemany(_RAW_POINT_SQL, [
+        {'account_id': account_id, 'ts': ts if ts is not None else time.time(),
+         'total': total_messages, 'unread': unread_messages}
+        for account_id, total_messages, unread_messages, ts in points
+    ])
+
+
+def _rollup(conn, src: int, dst: int, older_than: float) -> int:
+    # Csak teljes célvödröket tömörítünk, ezért a határt a célfelbontásra kerekítjük
+    cutoff = int(older_than // dst) * dst
+    params = {'src': src, 'dst': dst, 'cutoff': cutoff}
+    conn.execute(_rollup_sql(conn.storage), params)
+    c = conn.execute("DELETE FROM stats_history WHERE resolution = :src AND ts < :cutoff", params)
+    return c.rowcount
+
+
+def compact(database: str, now: float = None):
+    now = now if now is not None else time.time()
+    with storage.writing(database) as conn:
+        # Több API példány esetén egyszerre csak egy tömörít, különben a vödrök duplán számolódnának
+        conn.lock('stats_history_compaction')
+        raw_removed = _rollup(conn, RAW, FIVE_MINUTES, now - RAW_RETENTION)
+        five_removed = _rollup(conn, FIVE_MINUTES, HOURLY, now - FIVE_MINUTE_RETENTION)
+    if raw_removed or five_removed:
+        logger.info(f"History compacted: {raw_removed} raw points, {five_removed} 5-minute rollups")
+    return raw_removed, five_removed
@@ -1,3 +1,8 @@
 #!/bin/bash
 cd backend
-python -m uvicorn main:app --host 0.0.0.0 --port $PORT --workers 4 
\ No newline at end of file
+# A workerek metrika fájljai; minden indítás üres könyvtárral kezd
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/msg_dashboard_metrics}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+# Több workernél csak stdout: a workerek egymástól függetlenül forgatnák ugyanazt a fájlt
+export LOG_FILE="${LOG_FILE-}"
+python -m uvicorn main:app --host 0.0.0.0 --port $PORT --workers 4
@@ -0,0 +1,399 @@
+import os
+import asyncio
+import json
+import logging
+import time
+import traceback
+import uuid
+from datetime import datetime
+from services import load_active_accounts, refresh_account
+import retention
+import storage
+from storage import get_database_url
+from stats_writer import stats_writer
+from leader import create_lease, LEADER_HEARTBEAT_SECONDS
+from circuit_breaker import circuit_breakers
+import tracing
+from webhooks import load_webhook_activity, WEBHOOK_RECONCILE_INTERVAL_SECONDS
+
+logger = logging.getLogger('scheduler')
+
+# Alapértelmezett frissítési időköz fiókonként (másodperc)
+DEFAULT_REFRESH_INTERVAL = int(os.environ.get('REFRESH_INTERVAL_SECONDS', '300'))
+# Milyen gyakran nézzük meg, melyik fiók esedékes
+SCHEDULER_TICK_SECONDS = float(os.environ.get('SCHEDULER_TICK_SECONDS', '15'))
+# A vezető ilyen gyakran nézi meg, küldött-e másik worker frissítési kérést
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', '1'))
+# Futó job előrehaladását legfeljebb ilyen gyakran írjuk ki, nem fiókonként
+JOB_PROGRESS_SECONDS = 1.0
+# Ennyi lezárt job állapotát őrizzük meg a státusz lekérdezéshez
+MAX_FINISHED_JOBS = 200
+
+JOB_COLUMNS = 'id, status, account_ids, created_at, started_at, finished_at, accounts_total, accounts_done, errors'
+
+
+class RefreshJob:
+    def __init__(self, account_ids=None):
+        self.id = uuid.uuid4().hex
+        self.account_ids = account_ids
+        self.status = 'pending'
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.accounts_total = 0
+        self.accounts_done = 0
+        self.errors = {}
+
+    @classmethod
+    def from_row(cls, row):
+        job = cls(json.loads(row[2]) if row[2] is not None else None)
+        job.id, job.status = row[0], row[1]
+        job.created_at, job.started_at, job.finished_at = row[3], row[4], row[5]
+        job.accounts_total, job.accounts_done = row[6], row[7]
+        job.errors = json.loads(row[8]) if row[8] else {}
+        return job
+
+    def covers(self, account_ids) -> bool:
+        # Várakozó teljes frissítés mindent lefed; futó jobhoz csak azonos kérés csatlakozhat
+        if self.status == 'pending' and self.account_ids is None:
+            return True
+        return self.account_ids == account_ids
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "account_ids": self.account_ids,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "accounts_total": self.accounts_total,
+            "accounts_done": self.accounts_done,
+            "errors": self.errors,
+        }
+
+
+# A jobok az adatbázisban vannak: bármelyik worker fogadhat kérést és adhat állapotot,
+# de csak a vezető futtatja őket
+
+def enqueue_job(database: str, job: RefreshJob) -> RefreshJob:
+    with storage.writing(database) as conn:
+        conn.lock('refresh_jobs')
+        rows = conn.execute(
+            f"SELECT {JOB_COLUMNS} FROM refresh_jobs WHERE status IN ('pending', 'running') ORDER BY created_at"
+        ).fetchall()
+        for row in rows:
+            existing = RefreshJob.from_row(row)
+            if existing.covers(job.account_ids):
+                return existing
+        conn.execute(f'''
+            INSERT INTO refresh_jobs ({JOB_COLUMNS}, updated_at)
+            VALUES (:id, :status, :account_ids, :created_at, NULL, NULL, 0, 0, NULL, :updated_at)
+        ''', {'id': job.id, 'status': job.status, 'created_at': job.created_at, 'updated_at': time.time(),
+              'account_ids': json.dumps(job.account_ids) if job.account_ids is not None else None})
+        conn.execute('''
+            DELETE FROM refresh_jobs WHERE finished_at IS NOT NULL AND id NOT IN (
+                SELECT id FROM refresh_jobs WHERE finished_at IS NOT NULL ORDER BY finished_at DESC LIMIT :keep
+            )
+        ''', {'keep': MAX_FINISHED_JOBS})
+    return job
+
+
+def load_job(database: str, job_id: str):
+    with storage.reading(database) as conn:
+        row = conn.execute(f"SELECT {JOB_COLUMNS} FROM refresh_jobs WHERE id = :id", {'id': job_id}).fetchone()
+    return RefreshJob.from_row(row) if row else None
+
+
+def has_pending_jobs(database: str) -> bool:
+    with storage.reading(database) as conn:
+        return conn.execute("SELECT 1 FROM refresh_jobs WHERE status = 'pending' LIMIT 1").fetchone() is not None
+
+
+def claim_pending_jobs(database: str, owner: str):
+    started_at = datetime.now().isoformat()
+    with storage.writing(database) as conn:
+        conn.lock('refresh_jobs')
+        rows = conn.execute(
+            f"SELECT {JOB_COLUMNS} FROM refresh_jobs WHERE status = 'pending' ORDER BY created_at"
+        ).fetchall()
+        jobs = [RefreshJob.from_row(row) for row in rows]
+        for job in jobs:
+            job.status = 'running'
+            job.started_at = started_at
+        conn.executemany('''
+            UPDATE refresh_jobs SET status = 'running', owner = :owner, started_at = :started_at, updated_at = :updated_at
+            WHERE id = :id
+        ''', [{'id': job.id, 'owner': owner, 'started_at': started_at, 'updated_at': time.time()} for job in jobs])
+    return jobs
+
+
+def save_job(database: str, job: RefreshJob):
+    with storage.writing(database) as conn:
+        conn.execute('''
+            UPDATE refresh_jobs SET
+                status = :status, finished_at = :finished_at, accounts_total = :accounts_total,
+                accounts_done = :accounts_done, errors = :errors, updated_at = :updated_at
+            WHERE id = :id
+        ''', {'id': job.id, 'status': job.status, 'finished_at': job.finished_at,
+              'accounts_total': job.accounts_total, 'accounts_done': job.accounts_done,
+              'errors': json.dumps(job.errors) if job.errors else None, 'updated_at': time.time()})
+
+
+def requeue_orphaned_jobs(database: str) -> int:
+    # Új vezető: az előző vezető félbemaradt jobjai újra sorra kerülnek
+    with storage.writing(database) as conn:
+        conn.lock('refresh_jobs')
+        return conn.execute('''
+            UPDATE refresh_jobs SET status = 'pending', owner = NULL, accounts_done = 0, updated_at = :updated_at
+            WHERE status = 'running'
+        ''', {'updated_at': time.time()}).rowcount
+
+
+class RefreshScheduler:
+    def __init__(self, default_interval: int = DEFAULT_REFRESH_INTERVAL, tick: float = SCHEDULER_TICK_SECONDS):
+        self.default_interval = default_interval
+        self.tick = tick
+        self.lease = None
+        self.is_leader = False
+        self._inflight = {}
+        self._last_started = {}
+        self._job_tasks = set()
+        self._leader_tasks = []
+        self._election_task = None
+        self._job_wakeup = None
+
+    def start(self):
+        # Minden worker elindítja, de a collectorokat csak a bérlet tulajdonosa futtatja
+        if self._election_task is None or self._election_task.done():
+            self.lease = create_lease('collectors', get_database_url())
+            self._job_wakeup = asyncio.Event()
+            self._election_task = asyncio.create_task(self._run_election())
+            logger.info(f"Scheduler started as {self.lease.holder} (default interval: {self.default_interval}s, tick: {self.tick}s)")
+
+    async def stop(self):
+        tasks = [t for t in [self._election_task, *self._leader_tasks, *self._job_tasks, *self._inflight.values()] if t]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._election_task = None
+        self._leader_tasks = []
+        if self.is_leader:
+            # Azonnali átadás: a többi worker a következő szívverésnél átveszi, nem kell lejáratra várni
+            self.is_leader = False
+            try:
+                await storage.run_write(self.lease.release)
+            except Exception as e:
+                logger.warning(f"Could not release leader lease: {str(e)}")
+        logger.info("Scheduler stopped")
+
+    async def get_job(self, job_id: str):
+        return await storage.run_read(load_job, get_database_url(), job_id)
+
+    async def submit(self, account_ids=None) -> RefreshJob:
+        # Bármelyik worker fogadhatja; ha már van a kérést lefedő aktív job, azt adjuk vissza
+        job = await storage.run_write(enqueue_job, get_database_url(), RefreshJob(account_ids))
+        if self.is_leader:
+            self._job_wakeup.set()
+        return job
+
+    def _track(self, task: asyncio.Task):
+        self._job_tasks.add(task)
+        task.add_done_callback(self._job_tasks.discard)
+
+    def refresh(self, account_id: int, account_type: str, credentials: str) -> asyncio.Task:
+        # Single-flight: ha a fiók frissítése már fut, ahhoz csatlakozunk
+        task = self._inflight.get(account_id)
+        if task is not None and not task.done():
+            return task
+
+        self._last_started[account_id] = datetime.now()
+        task = asyncio.create_task(refresh_account(account_id, account_type, credentials))
+        self._inflight[account_id] = task
+
+        def _done(t, account_id=account_id):
+            if self._inflight.get(account_id) is t:
+                del self._inflight[account_id]
+        task.add_done_callback(_done)
+        return task
+
+    async def _run_election(self):
+        while True:
+            try:
+                leader = await storage.run_write(self.lease.acquire)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Ha nem tudjuk megújítani, inkább lemondunk, mint hogy két vezető fusson
+                logger.error(f"Leader lease heartbeat failed: {str(e)}")
+                leader = False
+            if leader and not self.is_leader:
+                await self._become_leader()
+            elif not leader and self.is_leader:
+                await self._step_down()
+            await asyncio.sleep(LEADER_HEARTBEAT_SECONDS)
+
+    async def _become_leader(self):
+        self.is_leader = True
+        logger.info(f"Acquired collector lease, {self.lease.holder} is now the leader")
+        try:
+            requeued = await storage.run_write(requeue_orphaned_jobs, get_database_url())
+            if requeued:
+                logger.info(f"Requeued {requeued} refresh jobs left running by the previous leader")
+        except Exception as e:
+            logger.error(f"Could not requeue orphaned refresh jobs: {str(e)}")
+        try:
+            await circuit_breakers.load()
+        except Exception as e:
+            logger.error(f"Could not load circuit breaker state: {str(e)}")
+        self._leader_tasks = [
+            asyncio.create_task(self._run_loop()),
+            asyncio.create_task(self._run_compaction_loop()),
+            asyncio.create_task(self._run_job_queue()),
+        ]
+
+    async def _step_down(self):
+        self.is_leader = False
+        logger.warning(f"Lost collector lease, {self.lease.holder} stops running collectors")
+        # A félbemaradt jobokat az új vezető állítja újra sorba
+        tasks = [*self._leader_tasks, *self._job_tasks, *self._inflight.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._leader_tasks = []
+
+    async def _run_job_queue(self):
+        holder = self.lease.holder
+        while True:
+            try:
+                # Olvasással nézzük meg, hogy üresjáratban ne nyissunk írási tranzakciót
+                if await storage.run_read(has_pending_jobs, get_database_url()):
+                    for job in await storage.run_write(claim_pending_jobs, get_database_url(), holder):
+                        self._track(asyncio.create_task(self._run_job(job)))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Refresh job queue poll failed: {str(e)}")
+                logger.error(f"Full traceback: {traceback.format_exc()}")
+            try:
+                await asyncio.wait_for(self._job_wakeup.wait(), timeout=JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._job_wakeup.clear()
+
+    async def _save_job(self, job: RefreshJob):
+        try:
+            await storage.run_write(save_job, get_database_url(), job)
+        except Exception as e:
+            logger.error(f"Could not save refresh job {job.id}: {str(e)}")
+
+    async def _report_progress(self, job: RefreshJob):
+        saved = None
+        while True:
+            await asyncio.sleep(JOB_PROGRESS_SECONDS)
+            if job.accounts_done != saved:
+                saved = job.accounts_done
+                await self._save_job(job)
+
+    async def _run_job(self, job: RefreshJob):
+        progress = None
+        # Lassú job esetén a span fa megmarad (/debug/traces)
+        with tracing.sweep('job', get_database_url(), job_id=job.id):
+            try:
+                accounts = await storage.run_read(load_active_accounts)
+                if job.account_ids is not None:
+                    accounts = [a for a in accounts if a[0] in job.account_ids]
+                job.accounts_total = len(accounts)
+                progress = asyncio.create_task(self._report_progress(job))
+
+                async def _wait(account):
+                    account_id, account_type, credentials, _, _ = account
+                    try:
+                        # shield: a job megszakítása ne állítsa le a közös futást
+                        await asyncio.shield(self.refresh(account_id, account_type, credentials))
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        job.errors[str(account_id)] = str(e)
+                        logger.error(f"Refresh failed for account {account_id}: {str(e)}")
+                    finally:
+                        job.accounts_done += 1
+
+                await asyncio.gather(*[_wait(a) for a in accounts])
+                # A job csak akkor kész, ha az eredményei már az adatbázisban vannak
+                await stats_writer.flush()
+                job.status = 'failed' if job.errors else 'completed'
+            except asyncio.CancelledError:
+                # Nem írjuk ki: 'running' marad, és a következő vezető újra sorba állítja
+                logger.info(f"Refresh job {job.id} interrupted")
+                raise
+            except Exception as e:
+                job.status = 'failed'
+                job.errors['job'] = str(e)
+                logger.error(f"Refresh job {job.id} failed: {str(e)}")
+                logger.error(f"Full traceback: {traceback.format_exc()}")
+            finally:
+                if progress is not None:
+                    progress.cancel()
+        job.finished_at = datetime.now().isoformat()
+        await self._save_job(job)
+        logger.info(f"Refresh job {job.id} finished with status: {job.status}")
+
+    async def _run_sweep(self, accounts):
+        # A kör fiókjai ebben a taskban indulnak, így a lassú kör nyomkövetése (span fa) mindet lefedi.
+        # Egy kör eredményei egyszerre, egy tranzakcióban kerülnek ki, így a /stats konzisztens pillanatképet mutat
+        with tracing.sweep('scheduled', get_database_url(), accounts=len(accounts)):
+            tasks = [self.refresh(*account) for account in accounts]
+            await asyncio.gather(*tasks, return_exceptions=True)
+            with tracing.span('flush'):
+                await stats_writer.flush()
+
+    def _is_due(self, account_id: int, interval, last_updated, webhook_at=None) -> bool:
+        interval = interval or self.default_interval
+        last = self._last_started.get(account_id)
+        if webhook_at is not None and time.time() - webhook_at < WEBHOOK_RECONCILE_INTERVAL_SECONDS:
+            # Webhookkal frissülő fiók: a last_updated-et az események is léptetik,
+            # a lekérdezés csak ritka egyeztetés
+            interval = max(interval, WEBHOOK_RECONCILE_INTERVAL_SECONDS)
+            last_updated = None
+        if last_updated:
+            try:
+                stored = datetime.fromisoformat(last_updated)
+                last = stored if last is None else max(last, stored)
+            except ValueError:
+                pass
+        return last is None or (datetime.now() - last).total_seconds() >= interval
+
+    async def _run_loop(self):
+        while True:
+            try:
+                sweep = []
+                webhook_activity = await storage.run_read(load_webhook_activity, get_database_url())
+                for account_id, account_type, credentials, interval, last_updated in await storage.run_read(load_active_accounts):
+                    due = self._is_due(account_id, interval, last_updated, webhook_activity.get(account_id))
+                    # Nyitott áramkörű fiók kimarad, amíg le nem telik a várakozás
+                    if due and not circuit_breakers.is_open(account_id):
+                        sweep.append((account_id, account_type, credentials))
+                if sweep:
+                    self._track(asyncio.create_task(self._run_sweep(sweep)))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Scheduler tick failed: {str(e)}")
+                logger.error(f"Full traceback: {traceback.format_exc()}")
+            await asyncio.sleep(self.tick)
+
+    async def _run_compaction_loop(self):
+        # Idősor megőrzési szabály: nyers pontok 48 óráig, utána 5 perces, 30 nap után órás összesítés
+        while True:
+            try:
+                await storage.run_write(retention.compact, get_database_url())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"History compaction failed: {str(e)}")
+                logger.error(f"Full traceback: {traceback.format_exc()}")
+            await asyncio.sleep(retention.COMPACTION_INTERVAL)
+
+
+scheduler = RefreshScheduler()
@@ -0,0 +1,72 @@
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import time
+import aiohttp
+from webhooks import helpscout_signature
+
+# Aláírt fixture payloadok küldése a futó backendnek, helyi teszteléshez és terheléshez, pl.:
+#   META_APP_SECRET=... python send_webhook.py webhook_fixtures/meta_whatsapp.json --set PHONE_NUMBER_ID=123 --count 5000
+#   HELPSCOUT_WEBHOOK_SECRET=... python send_webhook.py webhook_fixtures/helpscout_customer_reply.json
+# Az azonos payloadokat a backend duplikátumként eldobja; egyedi azonosítókhoz a {n} a kérés sorszáma:
+#   --set wamid.1=wamid.{n}
+
+
+def _load(path: str, replacements, n: int = 0) -> bytes:
+    with open(path) as f:
+        body = f.read()
+    for replacement in replacements:
+        key, _, value = replacement.partition('=')
+        body = body.replace(key, value.replace('{n}', str(n)))
+    # Tömör JSON, ahogy a szolgáltatók küldik; az aláírás erre a bájtsorozatra vonatkozik
+    return json.dumps(json.loads(body), separators=(',', ':')).encode()
+
+
+def _request(body: bytes, args):
+    if 'object' in json.loads(body):
+        secret = args.secret or os.environ.get('META_APP_SECRET', '')
+        signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        return f"{args.url}/webhooks/meta", {'X-Hub-Signature-256': f"sha256={signature}"}
+    secret = args.secret or os.environ.get('HELPSCOUT_WEBHOOK_SECRET', '')
+    return f"{args.url}/webhooks/helpscout", {
+        'X-HelpScout-Signature': helpscout_signature(secret, body),
+        'X-HelpScout-Event': args.event,
+    }
+
+
+async def main(args):
+    statuses = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with aiohttp.ClientSession() as session:
+        async def _send(n):
+            body = _load(args.fixture, args.set, n)
+            url, headers = _request(body, args)
+            headers['Content-Type'] = 'application/json'
+            async with semaphore:
+                async with session.post(url, data=body, headers=headers) as response:
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+                    if args.count == 1:
+                        print(response.status, await response.text())
+
+        started = time.monotonic()
+        await asyncio.gather(*[_send(n) for n in range(args.count)])
+        elapsed = time.monotonic() - started
+
+    print(f"Sent {args.count} requests to {args.url} in {elapsed:.2f}s ({args.count / elapsed:.0f}/s): {statuses}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Send a signed webhook fixture to the backend')
+    parser.add_argument('fixture')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='replace a placeholder in the fixture, e.g. PAGE_ID=123')
+    parser.add_argument('--event', default='convo.customer.reply.created', help='X-HelpScout-Event header')
+    parser.add_argument('--secret', help='defaults to META_APP_SECRET / HELPSCOUT_WEBHOOK_SECRET')
+    parser.add_argument('--count', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
@@ -1,237 +1,511 @@
 import os
+import time
 from abc import ABC, abstractmethod
-from datetime import datetime
-import sqlite3
-import requests
+from datetime import datetime, timedelta
 from skpy import Skype
-from facebook import GraphAPI
 import aiohttp
 import asyncio
 import json
 import base64
+import hashlib
 import logging
 import traceback
 from skpy.core import SkypeAuthException
+from executor import run_blocking
+import http_client
+from token_cache import TokenCache
+from pagination import fetch_all_pages, PageFetchError
+import rate_limit
+from graph_api import GraphClient, GraphError, relative_url, GRAPH_MAX_PAGES
+import sync_state
+import storage
+from storage import get_database_url
+from stats_writer import stats_writer
+from stats_cache import stats_cache
+from broadcaster import broadcaster
+from circuit_breaker import circuit_breakers, collector_timeout
+from logging_setup import SAMPLED
+import metrics
+import tracing
+from metrics import phase
+
+logger = logging.getLogger('services')
+
+# Messenger: ennyi üzenet jön beágyazva beszélgetésenként (field expansion); ha ennél több
+# az olvasatlan, a további oldalakat kötegelve kérjük le
+MESSENGER_MESSAGES_PAGE = int(os.environ.get('MESSENGER_MESSAGES_PAGE', '25'))
+GRAPH_PAGE_SIZE = int(os.environ.get('GRAPH_PAGE_SIZE', '100'))
+# Skype: egy chatben ennyi napnál régebbi, illetve ennél több üzenetet nem olvasunk végig
+SKYPE_HISTORY_DAYS = int(os.environ.get('SKYPE_HISTORY_DAYS', '30'))
+SKYPE_MAX_MESSAGES_PER_CHAT = int(os.environ.get('SKYPE_MAX_MESSAGES_PER_CHAT', '1000'))
+# A benchmark a helyi fake szerverre irányítja (bench/sweep.py)
+HELPSCOUT_API_URL = os.environ.get('HELPSCOUT_API_URL', 'https://api.helpscout.net/v2').rstrip('/')
+
+# OAuth tokenek és Skype munkamenetek fiókonként, SQLite-ban is megőrizve
+token_cache = TokenCache(get_database_url())
 
 class MessageService(ABC):
-    def __init__(self, account_id: int, credentials: dict):
+    # A rate limiter kerete ehhez a szolgáltatóhoz tartozik
+    provider = None
+
+    def __init__(self, account_id: int, credentials: dict, http: aiohttp.ClientSession = None):
         self.account_id = account_id
         self.credentials = credentials
-        if os.environ.get('RENDER'):
-            db_dir = '/opt/render/project/src'
-        else:
-            db_dir = os.path.dirname(__file__)
-        self.db_path = os.path.join(db_dir, 'messages.db')
+        self.database = get_database_url()
+        self._http = http
+        # Szolgáltatásonkénti logger (whatsapp, skype, messenger, helpscout), szintje LOG_LEVELS-szel állítható
+        self.logger = logging.getLogger(type(self).__name__[:-len('Service')].lower())
+
+    @property
+    def http(self) -> aiohttp.ClientSession:
+        # Az alkalmazás szintű, kapcsolat-poolos kliens; minden collector ezt használja
+        if self._http is None or self._http.closed:
+            self._http = http_client.get_session()
+        return self._http
+
+    @property
+    def rate_key(self) -> str:
+        # Hitelesítő adatonkénti keret: a közös tokent használó fiókok egy keretből fogyasztanak
+        digest = hashlib.sha1(json.dumps(self.credentials, sort_keys=True).encode()).hexdigest()
+        return digest[:12]
+
+    async def _request(self, method: str, url: str, **kwargs) -> rate_limit.HttpResponse:
+        return await rate_limit.request(self.http, method, url, self.provider, self.rate_key, **kwargs)
 
     @abstractmethod
     async def get_stats(self):
         pass
 
     def save_stats(self, total_messages: int, unread_messages: int, oldest_unread_date: str):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        now = datetime.now().isoformat()
-        
-        c.execute('''
-            INSERT OR REPLACE INTO account_stats 
-            (account_id, total_messages, unread_messages, last_unread_date, last_updated)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (self.account_id, total_messages, unread_messages, oldest_unread_date, now))
-        
-        conn.commit()
-        conn.close()
+        # Nem írunk azonnal: az író a teljes frissítési kört egy tranzakcióban menti
+        # (fiókonként egy aktuális sor, a mérés az idősorba is bekerül)
+        stats_writer.submit(self.account_id, total_messages, unread_messages, oldest_unread_date)
 
 class WhatsAppService(MessageService):
+    provider = 'graph'
+
     async def get_stats(self):
         try:
-            print(f"Connecting to WhatsApp Business API...")
-            headers = {
-                "Authorization": f"Bearer {self.credentials['api_key']}",
-                "Content-Type": "application/json"
-            }
+            self.logger.info("Connecting to WhatsApp Business API...")
+            graph = GraphClient(self.http, self.credentials['api_key'], self.rate_key)
+            phone_number_id = self.credentials['phone_number_id']
             
-            async with aiohttp.ClientSession() as session:
-                # Business Account információk lekérése
-                base_url = "https://graph.facebook.com/v17.0"
-                waba_id = self.credentials['waba_id']
-                phone_number_id = self.credentials['phone_number_id']
-                
-                # Összes üzenet lekérése
-                messages_url = f"{base_url}/{phone_number_id}/messages"
-                async with session.get(messages_url, headers=headers) as response:
-                    if response.status == 200:
-                        messages_data = await response.json()
-                        total_messages = len(messages_data.get('data', []))
-                    else:
-                        print(f"Error fetching messages: {await response.text()}")
-                        total_messages = 0
-                
-                # Olvasatlan üzenetek lekérése
-                conversations_url = f"{base_url}/{phone_number_id}/conversations"
-                async with session.get(conversations_url, headers=headers) as response:
-                    if response.status == 200:
-                        conversations_data = await response.json()
-                        unread_messages = sum(
-                            conv.get('unread_count', 0) 
-                            for conv in conversations_data.get('data', [])
-                        )
-                        
-                        # Legrégebbi olvasatlan üzenet dátuma
-                        oldest_unread_date = None
-                        for conv in conversations_data.get('data', []):
-                            if conv.get('unread_count', 0) > 0:
-                                updated_time = conv.get('updated_time')
-                                if updated_time:
-                                    if oldest_unread_date is None or updated_time < oldest_unread_date:
-                                        oldest_unread_date = updated_time
-                    else:
-                        print(f"Error fetching conversations: {await response.text()}")
-                        unread_messages = 0
-                        oldest_unread_date = None
+            # Üzenetek és beszélgetések egy batch kérésben, utána a kurzorok szerint lapozunk
+            with phase('fetch'):
+                messages_page, conversations_page = await graph.batch([
+                    f"{phone_number_id}/messages?limit={GRAPH_PAGE_SIZE}",
+                    f"{phone_number_id}/conversations?limit={GRAPH_PAGE_SIZE}",
+                ])
+                for page in (messages_page, conversations_page):
+                    if isinstance(page, GraphError):
+                        raise page
+                messages, conversations = await asyncio.gather(
+                    graph.paginate(messages_page),
+                    graph.paginate(conversations_page),
+                )
+            
+            with phase('parse'):
+                total_messages = len(messages)
                 
-                print(f"WhatsApp stats - Total: {total_messages}, Unread: {unread_messages}, Oldest unread: {oldest_unread_date}")
-                self.save_stats(total_messages, unread_messages, oldest_unread_date)
+                # Olvasatlan üzenetek
+                unread_messages = sum(conv.get('unread_count', 0) for conv in conversations)
                 
+                # Legrégebbi olvasatlan üzenet dátuma
+                oldest_unread_date = None
+                for conv in conversations:
+                    if conv.get('unread_count', 0) > 0:
+                        updated_time = conv.get('updated_time')
+                        if updated_time:
+                            if oldest_unread_date is None or updated_time < oldest_unread_date:
+                                oldest_unread_date = updated_time
+            
+            self.logger.info(f"WhatsApp stats - Total: {total_messages}, Unread: {unread_messages}, "
+                             f"Oldest unread: {oldest_unread_date} ({graph.requests} Graph requests)")
+            self.save_stats(total_messages, unread_messages, oldest_unread_date)
+            
         except Exception as e:
-            print(f"Error getting WhatsApp stats: {str(e)}")
-            print(f"Error type: {type(e)}")
-            print(f"Full traceback: {traceback.format_exc()}")
-            # Hiba esetén nullázzuk az értékeket
-            self.save_stats(0, 0, None)
+            self.logger.error(f"Error getting WhatsApp stats ({type(e).__name__}): {str(e)}")
+            self.logger.error(f"Full traceback: {traceback.format_exc()}")
+            # Hiba esetén nem nullázunk: az utolsó sikeres értékek maradnak, a hibát a job rögzíti
+            raise
+
+# Tokenből felépített Skype kliensek fiókonként, hogy a következő futás újra felhasználhassa
+_skype_clients = {}
 
 class SkypeService(MessageService):
+    provider = 'skype'
+
+    @property
+    def token_key(self) -> str:
+        return f"skype:{self.account_id}"
+
     async def get_stats(self):
         try:
-            print(f"Attempting to connect to Skype with username: {self.credentials['username']}")
-            try:
-                sk = Skype(self.credentials['username'], self.credentials['password'])
-                print("Successfully connected to Skype")
-            except SkypeAuthException as auth_exc:
-                print(f"Skype authentication failed: {auth_exc}. Skipping Skype stats update.")
-                self.save_stats(0, 0, None)
-                return
-
-            total_messages = 0
-            unread_messages = 0
-            oldest_unread_date = None
-            
-            print("Fetching recent chats...")
-            chats = sk.chats.recent()
-            print(f"Found {len(chats)} chats, processing...")
-            
-            for chat_id, chat in chats.items():
-                try:
-                    print(f"Processing chat: {chat_id}")
-                    if hasattr(chat, 'getMsgs'):
-                        messages = list(chat.getMsgs())
-                        print(f"Found {len(messages)} messages in chat")
-                        total_messages += len(messages)
-                        
-                        for msg in messages:
-                            try:
-                                # Debug információk
-                                print(f"Message ID: {msg.id}")
-                                print(f"Message type: {msg.type}")
-                                print(f"Message time: {msg.time}")
-                                
-                                # Ellenőrizzük az üzenet állapotát
-                                is_unread = False
-                                
-                                # Új módszer: közvetlenül a msg objektumból ellenőrizzük
-                                if hasattr(msg, 'read'):
-                                    is_unread = not bool(msg.read)
-                                    print(f"Message read status from read attribute: {is_unread}")
-                                
-                                # Ha nincs read attribútum, próbáljuk a properties-ből
-                                if not hasattr(msg, 'read') and hasattr(msg, 'properties'):
-                                    is_unread = bool(msg.properties.get('isunread', False))
-                                    print(f"Message read status from properties: {is_unread}")
-                                
-                                if is_unread:
-                                    unread_messages += 1
-                                    if hasattr(msg, 'time'):
-                                        msg_date = msg.time.isoformat() if msg.time else None
-                                        if msg_date:
-                                            if oldest_unread_date is None or msg_date < oldest_unread_date:
-                                                oldest_unread_date = msg_date
-                                                print(f"Found unread message from: {msg_date}")
-                            except Exception as msg_error:
-                                print(f"Error processing message in chat {chat_id}: {str(msg_error)}")
-                                continue
-                                
-                except Exception as chat_error:
-                    print(f"Error processing chat {chat_id}: {str(chat_error)}")
-                    continue
-            
-            print(f"Final Skype stats - Total messages: {total_messages}, Unread: {unread_messages}, Oldest unread: {oldest_unread_date}")
+            with phase('auth'):
+                token = await token_cache.get(self.token_key, self._fetch_token)
+            total_messages, unread_messages, oldest_unread_date = await self._collect_stats(token)
+            self.logger.info(f"Final Skype stats - Total messages: {total_messages}, Unread: {unread_messages}, Oldest unread: {oldest_unread_date}")
             self.save_stats(total_messages, unread_messages, oldest_unread_date)
-            
+
+        except SkypeAuthException as auth_exc:
+            self.logger.warning(f"Skype authentication failed: {auth_exc}. Skipping Skype stats update.")
+            # A tárolt munkamenet érvénytelen, a következő futás újra bejelentkezik
+            await token_cache.invalidate(self.token_key)
+            _skype_clients.pop(self.account_id, None)
+            raise
         except Exception as e:
-            print(f"Error getting Skype stats: {str(e)}")
-            print(f"Error type: {type(e)}")
-            print(f"Full traceback: {traceback.format_exc()}")
-            self.save_stats(0, 0, None)
+            self.logger.error(f"Error getting Skype stats ({type(e).__name__}): {str(e)}")
+            self.logger.error(f"Full traceback: {traceback.format_exc()}")
+            raise
+
+    async def _fetch_token(self):
+        return await run_blocking('skype', self._login)
+
+    def _login(self):
+        self.logger.info(f"Attempting to connect to Skype with username: {self.credentials['username']}")
+        sk = Skype(self.credentials['username'], self.credentials['password'])
+        self.logger.info("Successfully connected to Skype")
+        conn = sk.conn
+        token = json.dumps({
+            'user_id': conn.userId,
+            'skype_token': conn.tokens['skype'],
+            'skype_expiry': conn.tokenExpiry['skype'].timestamp(),
+            'reg_token': conn.tokens['reg'],
+            'reg_expiry': conn.tokenExpiry['reg'].timestamp(),
+            'msgs_host': conn.msgsHost,
+        })
+        _skype_clients[self.account_id] = (token, sk)
+        return token, conn.tokenExpiry['skype'].timestamp()
+
+    def _client_from_token(self, token: str) -> Skype:
+        cached = _skype_clients.get(self.account_id)
+        if cached and cached[0] == token:
+            return cached[1]
+
+        # Ugyanazokat a mezőket állítjuk vissza, mint az skpy saját token fájlja
+        data = json.loads(token)
+        sk = Skype(connect=False)
+        conn = sk.conn
+        conn.userId = data['user_id']
+        conn.tokens['skype'] = data['skype_token']
+        conn.tokenExpiry['skype'] = datetime.fromtimestamp(data['skype_expiry'])
+        if time.time() < data['reg_expiry']:
+            conn.tokens['reg'] = data['reg_token']
+            conn.tokenExpiry['reg'] = datetime.fromtimestamp(data['reg_expiry'])
+            conn.msgsHost = data['msgs_host']
+        else:
+            conn.getRegToken()
+        _skype_clients[self.account_id] = (token, sk)
+        return sk
+
+    @staticmethod
+    def _message_order(message_id):
+        # A Skype üzenet azonosítók növekvő számok, így a sorrend összehasonlítható
+        try:
+            return int(message_id)
+        except (TypeError, ValueError):
+            return 0
+
+    @staticmethod
+    def _is_unread(msg) -> bool:
+        if hasattr(msg, 'read'):
+            return not bool(msg.read)
+        if hasattr(msg, 'properties'):
+            return bool(msg.properties.get('isunread', False))
+        return False
+
+    def _recent_chats(self, token: str):
+        sk = self._client_from_token(token)
+        # Az skpy a lapozási állapotot a kapcsolaton tárolja; minden futás a legfrissebb oldallal kezd
+        sk.conn.syncStates.clear()
+        return sk.chats.recent()
+
+    def _iter_messages(self, chat, last_seen, horizon: datetime):
+        # Az üzenetek a legújabbtól érkeznek, oldalanként; egyszerre csak egy oldal van a memóriában.
+        # Megállunk az utoljára látott üzenetnél (delta), az időhorizontnál vagy a darabszám korlátnál.
+        count = 0
+        page = chat.getMsgs()
+        while page:
+            for msg in page:
+                if last_seen is not None and self._message_order(msg.id) <= last_seen:
+                    return
+                if msg.time and msg.time < horizon:
+                    return
+                yield msg
+                count += 1
+                if count >= SKYPE_MAX_MESSAGES_PER_CHAT:
+                    return
+            page = chat.getMsgs()
+
+    def _scan_chat(self, chat, previous, horizon: datetime):
+        # Csak számlálók maradnak meg, az üzenet objektumok nem
+        last_seen = self._message_order(previous['cursor']) if previous else None
+        newest_id, newest_time = None, None
+        message_count, unread_count, oldest_unread = 0, 0, None
+        for msg in self._iter_messages(chat, last_seen, horizon):
+            if newest_id is None:
+                newest_id, newest_time = msg.id, msg.time.isoformat() if msg.time else None
+            message_count += 1
+            try:
+                if self._is_unread(msg):
+                    unread_count += 1
+                    msg_date = msg.time.isoformat() if msg.time else None
+                    if msg_date and (oldest_unread is None or msg_date < oldest_unread):
+                        oldest_unread = msg_date
+            except Exception as msg_error:
+                self.logger.debug(f"Error processing message in chat {chat.id}: {str(msg_error)}", extra=SAMPLED)
+
+        if previous is None:
+            return {
+                'message_count': message_count,
+                'unread_count': unread_count,
+                'oldest_unread': oldest_unread,
+                'cursor': newest_id,
+                'modified_at': newest_time,
+            }
+        if message_count == 0:
+            return None
+        # Az új üzenetek számlálóit hozzáadjuk a tárolt beszélgetés számlálóihoz
+        if previous['oldest_unread'] and (oldest_unread is None or previous['oldest_unread'] < oldest_unread):
+            oldest_unread = previous['oldest_unread']
+        return {
+            'message_count': previous['message_count'] + message_count,
+            'unread_count': previous['unread_count'] + unread_count,
+            'oldest_unread': oldest_unread,
+            'cursor': newest_id,
+            'modified_at': newest_time,
+        }
+
+    async def _collect_stats(self, token: str):
+        with phase('persist'):
+            watermark, full_sync_at = await storage.run_read(sync_state.get_watermark, self.database, self.account_id)
+        full_sync = sync_state.needs_full_sync(watermark, full_sync_at)
+        # Az skpy teljesen szinkron, ezért a szálkészletben futtatjuk
+        with phase('fetch'):
+            chats = await run_blocking('skype', self._recent_chats, token)
+        self.logger.info(f"Found {len(chats)} chats, processing...")
+        # Csak a most látott chatek tárolt állapotát olvassuk be
+        with phase('persist'):
+            state = {} if full_sync else await storage.run_read(sync_state.load_conversations, self.database, self.account_id, chats.keys())
+        horizon = datetime.utcnow() - timedelta(days=SKYPE_HISTORY_DAYS)
+
+        async def _scan(chat_id, chat):
+            # Az skpy maga küldi a kéréseit; chatenként egy helyet kérünk a keretből
+            await rate_limit.rate_limiter.acquire(self.provider, self.rate_key)
+            # A chatek párhuzamosan, de korlátozott számban futnak (COLLECTOR_LIMIT_SKYPE_CHATS)
+            with tracing.span('chat', chat=chat_id):
+                return await run_blocking('skype_chats', self._scan_chat, chat, state.get(chat_id), horizon)
+
+        chat_items = [(chat_id, chat) for chat_id, chat in chats.items() if hasattr(chat, 'getMsgs')]
+        # A chatek lapozása és számlálása összefonódik (oldalanként), ezért egészében fetch
+        with phase('fetch'):
+            results = await asyncio.gather(*[_scan(chat_id, chat) for chat_id, chat in chat_items], return_exceptions=True)
+        changed = {}
+        for (chat_id, _), result in zip(chat_items, results):
+            if isinstance(result, Exception):
+                self.logger.warning(f"Error processing chat {chat_id}: {str(result)}")
+            elif result is not None:
+                changed[chat_id] = result
+        self.logger.info(f"Scanned {len(chat_items)} chats, {len(changed)} changed")
+
+        with phase('persist'):
+            await storage.run_write(sync_state.save_conversations, self.database, self.account_id, changed, replace=full_sync)
+            await storage.run_write(sync_state.set_watermark, self.database, self.account_id, sync_state.utc_watermark(overlap=0), full_sync)
+            
+            return await storage.run_read(sync_state.aggregate_stats, self.database, self.account_id)
 
 class MessengerService(MessageService):
+    provider = 'graph'
+
+    @property
+    def _fields(self) -> str:
+        # Field expansion: a beszélgetések listája az első üzenetoldalt is hozza, nem kell beszélgetésenként kérés
+        return (f"participants,unread_count,updated_time,message_count,"
+                f"messages.limit({MESSENGER_MESSAGES_PAGE}){{created_time,seen}}")
+
+    async def _changed_conversations(self, graph: GraphClient, since: str = None):
+        # A beszélgetések updated_time szerint csökkenő sorrendben jönnek,
+        # delta módban a vízjelnél régebbi beszélgetésnél megállunk
+        page = await graph.get('me/conversations', fields=self._fields, limit=GRAPH_PAGE_SIZE)
+        stop = (lambda conversation: conversation.get('updated_time', '')[:19] < since[:19]) if since else None
+        return await graph.paginate(page, stop)
+
+    async def _unread_messages(self, graph: GraphClient, conversations):
+        # Az olvasatlan üzenetek a legújabbak; csak ott lapozunk tovább, ahol a beágyazott oldal nem fedi le őket.
+        # Körönként minden ilyen beszélgetés következő oldala egy batch kérésben megy.
+        messages, next_urls, errors = {}, {}, {}
+        for conversation in conversations:
+            embedded = conversation.get('messages', {})
+            messages[conversation['id']] = list(embedded.get('data', []))
+            next_urls[conversation['id']] = embedded.get('paging', {}).get('next')
+        for _ in range(GRAPH_MAX_PAGES):
+            needed = [
+                conversation['id'] for conversation in conversations
+                if next_urls[conversation['id']]
+                and conversation.get('unread_count', 0) > len(messages[conversation['id']])
+            ]
+            if not needed:
+                return messages, errors
+            results = await graph.batch([relative_url(next_urls[conv_id]) for conv_id in needed])
+            for conv_id, result in zip(needed, results):
+                if isinstance(result, Exception):
+                    errors[conv_id] = result
+                    next_urls[conv_id] = None
+                    continue
+                messages[conv_id].extend(result.get('data', []))
+                next_urls[conv_id] = result.get('paging', {}).get('next')
+        return messages, errors
+
     async def get_stats(self):
         try:
-            print(f"Connecting to Facebook Graph API...")
-            graph = GraphAPI(access_token=self.credentials['access_token'])
+            self.logger.info("Connecting to Facebook Graph API...")
+            
+            with phase('persist'):
+                watermark, full_sync_at = await storage.run_read(sync_state.get_watermark, self.database, self.account_id)
+            full_sync = sync_state.needs_full_sync(watermark, full_sync_at)
+            sweep_started = datetime.utcnow()
             
-            total_messages = 0
-            unread_messages = 0
-            oldest_unread_date = None
+            # Lekérjük az összes (delta módban csak a módosult) beszélgetést
+            self.logger.info("Fetching conversations..." if full_sync else f"Fetching conversations updated since {watermark}...")
+            with phase('fetch'):
+                graph = GraphClient(self.http, self.credentials['access_token'], self.rate_key)
+                conversations = await self._changed_conversations(graph, None if full_sync else watermark)
+                self.logger.info(f"Found {len(conversations)} conversations")
+                
+                conversation_messages, errors = await self._unread_messages(graph, conversations)
+            self.logger.info(f"Messenger used {graph.requests} Graph requests for {len(conversations)} conversations")
             
-            # Lekérjük az összes beszélgetést
-            print("Fetching conversations...")
-            conversations = graph.get_object('me/conversations', fields='participants,unread_count,updated_time')
-            print(f"Found {len(conversations['data'])} conversations")
+            changed = {}
+            failed = []
             
-            for conversation in conversations['data']:
-                try:
-                    conv_id = conversation['id']
-                    print(f"Processing conversation: {conv_id}")
+            with phase('parse'):
+                for conversation in conversations:
+                    try:
+                        conv_id = conversation['id']
+                        if conv_id in errors:
+                            raise errors[conv_id]
+                        messages = conversation_messages[conv_id]
                     
-                    # Lekérjük a beszélgetés üzeneteit
-                    messages = graph.get_object(f"{conv_id}/messages", fields='created_time,seen')
-                    messages_count = len(messages['data'])
-                    total_messages += messages_count
-                    print(f"Found {messages_count} messages in conversation")
+                        messages_count = conversation.get('message_count', len(messages))
+                        self.logger.debug(f"Conversation {conv_id}: {messages_count} messages", extra=SAMPLED)
                     
-                    # Olvasatlan üzenetek számolása
-                    unread_count = conversation.get('unread_count', 0)
-                    unread_messages += unread_count
+                        # Olvasatlan üzenetek számolása
+                        unread_count = conversation.get('unread_count', 0)
                     
-                    # Utolsó olvasatlan üzenet dátuma
-                    if unread_count > 0:
-                        for message in messages['data']:
-                            if not message.get('seen', False):
-                                created_time = message.get('created_time')
-                                if created_time:
-                                    if oldest_unread_date is None or created_time < oldest_unread_date:
-                                        oldest_unread_date = created_time
+                        # Utolsó olvasatlan üzenet dátuma
+                        oldest_unread_date = None
+                        if unread_count > 0:
+                            for message in messages:
+                                if not message.get('seen', False):
+                                    created_time = message.get('created_time')
+                                    if created_time:
+                                        if oldest_unread_date is None or created_time < oldest_unread_date:
+                                            oldest_unread_date = created_time
                     
-                except Exception as conv_error:
-                    print(f"Error processing conversation {conv_id}: {str(conv_error)}")
-                    continue
+                        changed[conv_id] = {
+                            'message_count': messages_count,
+                            'unread_count': unread_count,
+                            'oldest_unread': oldest_unread_date,
+                            'cursor': conversation.get('updated_time'),
+                            'modified_at': conversation.get('updated_time'),
+                        }
+                    
+                    except Exception as conv_error:
+                        self.logger.warning(f"Error processing conversation {conv_id}: {str(conv_error)}")
+                        failed.append(conv_id)
+                        continue
             
-            print(f"Final stats - Total messages: {total_messages}, Unread: {unread_messages}, Oldest unread: {oldest_unread_date}")
+            with phase('persist'):
+                # Hibás beszélgetésnél a tárolt állapota megmarad (nincs replace), és a vízjel sem lép előre,
+                # így a következő kör újra lekéri
+                await storage.run_write(sync_state.save_conversations, self.database, self.account_id, changed,
+                                        replace=full_sync and not failed)
+                if failed:
+                    self.logger.warning(f"{len(failed)} conversations failed, keeping the watermark so they are fetched again")
+                else:
+                    await storage.run_write(sync_state.set_watermark, self.database, self.account_id, sync_state.utc_watermark(sweep_started), full_sync)
+            
+                total_messages, unread_messages, oldest_unread_date = await storage.run_read(sync_state.aggregate_stats, self.database, self.account_id)
+            self.logger.info(f"Final stats - Total messages: {total_messages}, Unread: {unread_messages}, Oldest unread: {oldest_unread_date}")
             self.save_stats(total_messages, unread_messages, oldest_unread_date)
             
         except Exception as e:
-            print(f"Error getting Messenger stats: {str(e)}")
-            print(f"Error type: {type(e)}")
-            print(f"Full traceback: {traceback.format_exc()}")
-            # Hiba esetén nullázzuk az értékeket
-            self.save_stats(0, 0, None)
+            self.logger.error(f"Error getting Messenger stats ({type(e).__name__}): {str(e)}")
+            self.logger.error(f"Full traceback: {traceback.format_exc()}")
+            # Hiba esetén nem nullázunk: az utolsó sikeres értékek maradnak, a hibát a job rögzíti
+            raise
 
 class HelpScoutService(MessageService):
-    def __init__(self, account_id: int, credentials: dict):
-        super().__init__(account_id, credentials)
+    provider = 'helpscout'
+
+    def __init__(self, account_id: int, credentials: dict, http: aiohttp.ClientSession = None):
+        super().__init__(account_id, credentials, http)
         self.client_id = credentials.get('client_id')
         self.client_secret = credentials.get('client_secret')
-        self.logger = logging.getLogger('helpscout')
-        self.logger.setLevel(logging.DEBUG)
+
+    @property
+    def token_key(self) -> str:
+        return f"helpscout:{self.account_id}"
+
+    async def _fetch_token(self):
+        # OAuth token beszerzése
+        token_url = f"{HELPSCOUT_API_URL}/oauth2/token"
+        
+        auth_str = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode()
+        token_headers = {
+            'Authorization': f'Basic {auth_str}',
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
+        token_data = {
+            'grant_type': 'client_credentials'
+        }
+        
+        token_response = await self._request('POST', token_url, headers=token_headers, data=token_data)
+        self.logger.debug(f"Token response status: {token_response.status}")
+        
+        if token_response.status != 200:
+            self.logger.error(f"Failed to get token: {token_response.status}")
+            raise Exception("Nem sikerült a token beszerzése")
+        
+        token_json = token_response.json() or {}
+        
+        access_token = token_json.get('access_token')
+        if not access_token:
+            self.logger.error("No access token in response")
+            raise Exception("Hiányzó access token")
+        
+        return access_token, time.time() + int(token_json.get('expires_in', 7200))
+
+    async def _get_conversations(self, access_token: str, params: dict):
+        # API hívások fejléce
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+        
+        # Az összes oldalt lekérjük, nem csak az elsőt
+        try:
+            pages = await fetch_all_pages(
+                self.http,
+                f"{HELPSCOUT_API_URL}/conversations",
+                headers,
+                params,
+                self.provider,
+                self.rate_key
+            )
+        except PageFetchError as e:
+            if e.status == 401:
+                return None
+            self.logger.error(f"Failed to get conversations: {e.status}")
+            raise Exception("Nem sikerült a beszélgetések lekérése")
+        
+        total_active = pages[0].get('page', {}).get('totalElements', 0)
+        conversations = [
+            conv
+            for page in pages
+            for conv in page.get('_embedded', {}).get('conversations', [])
+        ]
+        return total_active, conversations
     
     async def get_stats(self):
         try:
@@ -241,102 +515,89 @@ class HelpScoutService(MessageService):
                 self.logger.error("Missing client_id or client_secret!")
                 raise Exception("HelpScout bejelentkezési adatok hiányoznak")
             
-            # OAuth token beszerzése
-            token_url = 'https://api.helpscout.net/v2/oauth2/token'
-            
-            auth_str = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode()
-            token_headers = {
-                'Authorization': f'Basic {auth_str}',
-                'Content-Type': 'application/x-www-form-urlencoded'
-            }
-            token_data = {
-                'grant_type': 'client_credentials'
-            }
-            
-            # Szinkron kérés a token beszerzéséhez
-            token_response = requests.post(token_url, headers=token_headers, data=token_data)
-            self.logger.debug(f"Token response status: {token_response.status_code}")
-            
-            if token_response.status_code != 200:
-                self.logger.error(f"Failed to get token: {token_response.status_code}")
-                raise Exception("Nem sikerült a token beszerzése")
+            with phase('auth'):
+                access_token = await token_cache.get(self.token_key, self._fetch_token)
             
-            access_token = token_response.json().get('access_token')
+            with phase('persist'):
+                watermark, full_sync_at = await storage.run_read(sync_state.get_watermark, self.database, self.account_id)
+            full_sync = sync_state.needs_full_sync(watermark, full_sync_at)
+            sweep_started = datetime.utcnow()
+            if full_sync:
+                # Teljes újraolvasás: minden aktív beszélgetés
+                self.logger.info("Fetching active conversations (full sync)...")
+                params = {'status': 'active', 'embed': 'threads', 'pageSize': 50}
+            else:
+                # Delta: csak a vízjel óta módosult beszélgetések, státusztól függetlenül,
+                # hogy a lezárt beszélgetéseket is kivehessük
+                self.logger.info(f"Fetching conversations modified since {watermark}...")
+                params = {'status': 'all', 'modifiedSince': watermark, 'embed': 'threads', 'pageSize': 50}
             
-            if not access_token:
-                self.logger.error("No access token in response")
-                raise Exception("Hiányzó access token")
+            with phase('fetch'):
+                result = await self._get_conversations(access_token, params)
+            if result is None:
+                # A tárolt token időközben érvénytelenné vált, egyszer újrapróbáljuk friss tokennel
+                self.logger.info("Access token rejected, fetching a new one")
+                await token_cache.invalidate(self.token_key)
+                with phase('auth'):
+                    access_token = await token_cache.get(self.token_key, self._fetch_token)
+                with phase('fetch'):
+                    result = await self._get_conversations(access_token, params)
+                if result is None:
+                    raise Exception("Nem sikerült a beszélgetések lekérése")
             
-            # API hívások fejléce
-            headers = {
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json"
-            }
-            
-            # Aktív beszélgetések lekérése szinkron módon
-            self.logger.info("Fetching active conversations...")
-            active_conversations = requests.get(
-                'https://api.helpscout.net/v2/conversations',
-                headers=headers,
-                params={
-                    'status': 'active',
-                    'embed': 'threads',
-                    'pageSize': 50
-                }
-            )
+            total_found, conversations = result
             
-            if active_conversations.status_code != 200:
-                self.logger.error(f"Failed to get conversations: {active_conversations.status_code}")
-                raise Exception("Nem sikerült a beszélgetések lekérése")
+            self.logger.info(f"Found {total_found} {'active' if full_sync else 'modified'} conversations")
             
-            active_data = active_conversations.json()
-            total_active = active_data.get('page', {}).get('totalElements', 0)
-            conversations = active_data.get('_embedded', {}).get('conversations', [])
+            changed = {}
+            removed = []
             
-            self.logger.info(f"Found {total_active} active conversations")
-            
-            total_messages = 0
-            unread_count = 0
-            oldest_unread = None
-            
-            # Beszélgetések feldolgozása
-            for conv in conversations:
-                conv_id = conv.get('id')
-                threads = conv.get('_embedded', {}).get('threads', [])
-                total_messages += len(threads)
-                is_unread = False
+            with phase('parse'):
+                # Beszélgetések feldolgozása
+                for conv in conversations:
+                    conv_id = str(conv.get('id'))
+                    if conv.get('status') != 'active':
+                        removed.append(conv_id)
+                        continue
                 
-                # Thread-ek ellenőrzése
-                for thread in threads:
-                    if not thread.get('seenByAgent', False):
-                        is_unread = True
-                        if oldest_unread is None or thread.get('createdAt', '') < oldest_unread.get('createdAt', ''):
-                            oldest_unread = thread
+                    threads = conv.get('_embedded', {}).get('threads', [])
+                    is_unread = False
+                    oldest_unread = None
                 
-                if is_unread:
-                    unread_count += 1
+                    # Thread-ek ellenőrzése
+                    for thread in threads:
+                        if not thread.get('seenByAgent', False):
+                            is_unread = True
+                            created_at = thread.get('createdAt')
+                            if created_at and (oldest_unread is None or created_at < oldest_unread):
+                                oldest_unread = created_at
                 
-                self.logger.debug(f"Conversation {conv_id}:")
-                self.logger.debug(f"Status: {conv.get('status')}")
-                self.logger.debug(f"Unread: {'Yes' if is_unread else 'No'}")
-                self.logger.debug(f"Created at: {conv.get('createdAt')}")
-                self.logger.debug(f"Modified at: {conv.get('modifiedAt')}")
-                self.logger.debug(f"Thread count: {len(threads)}")
+                    changed[conv_id] = {
+                        'message_count': len(threads),
+                        'unread_count': 1 if is_unread else 0,
+                        'oldest_unread': oldest_unread,
+                        'cursor': conv.get('modifiedAt'),
+                        'modified_at': conv.get('modifiedAt'),
+                    }
+                
+                    self.logger.debug(f"Conversation {conv_id}: status {conv.get('status')}, unread: {is_unread}, "
+                                      f"{len(threads)} threads, modified at {conv.get('modifiedAt')}", extra=SAMPLED)
+            
+            with phase('persist'):
+                await storage.run_write(sync_state.save_conversations, self.database, self.account_id, changed, removed, replace=full_sync)
+                await storage.run_write(sync_state.set_watermark, self.database, self.account_id, sync_state.utc_watermark(sweep_started), full_sync)
             
-            self.logger.info(f"Total messages: {total_messages}")
-            self.logger.info(f"Unread messages: {unread_count}")
+                total_messages, unread_count, oldest_unread_date = await storage.run_read(sync_state.aggregate_stats, self.database, self.account_id)
             
-            oldest_unread_date = oldest_unread.get('createdAt') if oldest_unread else None
-            self.logger.info(f"Oldest unread date: {oldest_unread_date}")
+            self.logger.info(f"Total messages: {total_messages}, Unread: {unread_count}, Oldest unread: {oldest_unread_date}")
             
             # Mentjük a statisztikákat
             self.save_stats(total_messages, unread_count, oldest_unread_date)
             
         except Exception as e:
-            self.logger.error(f"Error in HelpScout get_stats: {str(e)}")
-            self.logger.error(f"Error type: {type(e)}")
-            print(f"Full traceback: {traceback.format_exc()}")
-            self.save_stats(0, 0, None)
+            self.logger.error(f"Error in HelpScout get_stats ({type(e).__name__}): {str(e)}")
+            self.logger.error(f"Full traceback: {traceback.format_exc()}")
+            raise
 
 def get_service_class(account_type: str):
     service_classes = {
@@ -347,43 +608,66 @@ def get_service_class(account_type: str):
     }
     return service_classes.get(account_type)
 
+def load_active_accounts():
+    # Aktív fiókok a legutolsó frissítés idejével együtt
+    with storage.reading(get_database_url()) as conn:
+        return conn.execute("""
+            SELECT a.id, a.account_type, a.credentials, a.refresh_interval, s.last_updated
+            FROM accounts a
+            LEFT JOIN account_stats s ON s.account_id = a.id
+            WHERE a.is_active = TRUE
+        """).fetchall()
+
+async def refresh_account(account_id: int, account_type: str, credentials_str: str):
+    logger.info(f"Processing account: {account_id}, type: {account_type}")
+    ServiceClass = get_service_class(account_type)
+    if not ServiceClass:
+        logger.error(f"No service class found for account type: {account_type}")
+        return
+    # Hibás fióknál nem próbálkozunk minden körben, nem fogy a kör ideje és a szolgáltatói keret
+    circuit_breakers.allow(account_id)
+    credentials = json.loads(credentials_str)
+    service = ServiceClass(account_id, credentials, http_client.get_session())
+    timeout = collector_timeout(ServiceClass.provider)
+    try:
+        # Egy lassú fiók ne tartsa fel a kör többi részét; a fázisidők a /metrics-be kerülnek
+        with tracing.span('account', account_id=account_id, provider=account_type.lower()), \
+                metrics.collect(account_type.lower(), account_id):
+            await asyncio.wait_for(service.get_stats(), timeout=timeout)
+    except asyncio.TimeoutError:
+        error = f"Refresh timed out after {timeout:g}s"
+        await circuit_breakers.record_failure(account_id, error)
+        _health_changed()
+        raise Exception(error)
+    except Exception as e:
+        await circuit_breakers.record_failure(account_id, str(e) or type(e).__name__)
+        _health_changed()
+        raise
+    if await circuit_breakers.record_success(account_id):
+        _health_changed()
+
+def _health_changed():
+    # A /stats stale jelzése az account_health táblából jön
+    stats_cache.invalidate()
+    broadcaster.notify()
+
 async def update_account_stats():
     try:
-        if os.environ.get('RENDER'):
-            db_dir = '/opt/render/project/src'
-        else:
-            db_dir = os.path.dirname(__file__)
-        db_path = os.path.join(db_dir, 'messages.db')
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute("SELECT id, account_type, credentials FROM accounts WHERE is_active = TRUE")
-        accounts = c.fetchall()
-        conn.close()
+        accounts = await storage.run_read(load_active_accounts)
 
         services = []
-        for account_id, account_type, credentials_str in accounts:
-            try:
-                logging.info(f"Processing account: {account_id}, type: {account_type}")
-                logging.debug(f"Raw credentials string: {credentials_str}")
-                
-                ServiceClass = get_service_class(account_type)
-                if ServiceClass:
-                    credentials = json.loads(credentials_str)
-                    logging.debug(f"Parsed credentials: {credentials}")
-                    
-                    service = ServiceClass(account_id, credentials)
-                    services.append(service.get_stats())
-                else:
-                    logging.error(f"No service class found for account type: {account_type}")
-            except Exception as e:
-                logging.error(f"Error processing account {account_id}: {str(e)}")
-                logging.error(f"Traceback: {traceback.format_exc()}")
-                continue
+        for account_id, account_type, credentials_str, _, _ in accounts:
+            services.append(refresh_account(account_id, account_type, credentials_str))
 
         if services:
-            await asyncio.gather(*services)
+            # Lassú kör esetén a span fa megmarad (/debug/traces)
+            with tracing.sweep('manual', get_database_url(), accounts=len(accounts)):
+                results = await asyncio.gather(*services, return_exceptions=True)
+            for (account_id, _, _, _, _), result in zip(accounts, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Error processing account {account_id}: {str(result)}")
         else:
-            logging.warning("No services to process")
+            logger.warning("No services to process")
     except Exception as e:
-        logging.error(f"Error in update_account_stats: {str(e)}")
-        logging.error(f"Traceback: {traceback.format_exc()}") 
\ No newline at end of file
+        logger.error(f"Error in update_account_stats: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
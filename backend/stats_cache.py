@@ -0,0 +1,168 @@
+import os
+import gzip
+import hashlib
+import json
+import threading
+import time
+import storage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Más workerek írásait legkésőbb ennyi idő után vesszük észre (a saját írásainkat azonnal)
+STATS_CACHE_TTL_SECONDS = float(os.environ.get('STATS_CACHE_TTL_SECONDS', '2'))
+# Ennél kisebb választ nem érdemes tömöríteni
+STATS_COMPRESS_MIN_BYTES = int(os.environ.get('STATS_COMPRESS_MIN_BYTES', '500'))
+
+
+def load_stats_version(database: str):
+    with storage.reading(database) as conn:
+        # A fiókok hibaállapota (stale) is a válasz része, ezért annak változása is új verzió
+        return tuple(conn.execute("""
+            SELECT
+                (SELECT COUNT(*) FROM account_stats),
+                (SELECT MAX(last_updated) FROM account_stats),
+                (SELECT COUNT(*) FROM account_health),
+                (SELECT MAX(updated_at) FROM account_health)
+        """).fetchone())
+
+
+def load_stats_rows(database: str) -> dict:
+    with storage.reading(database) as conn:
+        rows = conn.execute("""
+            SELECT
+                s.account_id,
+                a.account_name,
+                a.account_type,
+                s.total_messages,
+                s.unread_messages,
+                s.last_unread_date,
+                s.last_updated,
+                h.state,
+                h.last_error
+            FROM account_stats s
+            JOIN accounts a ON s.account_id = a.id
+            LEFT JOIN account_health h ON h.account_id = s.account_id
+            WHERE a.is_active = TRUE
+        """).fetchall()
+        return {
+            row[0]: {
+                "account_id": row[0],
+                "account_name": row[1],
+                "account_type": row[2],
+                "total_messages": row[3],
+                "unread_messages": row[4],
+                "last_unread_date": row[5],
+                "last_updated": row[6],
+                # Hibás frissítés után az utolsó jó értékeket mutatjuk, nem nullát
+                "stale": row[7] is not None,
+                "circuit": row[7] or 'closed',
+                "last_error": row[8],
+            } for row in rows
+        }
+
+
+def accepted_encodings(header: str) -> set:
+    # "gzip, deflate, br;q=0.9" -> {'gzip', 'deflate', 'br'}; q=0 kizárja a kódolást
+    result = set()
+    for part in (header or '').split(','):
+        name, *params = part.strip().split(';')
+        if not name:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            result.add(name.strip().lower())
+    return result
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # Gyenge összehasonlítás: a tömörített változatok ugyanarra a tartalomra mutatnak
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    base = etag.strip('"')
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        candidate = candidate.strip('"')
+        if candidate.split('-', 1)[0] == base:
+            return True
+    return False
+
+
+class StatsSnapshot:
+    def __init__(self, version, rows: list):
+        self.version = version
+        self.body = json.dumps(rows, separators=(',', ':')).encode('utf-8')
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+        self.checked_at = time.monotonic()
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    def encode(self, accept_encoding: str):
+        # (tartalom, Content-Encoding vagy None, ETag); a tömörített változatot egyszer állítjuk elő
+        if len(self.body) < STATS_COMPRESS_MIN_BYTES:
+            return self.body, None, self.etag
+        accepted = accepted_encodings(accept_encoding)
+        if brotli is not None and 'br' in accepted:
+            encoding = 'br'
+        elif 'gzip' in accepted:
+            encoding = 'gzip'
+        else:
+            return self.body, None, self.etag
+        with self._lock:
+            body = self._encoded.get(encoding)
+            if body is None:
+                if encoding == 'br':
+                    body = brotli.compress(self.body)
+                else:
+                    body = gzip.compress(self.body, mtime=0)
+                self._encoded[encoding] = body
+        # Erős ETag reprezentációnként, ezért a tömörített változat saját utótagot kap
+        return body, encoding, self.etag[:-1] + '-' + encoding + '"'
+
+
+class StatsCache:
+    def __init__(self, ttl: float = STATS_CACHE_TTL_SECONDS):
+        self.database = None
+        self.ttl = ttl
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._snapshot = None
+
+    def fresh(self):
+        # Gyors út adatbázis nélkül; None, ha újra kell ellenőrizni
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - snapshot.checked_at < self.ttl:
+            return snapshot
+        return None
+
+    def get(self) -> StatsSnapshot:
+        # Blokkoló hívás (SQLite), a hívó run_blocking-gal futtatja
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and time.monotonic() - snapshot.checked_at < self.ttl:
+                return snapshot
+            version = load_stats_version(self.database)
+            if snapshot is not None and snapshot.version == version:
+                snapshot.checked_at = time.monotonic()
+                return snapshot
+            snapshot = StatsSnapshot(version, list(load_stats_rows(self.database).values()))
+            self._snapshot = snapshot
+            return snapshot
+
+
+stats_cache = StatsCache()
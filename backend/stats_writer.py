@@ -0,0 +1,123 @@
+import os
+import asyncio
+import logging
+import threading
+import time
+import traceback
+from datetime import datetime
+import storage
+import retention
+from stats_cache import stats_cache
+from broadcaster import broadcaster
+
+logger = logging.getLogger('stats_writer')
+
+# A frissítési kör végén mindig írunk; ez csak a felső korlát a hosszú körök alatt
+STATS_FLUSH_INTERVAL_MS = int(os.environ.get('STATS_FLUSH_INTERVAL_MS', '5000'))
+# Ennyi várakozó eredménynél nem várjuk meg az időzítőt
+STATS_FLUSH_MAX_BATCH = int(os.environ.get('STATS_FLUSH_MAX_BATCH', '500'))
+
+
+def upsert_stats(conn, batch):
+    # batch: (account_id, total_messages, unread_messages, last_unread_date, last_updated, ts) sorok
+    conn.executemany('''
+        INSERT INTO account_stats
+        (account_id, total_messages, unread_messages, last_unread_date, last_updated)
+        VALUES (:account_id, :total_messages, :unread_messages, :last_unread_date, :last_updated)
+        ON CONFLICT (account_id) DO UPDATE SET
+            total_messages = excluded.total_messages,
+            unread_messages = excluded.unread_messages,
+            last_unread_date = excluded.last_unread_date,
+            last_updated = excluded.last_updated
+    ''', [
+        {'account_id': row[0], 'total_messages': row[1], 'unread_messages': row[2],
+         'last_unread_date': row[3], 'last_updated': row[4]}
+        for row in batch
+    ])
+
+
+def write_results(database: str, batch):
+    # Egy tranzakció, egy fsync az egész körre
+    with storage.writing(database) as conn:
+        upsert_stats(conn, batch)
+        retention.record_points(conn, [(row[0], row[1], row[2], row[5]) for row in batch])
+        # A lekérdezett érték már tartalmazza a webhookból számolt olvasatlanokat, azokat nem vonjuk le újra
+        conn.executemany("DELETE FROM webhook_unread WHERE account_id = :account_id",
+                         [{'account_id': row[0]} for row in batch])
+
+
+class StatsWriter:
+    def __init__(self, interval_ms: int = STATS_FLUSH_INTERVAL_MS, max_batch: int = STATS_FLUSH_MAX_BATCH):
+        self.database = None
+        self.interval = interval_ms / 1000
+        self.max_batch = max_batch
+        self._pending = []
+        self._lock = threading.Lock()
+        self._task = None
+        self._loop = None
+        self._wakeup = None
+        self._flush_lock = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Stats writer started (flush interval: {self.interval}s, max batch: {self.max_batch})")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # A még várakozó eredményeket leállás előtt kiírjuk
+        await self.flush()
+
+    def submit(self, account_id: int, total_messages: int, unread_messages: int, last_unread_date: str):
+        row = (account_id, total_messages, unread_messages, last_unread_date, datetime.now().isoformat(), time.time())
+        if self._task is None:
+            # Nincs futó író (pl. önálló szkript): azonnal, szinkron írunk
+            write_results(self.database, [row])
+            stats_cache.invalidate()
+            broadcaster.notify()
+            return
+        with self._lock:
+            self._pending.append(row)
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def flush(self) -> int:
+        if self._flush_lock is None:
+            return 0
+        async with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                await storage.run_write(write_results, self.database, batch)
+            except Exception as e:
+                # Nem dobjuk el az eredményeket, a következő flush újra próbálja
+                with self._lock:
+                    self._pending[:0] = batch
+                logger.error(f"Stats flush failed ({len(batch)} results): {str(e)}")
+                logger.error(f"Full traceback: {traceback.format_exc()}")
+                return 0
+            stats_cache.invalidate()
+            broadcaster.notify()
+            logger.debug(f"Flushed {len(batch)} stats results in one transaction")
+            return len(batch)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+
+stats_writer = StatsWriter()
@@ -0,0 +1,100 @@
+import os
+import logging
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from sqlalchemy import create_engine, text
+from storage import Storage, describe
+import metrics
+
+logger = logging.getLogger('storage')
+
+# Kapcsolatok workerenként; több API példánynál a PostgreSQL max_connections-t is figyelembe kell venni
+STORAGE_PG_POOL_SIZE = int(os.environ.get('STORAGE_PG_POOL_SIZE', '10'))
+STORAGE_PG_MAX_OVERFLOW = int(os.environ.get('STORAGE_PG_MAX_OVERFLOW', '5'))
+STORAGE_PG_POOL_TIMEOUT = float(os.environ.get('STORAGE_PG_POOL_TIMEOUT', '30'))
+# Ennyi idő után a kapcsolatot újranyitjuk (a load balancer/proxy bontja a régieket)
+STORAGE_PG_POOL_RECYCLE = int(os.environ.get('STORAGE_PG_POOL_RECYCLE', '1800'))
+
+
+@lru_cache(maxsize=512)
+def _statement(sql: str):
+    # A text() konstrukciót SQL szövegenként egyszer építjük fel, így a lefordított alak is gyorsítótárban marad
+    return text(sql)
+
+
+class PostgresConnection:
+    def __init__(self, raw, storage):
+        self.raw = raw
+        self.storage = storage
+
+    def execute(self, sql: str, params=None):
+        started = time.perf_counter()
+        try:
+            return self.raw.execute(_statement(sql), params or {})
+        finally:
+            metrics.observe_query('postgresql', sql, time.perf_counter() - started)
+
+    def executemany(self, sql: str, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        if not seq_of_params:
+            return None
+        started = time.perf_counter()
+        try:
+            return self.raw.execute(_statement(sql), seq_of_params)
+        finally:
+            metrics.observe_query('postgresql', sql, time.perf_counter() - started)
+
+    def insert_id(self, sql: str, params=None) -> int:
+        return self.execute(sql + " RETURNING id", params).scalar_one()
+
+    def lock(self, name: str):
+        # Tranzakció végéig tartó zár; több API példány közül egyszerre csak egy futtatja a blokkot
+        self.raw.execute(_statement("SELECT pg_advisory_xact_lock(hashtext(:name))"), {'name': name})
+
+    @contextmanager
+    def savepoint(self, name: str):
+        # Beágyazott tranzakció (SAVEPOINT); a nevet az SQLAlchemy adja
+        with self.raw.begin_nested():
+            yield
+
+    def column_names(self, table: str):
+        rows = self.raw.execute(_statement(
+            "SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = :table"
+        ), {'table': table}).fetchall()
+        return [row[0] for row in rows]
+
+
+class PostgresStorage(Storage):
+    dialect = 'postgresql'
+
+    def __init__(self, url: str):
+        super().__init__(url)
+        # values_plus_batch: az executemany oldalanként egy körút, nem soronként
+        self.engine = create_engine(
+            url,
+            future=True,
+            pool_size=STORAGE_PG_POOL_SIZE,
+            max_overflow=STORAGE_PG_MAX_OVERFLOW,
+            pool_timeout=STORAGE_PG_POOL_TIMEOUT,
+            pool_recycle=STORAGE_PG_POOL_RECYCLE,
+            pool_pre_ping=True,
+            executemany_mode='values_plus_batch',
+        )
+        logger.info(f"PostgreSQL storage at {describe(url)} (pool: {STORAGE_PG_POOL_SIZE}+{STORAGE_PG_MAX_OVERFLOW})")
+
+    @contextmanager
+    def reading(self):
+        with self.engine.connect() as conn:
+            try:
+                yield PostgresConnection(conn, self)
+            finally:
+                conn.rollback()
+
+    @contextmanager
+    def writing(self):
+        with self.engine.begin() as conn:
+            yield PostgresConnection(conn, self)
+
+    def close(self):
+        self.engine.dispose()
@@ -0,0 +1,168 @@
+import os
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from storage import Storage
+import metrics
+
+logger = logging.getLogger('storage')
+
+# Olvasó kapcsolatok száma adatbázisonként; írásra egyetlen külön kapcsolat van
+STORAGE_POOL_SIZE = int(os.environ.get('STORAGE_POOL_SIZE', '8'))
+# Ennyit várunk egy másik folyamat (worker) írási zárára, mielőtt "database is locked" hibát kapnánk
+STORAGE_BUSY_TIMEOUT_MS = int(os.environ.get('STORAGE_BUSY_TIMEOUT_MS', '5000'))
+STORAGE_CACHE_SIZE_KB = int(os.environ.get('STORAGE_CACHE_SIZE_KB', '16384'))
+STORAGE_MMAP_SIZE = int(os.environ.get('STORAGE_MMAP_SIZE', str(256 * 1024 * 1024)))
+# Kapcsolatonként ennyi előkészített utasítást tart meg az sqlite3 modul
+STORAGE_STATEMENT_CACHE = int(os.environ.get('STORAGE_STATEMENT_CACHE', '256'))
+# WAL módban a NORMAL biztonságos: áramszünetnél legfeljebb az utolsó tranzakció veszhet el
+STORAGE_SYNCHRONOUS = os.environ.get('STORAGE_SYNCHRONOUS', 'NORMAL')
+
+
+class SQLiteConnection:
+    def __init__(self, raw: sqlite3.Connection, storage):
+        self.raw = raw
+        self.storage = storage
+
+    def execute(self, sql: str, params=None):
+        started = time.perf_counter()
+        try:
+            return self.raw.execute(sql, params or ())
+        finally:
+            metrics.observe_query('sqlite', sql, time.perf_counter() - started)
+
+    def executemany(self, sql: str, seq_of_params):
+        started = time.perf_counter()
+        try:
+            return self.raw.executemany(sql, seq_of_params)
+        finally:
+            metrics.observe_query('sqlite', sql, time.perf_counter() - started)
+
+    def insert_id(self, sql: str, params=None) -> int:
+        return self.execute(sql, params).lastrowid
+
+    def lock(self, name: str):
+        # A BEGIN IMMEDIATE már kizárólagos írási zárat ad
+        pass
+
+    @contextmanager
+    def savepoint(self, name: str):
+        # Beágyazott tranzakció: hibánál csak a blokk változásai vesznek el, a külső tranzakció folytatódik
+        self.raw.execute(f"SAVEPOINT {name}")
+        try:
+            yield
+        except BaseException:
+            self.raw.execute(f"ROLLBACK TO SAVEPOINT {name}")
+            self.raw.execute(f"RELEASE SAVEPOINT {name}")
+            raise
+        self.raw.execute(f"RELEASE SAVEPOINT {name}")
+
+    def column_names(self, table: str):
+        return [col[1] for col in self.raw.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+class SQLiteStorage(Storage):
+    dialect = 'sqlite'
+
+    def __init__(self, url: str, size: int = STORAGE_POOL_SIZE):
+        super().__init__(url)
+        self.db_path = url[len('sqlite:///'):]
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._writer = None
+        self._write_lock = threading.Lock()
+        logger.info(f"SQLite storage at {self.db_path} ({size} readers, WAL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: a tranzakciókat mi nyitjuk (BEGIN IMMEDIATE), nem az sqlite3 modul
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=STORAGE_BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=STORAGE_STATEMENT_CACHE,
+        )
+        # WAL: az olvasók nem várnak az íróra és fordítva; a beállítás az adatbázis fájlban megmarad
+        mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if mode.lower() != 'wal':
+            logger.warning(f"Could not enable WAL for {self.db_path}, journal mode: {mode}")
+        conn.execute(f"PRAGMA synchronous={STORAGE_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size=-{STORAGE_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={STORAGE_MMAP_SIZE}")
+        conn.execute(f"PRAGMA busy_timeout={STORAGE_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    @contextmanager
+    def reading(self):
+        conn = self._acquire()
+        try:
+            yield SQLiteConnection(conn, self)
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    @contextmanager
+    def writing(self):
+        # Folyamaton belül egy író; a workerek között a busy_timeout sorosít
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            conn = self._writer
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield SQLiteConnection(conn, self)
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    # Az SQLite-ban nincs FLOOR/LEAST/GREATEST (a math kiterjesztés nem mindig van befordítva);
+    # az időbélyegek pozitívak, így a CAST csonkolása megegyezik a FLOOR-ral
+    def floor(self, expr: str) -> str:
+        return f"CAST({expr} AS INTEGER)"
+
+    def least(self, a: str, b: str) -> str:
+        return f"MIN({a}, {b})"
+
+    def greatest(self, a: str, b: str) -> str:
+        return f"MAX({a}, {b})"
@@ -0,0 +1,140 @@
+import os
+from datetime import datetime, timedelta
+import storage
+
+# Ennyi időnként a delta helyett teljes újraolvasás, hogy a törölt/elcsúszott adatok is rendbe jöjjenek
+FULL_SYNC_INTERVAL = int(os.environ.get('FULL_SYNC_INTERVAL_SECONDS', str(6 * 3600)))
+# A vízjelet ennyivel visszább vesszük, hogy az órák eltérése miatt ne maradjon ki módosítás
+WATERMARK_OVERLAP = int(os.environ.get('WATERMARK_OVERLAP_SECONDS', '60'))
+
+
+def get_watermark(database: str, account_id: int):
+    with storage.reading(database) as conn:
+        row = conn.execute(
+            "SELECT watermark, full_sync_at FROM sync_watermarks WHERE account_id = :account_id",
+            {'account_id': account_id}
+        ).fetchone()
+        return tuple(row) if row else (None, None)
+
+
+def needs_full_sync(watermark, full_sync_at) -> bool:
+    if not watermark or not full_sync_at:
+        return True
+    try:
+        last_full = datetime.fromisoformat(full_sync_at)
+    except ValueError:
+        return True
+    return (datetime.now() - last_full).total_seconds() >= FULL_SYNC_INTERVAL
+
+
+def set_watermark(database: str, account_id: int, watermark: str, full_sync: bool = False):
+    now = datetime.now().isoformat()
+    params = {'account_id': account_id, 'watermark': watermark, 'now': now}
+    with storage.writing(database) as conn:
+        if full_sync:
+            conn.execute('''
+                INSERT INTO sync_watermarks (account_id, watermark, full_sync_at, updated_at)
+                VALUES (:account_id, :watermark, :now, :now)
+                ON CONFLICT (account_id) DO UPDATE SET
+                    watermark = excluded.watermark,
+                    full_sync_at = excluded.full_sync_at,
+                    updated_at = excluded.updated_at
+            ''', params)
+        else:
+            conn.execute('''
+                UPDATE sync_watermarks SET watermark = :watermark, updated_at = :now WHERE account_id = :account_id
+            ''', params)
+
+
+def utc_watermark(moment: datetime = None, overlap: int = WATERMARK_OVERLAP) -> str:
+    # HelpScout modifiedSince formátum: 2024-01-01T00:00:00Z
+    moment = (moment or datetime.utcnow()) - timedelta(seconds=overlap)
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def load_conversations(database: str, account_id: int, external_ids) -> dict:
+    # Csak az érintett beszélgetéseket olvassuk be, nem a fiók összes sorát
+    external_ids = [str(external_id) for external_id in external_ids]
+    result = {}
+    if not external_ids:
+        return result
+    with storage.reading(database) as conn:
+        # Az SQLite paraméterszám-korlátja miatt darabokban kérdezünk
+        for start in range(0, len(external_ids), 500):
+            chunk = external_ids[start:start + 500]
+            params = {f'id{i}': external_id for i, external_id in enumerate(chunk)}
+            params['account_id'] = account_id
+            rows = conn.execute(f'''
+                SELECT external_id, message_count, unread_count, oldest_unread, cursor, modified_at
+                FROM conversations
+                WHERE account_id = :account_id AND external_id IN ({', '.join(f':id{i}' for i in range(len(chunk)))})
+            ''', params).fetchall()
+            for row in rows:
+                result[row[0]] = {
+                    'message_count': row[1],
+                    'unread_count': row[2],
+                    'oldest_unread': row[3],
+                    'cursor': row[4],
+                    'modified_at': row[5],
+                }
+        return result
+
+
+def save_conversations(database: str, account_id: int, changed: dict, removed=(), replace: bool = False):
+    # changed: external_id -> {'message_count', 'unread_count', 'oldest_unread', 'cursor', 'modified_at'}
+    now = datetime.now().isoformat()
+    with storage.writing(database) as conn:
+        if replace:
+            conn.execute("DELETE FROM conversations WHERE account_id = :account_id", {'account_id': account_id})
+        if removed:
+            conn.executemany(
+                "DELETE FROM conversations WHERE account_id = :account_id AND external_id = :external_id",
+                [{'account_id': account_id, 'external_id': str(external_id)} for external_id in removed]
+            )
+        conn.executemany('''
+            INSERT INTO conversations
+            (account_id, external_id, message_count, unread_count, oldest_unread, cursor, modified_at, updated_at)
+            VALUES (:account_id, :external_id, :message_count, :unread_count, :oldest_unread, :cursor, :modified_at, :updated_at)
+            ON CONFLICT (account_id, external_id) DO UPDATE SET
+                message_count = excluded.message_count,
+                unread_count = excluded.unread_count,
+                oldest_unread = excluded.oldest_unread,
+                cursor = excluded.cursor,
+                modified_at = excluded.modified_at,
+                updated_at = excluded.updated_at
+        ''', [
+            {'account_id': account_id, 'external_id': str(external_id),
+             'message_count': state['message_count'], 'unread_count': state['unread_count'],
+             'oldest_unread': state['oldest_unread'], 'cursor': state.get('cursor'),
+             'modified_at': state.get('modified_at'), 'updated_at': now}
+            for external_id, state in changed.items()
+        ])
+
+
+def aggregate_stats(database: str, account_id: int):
+    # A fiók összesítése a tárolt beszélgetésekből; a MIN az (account_id, oldest_unread) indexet használja
+    params = {'account_id': account_id}
+    with storage.reading(database) as conn:
+        total_messages, unread_messages = conn.execute('''
+            SELECT COALESCE(SUM(message_count), 0), COALESCE(SUM(unread_count), 0)
+            FROM conversations WHERE account_id = :account_id
+        ''', params).fetchone()
+        oldest_unread = conn.execute('''
+            SELECT MIN(oldest_unread) FROM conversations
+            WHERE account_id = :account_id AND oldest_unread IS NOT NULL
+        ''', params).fetchone()[0]
+        return int(total_messages), int(unread_messages), oldest_unread
+
+
+def list_conversations(database: str, account_id: int, unread_only: bool = False, limit: int = 100, offset: int = 0):
+    query = '''
+        SELECT external_id, message_count, unread_count, oldest_unread, modified_at, updated_at
+        FROM conversations WHERE account_id = :account_id
+    '''
+    if unread_only:
+        query += " AND unread_count > 0 ORDER BY oldest_unread ASC"
+    else:
+        query += " ORDER BY modified_at DESC NULLS LAST"
+    query += " LIMIT :limit OFFSET :offset"
+    with storage.reading(database) as conn:
+        return conn.execute(query, {'account_id': account_id, 'limit': limit, 'offset': offset}).fetchall()
@@ -0,0 +1,81 @@
+import os
+import asyncio
+import logging
+import time
+from datetime import datetime
+import storage
+
+logger = logging.getLogger('token_cache')
+
+# Ennyivel a lejárat előtt már új tokent kérünk (másodperc)
+TOKEN_REFRESH_MARGIN = int(os.environ.get('TOKEN_REFRESH_MARGIN_SECONDS', '300'))
+
+
+class TokenCache:
+    def __init__(self, database: str, refresh_margin: int = TOKEN_REFRESH_MARGIN):
+        self.database = database
+        self.refresh_margin = refresh_margin
+        self._tokens = {}
+        self._locks = {}
+
+    def _is_fresh(self, entry) -> bool:
+        return entry is not None and entry[1] - self.refresh_margin > time.time()
+
+    async def get(self, key: str, fetch):
+        # fetch: aszinkron függvény, ami (token, lejárat unix időben) párt ad vissza
+        entry = self._tokens.get(key)
+        if self._is_fresh(entry):
+            return entry[0]
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            # Amíg a zárra vártunk, egy másik hívó már frissíthette
+            entry = self._tokens.get(key)
+            if self._is_fresh(entry):
+                return entry[0]
+
+            # Más worker vagy egy korábbi futás már elmenthette az adatbázisba
+            entry = await storage.run_read(self._load, key)
+            if self._is_fresh(entry):
+                self._tokens[key] = entry
+                return entry[0]
+
+            logger.info(f"Fetching new token for {key}")
+            token, expires_at = await fetch()
+            self._tokens[key] = (token, expires_at)
+            await storage.run_write(self._store, key, token, expires_at)
+            return token
+
+    async def invalidate(self, key: str):
+        self._tokens.pop(key, None)
+        await storage.run_write(self._delete, key)
+
+    def _delete(self, key: str):
+        try:
+            with storage.writing(self.database) as conn:
+                conn.execute("DELETE FROM auth_tokens WHERE cache_key = :key", {'key': key})
+        except storage.DatabaseError as e:
+            logger.error(f"Error deleting token {key}: {str(e)}")
+
+    def _load(self, key: str):
+        try:
+            with storage.reading(self.database) as conn:
+                row = conn.execute("SELECT token, expires_at FROM auth_tokens WHERE cache_key = :key", {'key': key}).fetchone()
+                return tuple(row) if row else None
+        except storage.DatabaseError as e:
+            logger.error(f"Error loading token {key}: {str(e)}")
+            return None
+
+    def _store(self, key: str, token: str, expires_at: float):
+        try:
+            with storage.writing(self.database) as conn:
+                conn.execute('''
+                    INSERT INTO auth_tokens (cache_key, token, expires_at, updated_at)
+                    VALUES (:key, :token, :expires_at, :updated_at)
+                    ON CONFLICT (cache_key) DO UPDATE SET
+                        token = excluded.token,
+                        expires_at = excluded.expires_at,
+                        updated_at = excluded.updated_at
+                ''', {'key': key, 'token': token, 'expires_at': expires_at, 'updated_at': datetime.now().isoformat()})
+        except storage.DatabaseError as e:
+            logger.error(f"Error storing token {key}: {str(e)}")
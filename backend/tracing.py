@@ -0,0 +1,199 @@
+import os
+import asyncio
+import json
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+import storage
+
+logger = logging.getLogger('tracing')
+
+# Az ennél hosszabb frissítési körök span fája megmarad (/debug/traces); 0: kikapcsolva, nem rögzítünk semmit
+TRACE_SLOW_SWEEP_SECONDS = float(os.environ.get('TRACE_SLOW_SWEEP_SECONDS', '30'))
+# Ennyi lassú kört őrzünk meg (a legrégebbi törlődik)
+TRACE_BUFFER_SIZE = int(os.environ.get('TRACE_BUFFER_SIZE', '20'))
+# Egy körön belül legfeljebb ennyi span, hogy egy nagy kör se nőjön korlátlanul
+TRACE_MAX_SPANS = int(os.environ.get('TRACE_MAX_SPANS', '20000'))
+
+
+class Span:
+    __slots__ = ('name', 'attrs', 'start', 'end', 'children', 'trace')
+
+    def __init__(self, name: str, attrs: dict, trace):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = []
+        self.trace = trace
+
+    def to_dict(self, origin: float) -> dict:
+        # Időpontok a kör kezdetéhez képest, ezredmásodpercben
+        end = self.end if self.end is not None else time.perf_counter()
+        data = {
+            'name': self.name,
+            'start_ms': round((self.start - origin) * 1000, 3),
+            'duration_ms': round((end - self.start) * 1000, 3),
+        }
+        if self.attrs:
+            data['attrs'] = self.attrs
+        if self.children:
+            data['children'] = [child.to_dict(origin) for child in self.children]
+        return data
+
+
+class Trace:
+    def __init__(self, name: str, attrs: dict):
+        self.id = uuid.uuid4().hex
+        self.started_at = time.time()
+        self.spans = 1
+        self.dropped = 0
+        self.root = Span(name, attrs, self)
+
+
+# Az aktuális span; a belőle indított taskok (fiókok, oldalak) a másolt kontextusból öröklik
+_current = ContextVar('trace_span', default=None)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    # Kör nélkül (üresjárat, webhook, API kérés) egyetlen ContextVar olvasás a költsége
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    trace = parent.trace
+    if trace.spans >= TRACE_MAX_SPANS:
+        trace.dropped += 1
+        yield None
+        return
+    trace.spans += 1
+    child = Span(name, attrs, trace)
+    parent.children.append(child)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.attrs['error'] = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        child.end = time.perf_counter()
+
+
+def annotate(**attrs):
+    # Utólag ismert adatok (státusz, darabszám) az aktuális spanra
+    current = _current.get()
+    if current is not None:
+        current.attrs.update(attrs)
+
+
+@contextmanager
+def sweep(name: str, database: str = None, **attrs):
+    # Egy frissítési kör gyökér spanja. Minden kört rögzítünk (a küszöböt csak a végén tudjuk),
+    # de csak a lassúak kerülnek mentésre; a többi a kör után eldobódik.
+    if TRACE_SLOW_SWEEP_SECONDS <= 0 or _current.get() is not None:
+        yield
+        return
+    trace = Trace(name, attrs)
+    token = _current.set(trace.root)
+    try:
+        yield
+    except BaseException as e:
+        trace.root.attrs['error'] = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        trace.root.end = time.perf_counter()
+        _finish(trace, database)
+
+
+_saving = set()
+
+
+def _finish(trace: Trace, database: str):
+    duration = trace.root.end - trace.root.start
+    # Leállításkor megszakított kör nem mérvadó
+    if duration < TRACE_SLOW_SWEEP_SECONDS or trace.root.attrs.get('error') == 'CancelledError':
+        return
+    logger.warning(f"Slow {trace.root.name} sweep took {duration:.1f}s ({trace.spans} spans), saving trace {trace.id}")
+    # A mentés (a fa sorosítása is) háttérben, az írási sávon fut, a kör nem vár rá
+    task = asyncio.create_task(_save(database, trace))
+    _saving.add(task)
+    task.add_done_callback(_saving.discard)
+
+
+async def _save(database: str, trace: Trace):
+    try:
+        await storage.run_write(save_trace, database, trace)
+    except storage.DatabaseError as e:
+        logger.error(f"Could not save trace {trace.id}: {str(e)}")
+
+
+def save_trace(database: str, trace: Trace, keep: int = TRACE_BUFFER_SIZE):
+    root = trace.root
+    data = {
+        'id': trace.id,
+        'name': root.name,
+        'started_at': trace.started_at,
+        'duration_ms': round((root.end - root.start) * 1000, 3),
+        'spans': trace.spans,
+        'dropped_spans': trace.dropped,
+        'root': root.to_dict(root.start),
+    }
+    with storage.writing(database) as conn:
+        conn.execute('''
+            INSERT INTO debug_traces (id, name, started_at, duration, span_count, trace)
+            VALUES (:id, :name, :started_at, :duration, :span_count, :trace)
+        ''', {'id': trace.id, 'name': root.name, 'started_at': trace.started_at, 'duration': root.end - root.start,
+              'span_count': trace.spans, 'trace': json.dumps(data)})
+        # Gyűrűpuffer: csak a legutóbbi keep darab marad
+        conn.execute('''
+            DELETE FROM debug_traces WHERE id NOT IN (
+                SELECT id FROM debug_traces ORDER BY started_at DESC LIMIT :keep
+            )
+        ''', {'keep': keep})
+
+
+def list_traces(database: str):
+    with storage.reading(database) as conn:
+        rows = conn.execute(
+            "SELECT id, name, started_at, duration, span_count FROM debug_traces ORDER BY started_at DESC"
+        ).fetchall()
+    return [{'id': row[0], 'name': row[1], 'started_at': row[2], 'duration_seconds': round(row[3], 3),
+             'spans': row[4]} for row in rows]
+
+
+def load_trace(database: str, trace_id: str):
+    with storage.reading(database) as conn:
+        row = conn.execute("SELECT trace FROM debug_traces WHERE id = :id", {'id': trace_id}).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def _frame(span: dict) -> str:
+    attrs = span.get('attrs') or {}
+    label = span['name']
+    for key in ('account_id', 'provider', 'method', 'host', 'func'):
+        if key in attrs:
+            label += f" {attrs[key]}"
+    # A collapsed formátumban a ; a keretek elválasztója
+    return label.replace(';', ',')
+
+
+def collapsed_stacks(trace: dict) -> str:
+    # Flamegraph bemenet (flamegraph.pl, speedscope): "gyökér;gyerek;unoka <saját idő µs-ban>" soronként.
+    # A párhuzamos spanok ideje összeadódik, mint a CPU profiloknál a szálaké.
+    lines = {}
+
+    def _walk(span: dict, path: str):
+        children = span.get('children', [])
+        own = span['duration_ms'] - sum(child['duration_ms'] for child in children)
+        if own > 0:
+            lines[path] = lines.get(path, 0) + int(own * 1000)
+        for child in children:
+            _walk(child, f"{path};{_frame(child)}")
+
+    _walk(trace['root'], _frame(trace['root']))
+    return ''.join(f"{path} {value}\n" for path, value in lines.items() if value)
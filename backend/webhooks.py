@@ -0,0 +1,408 @@
+import os
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import time
+from datetime import datetime, timezone
+import storage
+import retention
+from event_queue import event_queue
+from stats_writer import upsert_stats
+from stats_cache import stats_cache
+from broadcaster import broadcaster
+
+logger = logging.getLogger('webhooks')
+
+# Meta alkalmazás titok (X-Hub-Signature-256) és a feliratkozáskori ellenőrző token
+META_APP_SECRET = os.environ.get('META_APP_SECRET', '')
+META_VERIFY_TOKEN = os.environ.get('META_VERIFY_TOKEN', '')
+# HelpScout webhook titok, ha a fiók credentials-ében nincs saját webhook_secret
+HELPSCOUT_WEBHOOK_SECRET = os.environ.get('HELPSCOUT_WEBHOOK_SECRET', '')
+# A fiók -> webhook azonosító táblát ilyen gyakran olvassuk újra
+WEBHOOK_ROUTES_TTL_SECONDS = float(os.environ.get('WEBHOOK_ROUTES_TTL_SECONDS', '60'))
+# Löketek alatt fiókonként legfeljebb ennyi időnként írunk idősor pontot
+WEBHOOK_HISTORY_SECONDS = 60
+# Webhookot küldő fiókoknál a lekérdezés csak egyeztetés, legfeljebb ilyen gyakran
+WEBHOOK_RECONCILE_INTERVAL_SECONDS = int(os.environ.get('WEBHOOK_RECONCILE_INTERVAL_SECONDS', '3600'))
+
+# Esemény fajta a tartós sorban
+WEBHOOK_EVENT = 'webhook'
+# Esemény típusok: fiók szintű számláló (Meta), az oldal/vállalkozás válasza egy partnernek (Meta),
+# illetve beszélgetés szintű változás (HelpScout)
+COUNT = 'count'
+REPLY = 'reply'
+CONVERSATION = 'conversation'
+# Beszélgetés változások
+CUSTOMER_MESSAGE = 'customer'
+AGENT_MESSAGE = 'agent'
+REMOVED = 'removed'
+
+_HELPSCOUT_EVENTS = {
+    'convo.created': CUSTOMER_MESSAGE,
+    'convo.customer.reply.created': CUSTOMER_MESSAGE,
+    'convo.agent.reply.created': AGENT_MESSAGE,
+    'convo.deleted': REMOVED,
+    'convo.merged': REMOVED,
+}
+
+
+def _graph_time(ts: float) -> str:
+    # A Graph API-val azonos formátum, hogy a legrégebbi olvasatlan összehasonlítható maradjon
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S+0000')
+
+
+def _event_time(value, scale: float = 1) -> str:
+    # Aláírt, de hibás időbélyegnél (szöveg, hiányzó, túl nagy) a fogadás ideje; a 500 miatt a Meta újraküldené
+    try:
+        ts = float(value) / scale
+        return _graph_time(ts)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return _graph_time(time.time())
+
+
+def valid_meta_signature(body: bytes, header: str) -> bool:
+    if not META_APP_SECRET or not header or not header.startswith('sha256='):
+        return False
+    expected = hmac.new(META_APP_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, header[len('sha256='):])
+
+
+def verify_meta_subscription(mode: str, token: str) -> bool:
+    return bool(META_VERIFY_TOKEN) and mode == 'subscribe' and hmac.compare_digest(token or '', META_VERIFY_TOKEN)
+
+
+def helpscout_signature(secret: str, body: bytes) -> str:
+    return base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha1).digest()).decode()
+
+
+class WebhookRoutes:
+    # Melyik fiókhoz tartozik egy bejövő esemény: WhatsApp phone_number_id/waba_id,
+    # Messenger page_id, HelpScout webhook titok (és opcionálisan mailbox_id) alapján
+    def __init__(self, rows=()):
+        self.whatsapp = {}
+        self.messenger = {}
+        self.helpscout = []
+        for account_id, account_type, credentials_str in rows:
+            try:
+                credentials = json.loads(credentials_str)
+            except ValueError:
+                continue
+            if account_type == 'WhatsApp':
+                for key in ('phone_number_id', 'waba_id'):
+                    if credentials.get(key):
+                        self.whatsapp[str(credentials[key])] = account_id
+            elif account_type == 'Messenger' and credentials.get('page_id'):
+                self.messenger[str(credentials['page_id'])] = account_id
+            elif account_type == 'HelpScout':
+                secret = credentials.get('webhook_secret') or HELPSCOUT_WEBHOOK_SECRET
+                if secret:
+                    self.helpscout.append((account_id, secret, credentials.get('mailbox_id')))
+
+    def helpscout_account(self, body: bytes, signature: str, mailbox_id):
+        if not signature:
+            return None
+        for account_id, secret, account_mailbox in self.helpscout:
+            if account_mailbox and mailbox_id is not None and str(account_mailbox) != str(mailbox_id):
+                continue
+            if hmac.compare_digest(helpscout_signature(secret, body), signature):
+                return account_id
+        return None
+
+
+def load_routes(database: str) -> WebhookRoutes:
+    with storage.reading(database) as conn:
+        rows = conn.execute("SELECT id, account_type, credentials FROM accounts WHERE is_active = TRUE").fetchall()
+    return WebhookRoutes(rows)
+
+
+def _peer(item: dict, side: str):
+    peer = (item.get(side) or {}).get('id')
+    return str(peer) if peer else None
+
+
+def parse_meta(payload: dict, routes: WebhookRoutes) -> list:
+    # (idempotencia kulcs, esemény) párok; a Meta újraküldésnél ugyanazokat az azonosítókat küldi.
+    # A bejövő üzenet a küldő partnernél olvasatlan; az oldal/vállalkozás válasza (echo, kimenő
+    # státusz) vagy a partner olvasási visszaigazolása nullázza a partner webhookból számolt olvasatlanjait.
+    events = []
+    if not isinstance(payload, dict):
+        return events
+    kind = payload.get('object')
+    for entry in payload.get('entry', []):
+        if kind == 'page':
+            account_id = routes.messenger.get(str(entry.get('id')))
+            if account_id is None:
+                continue
+            for item in entry.get('messaging', []):
+                read = item.get('read')
+                if read:
+                    # message_reads: a felhasználó elolvasta az oldal válaszait
+                    peer = _peer(item, 'sender')
+                    if peer:
+                        events.append((f"meta:{account_id}:read:{peer}:{read.get('watermark')}", (REPLY, account_id, peer, 0)))
+                    continue
+                message = item.get('message')
+                if not message:
+                    continue
+                key = f"meta:{account_id}:{message['mid']}" if message.get('mid') else None
+                if message.get('is_echo'):
+                    # Az oldal saját válasza: üzenet, de nem olvasatlan, és a címzett beszélgetése megválaszolt
+                    events.append((key, (REPLY, account_id, _peer(item, 'recipient'), 1)))
+                else:
+                    events.append((key, (COUNT, account_id, 1, 1, _event_time(item.get('timestamp'), 1000), _peer(item, 'sender'))))
+        elif kind == 'whatsapp_business_account':
+            for change in entry.get('changes', []):
+                if change.get('field') != 'messages':
+                    continue
+                value = change.get('value', {})
+                phone_number_id = value.get('metadata', {}).get('phone_number_id')
+                account_id = routes.whatsapp.get(str(phone_number_id)) or routes.whatsapp.get(str(entry.get('id')))
+                if account_id is None:
+                    continue
+                for message in value.get('messages', []):
+                    key = f"meta:{account_id}:{message['id']}" if message.get('id') else None
+                    peer = str(message['from']) if message.get('from') else None
+                    events.append((key, (COUNT, account_id, 1, 1, _event_time(message.get('timestamp')), peer)))
+                for status in value.get('statuses', []):
+                    state = status.get('status')
+                    if state not in ('sent', 'read'):
+                        continue
+                    peer = str(status['recipient_id']) if status.get('recipient_id') else None
+                    key = f"meta:{account_id}:{status['id']}:{state}" if status.get('id') else None
+                    # Kimenő üzenet: csak az első (sent) állapotnál számoljuk; a read csak nulláz
+                    events.append((key, (REPLY, account_id, peer, 1 if state == 'sent' else 0)))
+    return events
+
+
+def _helpscout_state(conv: dict):
+    # Ha a payload tartalmazza a thread-eket, ugyanúgy számolunk, mint a lekérdezés
+    threads = conv.get('_embedded', {}).get('threads')
+    if threads is None:
+        return None
+    is_unread = False
+    oldest_unread = None
+    for thread in threads:
+        if not thread.get('seenByAgent', False):
+            is_unread = True
+            created_at = thread.get('createdAt')
+            if created_at and (oldest_unread is None or created_at < oldest_unread):
+                oldest_unread = created_at
+    return {'message_count': len(threads), 'unread_count': 1 if is_unread else 0, 'oldest_unread': oldest_unread}
+
+
+def parse_helpscout(event: str, payload: dict, account_id: int) -> list:
+    if not isinstance(payload, dict) or payload.get('id') is None:
+        return []
+    change = _HELPSCOUT_EVENTS.get(event)
+    status = payload.get('status')
+    if status is not None and status != 'active':
+        # A lekérdezés is csak az aktív beszélgetéseket számolja
+        change = REMOVED
+    elif event == 'convo.status':
+        # Újranyitott beszélgetés: csak a payload teljes állapotából tudjuk számolni
+        change = CUSTOMER_MESSAGE if _helpscout_state(payload) is not None else None
+    if change is None:
+        return []
+    modified_at = payload.get('userUpdatedAt') or payload.get('modifiedAt') or datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    state = None if change == REMOVED else _helpscout_state(payload)
+    # A HelpScout nem küld kézbesítési azonosítót; az újraküldött payload azonos
+    digest = hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+    key = f"helpscout:{account_id}:{event}:{digest}"
+    return [(key, (CONVERSATION, account_id, str(payload['id']), change, modified_at, state))]
+
+
+def _coalesce(events):
+    # Sok esemény -> fiókonként / beszélgetésenként egy változás, a beérkezés sorrendjében alkalmazva.
+    # peers: (fiók, partner) -> a kötegben a partnernél keletkezett olvasatlanok; replied: a tárolt
+    # partner olvasatlanokat nullázó válaszok
+    counters = {}
+    conversations = {}
+    peers = {}
+    replied = set()
+    for event in events:
+        if event[0] == COUNT:
+            # A régebbi, partner nélküli események is feldolgozhatók maradnak a sorban
+            _, account_id, messages, unread, oldest = event[:5]
+            peer = event[5] if len(event) > 5 else None
+            counter = counters.setdefault(account_id, [0, 0, None])
+            counter[0] += messages
+            counter[1] += unread
+            if oldest and (counter[2] is None or oldest < counter[2]):
+                counter[2] = oldest
+            if peer and unread:
+                peers[(account_id, peer)] = peers.get((account_id, peer), 0) + unread
+            continue
+
+        if event[0] == REPLY:
+            _, account_id, peer, messages = event
+            counter = counters.setdefault(account_id, [0, 0, None])
+            counter[0] += messages
+            if peer:
+                # A kötegben korábban számolt olvasatlanok nem kerülnek be, a tároltakat az alkalmazás vonja le
+                counter[1] -= peers.pop((account_id, peer), 0)
+                replied.add((account_id, peer))
+            continue
+
+        _, account_id, conv_id, change, modified_at, state = event
+        key = (account_id, conv_id)
+        if change == REMOVED:
+            conversations[key] = {'removed': True}
+            continue
+        delta = conversations.get(key)
+        if state is not None or delta is None or delta['removed']:
+            # Teljes állapot a payloadból; törlés utáni új üzenetnél elölről kezdjük a számolást
+            known = state is not None or (delta is not None and delta['removed'])
+            delta = conversations[key] = {
+                'removed': False, 'replace': known, 'clear_oldest': known,
+                'messages': state['message_count'] if state else 0,
+                'unread': state['unread_count'] if state else None,
+                'oldest': state['oldest_unread'] if state else None,
+                'modified_at': modified_at,
+            }
+            if state is not None:
+                continue
+        delta['messages'] += 1
+        if change == CUSTOMER_MESSAGE:
+            # A HelpScout beszélgetésenként 0/1 olvasatlant számol
+            delta['unread'] = 1
+            if delta['oldest'] is None or modified_at < delta['oldest']:
+                delta['oldest'] = modified_at
+        else:
+            delta.update(unread=0, oldest=None, clear_oldest=True)
+        if modified_at > delta['modified_at']:
+            delta['modified_at'] = modified_at
+    return counters, conversations, peers, replied
+
+
+def apply_events(conn, counters: dict, conversations: dict, history=(), peers=None, replied=()):
+    # A sor feldolgozó tranzakcióján belül fut.
+    # history: azok a fiókok, amelyeknél idősor pontot is írunk (nem minden kötegnél)
+    now = datetime.now().isoformat()
+    ts = time.time()
+
+    def nullable_min(a: str, b: str) -> str:
+        return f"CASE WHEN {a} IS NULL THEN {b} WHEN {b} IS NULL THEN {a} ELSE {conn.storage.least(a, b)} END"
+
+    # Beszélgetés szintű változások (HelpScout, a lekérdezéssel azonos azonosítókkal)
+    removed = [{'account_id': a, 'external_id': c} for (a, c), d in conversations.items() if d['removed']]
+    conn.executemany("DELETE FROM conversations WHERE account_id = :account_id AND external_id = :external_id", removed)
+    conn.executemany(f'''
+        INSERT INTO conversations
+            (account_id, external_id, message_count, unread_count, oldest_unread, cursor, modified_at, updated_at)
+        VALUES (:account_id, :external_id, :messages, COALESCE(:unread, 0), :oldest, :modified_at, :modified_at, :updated_at)
+        ON CONFLICT (account_id, external_id) DO UPDATE SET
+            message_count = CASE WHEN :replace THEN 0 ELSE conversations.message_count END + excluded.message_count,
+            unread_count = COALESCE(:unread, conversations.unread_count),
+            oldest_unread = CASE WHEN :clear_oldest THEN excluded.oldest_unread
+                                 ELSE {nullable_min('conversations.oldest_unread', 'excluded.oldest_unread')} END,
+            modified_at = excluded.modified_at,
+            updated_at = excluded.updated_at
+    ''', [
+        {'account_id': a, 'external_id': c, 'messages': d['messages'], 'unread': d['unread'], 'oldest': d['oldest'],
+         'replace': d['replace'], 'clear_oldest': d['clear_oldest'], 'modified_at': d['modified_at'], 'updated_at': now}
+        for (a, c), d in conversations.items() if not d['removed']
+    ])
+
+    # Megválaszolt partnerek: a webhookból számolt olvasatlanjaik levonódnak a fiók számlálójából
+    for account_id, peer in sorted(replied):
+        params = {'account_id': account_id, 'peer': peer}
+        row = conn.execute(
+            "SELECT unread_count FROM webhook_unread WHERE account_id = :account_id AND peer = :peer", params
+        ).fetchone()
+        if row is not None:
+            conn.execute("DELETE FROM webhook_unread WHERE account_id = :account_id AND peer = :peer", params)
+            counters[account_id][1] -= row[0]
+    conn.executemany('''
+        INSERT INTO webhook_unread (account_id, peer, unread_count) VALUES (:account_id, :peer, :unread)
+        ON CONFLICT (account_id, peer) DO UPDATE SET unread_count = webhook_unread.unread_count + excluded.unread_count
+    ''', [{'account_id': a, 'peer': p, 'unread': n} for (a, p), n in (peers or {}).items()])
+
+    # Fiók szintű számlálók (Meta); a sor hiányában az első lekérdezés hozza létre.
+    # Ha minden olvasatlan elfogyott, a legrégebbi olvasatlan dátuma is törlődik.
+    conn.executemany(f'''
+        UPDATE account_stats SET
+            total_messages = total_messages + :messages,
+            unread_messages = {conn.storage.greatest('unread_messages + :unread', '0')},
+            last_unread_date = CASE WHEN unread_messages + :unread <= 0 THEN NULL
+                                    ELSE {nullable_min('last_unread_date', ':oldest')} END,
+            last_updated = :last_updated
+        WHERE account_id = :account_id
+    ''', [
+        {'account_id': a, 'messages': c[0], 'unread': c[1], 'oldest': c[2], 'last_updated': now}
+        for a, c in counters.items()
+    ])
+
+    # A beszélgetésekből összesített fiókok (HelpScout)
+    batch = []
+    for account_id in sorted({a for a, _ in conversations}):
+        total, unread, oldest = conn.execute('''
+            SELECT COALESCE(SUM(message_count), 0), COALESCE(SUM(unread_count), 0), MIN(oldest_unread)
+            FROM conversations WHERE account_id = :account_id
+        ''', {'account_id': account_id}).fetchone()
+        batch.append((account_id, int(total), int(unread), oldest, now, ts))
+    upsert_stats(conn, batch)
+
+    points = []
+    for account_id in sorted(history):
+        row = conn.execute(
+            "SELECT total_messages, unread_messages FROM account_stats WHERE account_id = :account_id",
+            {'account_id': account_id}
+        ).fetchone()
+        if row is not None:
+            points.append((account_id, row[0], row[1], ts))
+    retention.record_points(conn, points)
+
+    # A lekérdezés ezeknél a fiókoknál csak ritkán, egyeztetésként fut
+    conn.executemany('''
+        INSERT INTO webhook_activity (account_id, last_event_at) VALUES (:account_id, :ts)
+        ON CONFLICT (account_id) DO UPDATE SET last_event_at = excluded.last_event_at
+    ''', [{'account_id': a, 'ts': ts} for a in {*counters, *(a for a, _ in conversations)}])
+    return len(batch) + len(counters)
+
+
+def load_webhook_activity(database: str) -> dict:
+    with storage.reading(database) as conn:
+        return {row[0]: row[1] for row in conn.execute("SELECT account_id, last_event_at FROM webhook_activity").fetchall()}
+
+
+class WebhookIngestor:
+    # A végpont csak ellenőriz, értelmez és a tartós sorba tesz; az összesítést a sor feldolgozója végzi kötegelve
+    def __init__(self):
+        self.database = None
+        self._routes = None
+        self._routes_loaded = 0.0
+        self._history_at = {}
+
+    async def routes(self) -> WebhookRoutes:
+        if self._routes is None or time.monotonic() - self._routes_loaded > WEBHOOK_ROUTES_TTL_SECONDS:
+            self._routes = await storage.run_read(load_routes, self.database)
+            self._routes_loaded = time.monotonic()
+        return self._routes
+
+    def invalidate_routes(self):
+        self._routes = None
+
+    async def submit(self, events: list):
+        # Telített sornál QueueFull; visszatéréskor az események már az adatbázisban vannak
+        await event_queue.append([(key, WEBHOOK_EVENT, event) for key, event in events])
+
+    def apply(self, conn, events: list):
+        counters, conversations, peers, replied = _coalesce(events)
+        now = time.monotonic()
+        history = {
+            account_id for account_id in {*counters, *(a for a, _ in conversations)}
+            if now - self._history_at.get(account_id, -WEBHOOK_HISTORY_SECONDS) >= WEBHOOK_HISTORY_SECONDS
+        }
+        accounts = apply_events(conn, counters, conversations, history, peers, replied)
+        self._history_at.update((account_id, now) for account_id in history)
+        logger.debug(f"Applied {len(events)} webhook events to {accounts} accounts")
+
+    def applied(self):
+        stats_cache.invalidate()
+        broadcaster.notify()
+
+
+webhook_ingestor = WebhookIngestor()
+event_queue.register(WEBHOOK_EVENT, webhook_ingestor.apply, webhook_ingestor.applied)
@@ -57,6 +57,24 @@ const api = axios.create({
     }
 });
 
+interface RefreshJob {
+  job_id: string;
+  status: 'pending' | 'running' | 'completed' | 'failed' | 'cancelled';
+}
+
+// A frissítés a háttérben fut, a job állapotát kérdezzük le amíg be nem fejeződik
+const waitForRefresh = async (jobId: string, timeoutMs = 120000) => {
+  const deadline = Date.now() + timeoutMs;
+  while (Date.now() < deadline) {
+    const response = await api.get<RefreshJob>(`/stats/refresh/${jobId}`);
+    if (response.data.status !== 'pending' && response.data.status !== 'running') {
+      return response.data;
+    }
+    await new Promise(resolve => setTimeout(resolve, 2000));
+  }
+  return null;
+};
+
 interface AccountStats {
   account_id: number;
   account_name: string;
@@ -65,6 +83,9 @@ interface AccountStats {
   unread_messages: number;
   last_unread_date: string;
   last_updated: string;
+  stale?: boolean;
+  circuit?: string;
+  last_error?: string | null;
   id?: string;
 }
 
@@ -75,6 +96,23 @@ interface TimeSeriesData {
   new_messages: number;
 }
 
+interface HistoryValue {
+  min: number;
+  max: number;
+  avg: number;
+  last: number;
+}
+
+interface StatsHistory {
+  bucket: number;
+  points: {
+    timestamp: string;
+    samples: number;
+    total_messages: HistoryValue;
+    unread_messages: HistoryValue;
+  }[];
+}
+
 interface AccountFormData {
   account_type: string;
   account_name: string;
@@ -84,19 +122,24 @@ interface AccountFormData {
 const ACCOUNT_TYPES = {
   'WhatsApp': {
     name: 'WhatsApp',
-    fields: ['api_key', 'waba_id', 'phone_number_id']
+    fields: ['api_key', 'waba_id', 'phone_number_id'],
+    optionalFields: []
   },
   'Skype': {
     name: 'Skype',
-    fields: ['username', 'password']
+    fields: ['username', 'password'],
+    optionalFields: []
   },
   'Messenger': {
     name: 'Messenger',
-    fields: ['access_token']
+    fields: ['access_token'],
+    // Webhook esetén az események ez alapján kerülnek a fiókhoz
+    optionalFields: ['page_id']
   },
   'HelpScout': {
     name: 'HelpScout',
-    fields: ['client_id', 'client_secret']
+    fields: ['client_id', 'client_secret'],
+    optionalFields: ['webhook_secret', 'mailbox_id']
   }
 };
 
@@ -144,8 +187,20 @@ const columns: GridColDef[] = [
     headerName: 'Last Updated', 
     width: 200,
     flex: 1,
-    valueFormatter: (params) => {
-      return new Date(params.value).toLocaleString('en-US');
+    renderCell: (params) => {
+      const updated = new Date(params.value).toLocaleString('en-US');
+      if (!params.row.stale) return updated;
+      // The last refresh failed: the numbers are the last good values, not zeros
+      return (
+        <Box display="flex" alignItems="center" gap={1} title={params.row.last_error || ''}>
+          <span>{updated}</span>
+          <Chip
+            label={params.row.circuit === 'closed' ? 'stale' : 'paused'}
+            color="warning"
+            size="small"
+          />
+        </Box>
+      );
     }
   },
   {
@@ -248,81 +303,96 @@ function App() {
   });
   const [error, setError] = useState<string | null>(null);
 
-  const fetchStats = useCallback(async () => {
-    try {
-      const response = await api.get<AccountStats[]>('/stats');
-      
-      // Csak a legfrissebb adatok megtartása fiókonként
-      const latestStats = Object.values(
-        response.data.reduce((acc, stat) => {
-          const key = `${stat.account_type}_${stat.account_id}`;
-          if (!acc[key] || new Date(stat.last_updated) > new Date(acc[key].last_updated)) {
-            acc[key] = {
-              ...stat,
-              id: key,
-              onDelete: (accountId: number) => handleDeleteAccount(accountId)
-            };
-          }
-          return acc;
-        }, {} as Record<string, AccountStats & { onDelete: (accountId: number) => void }>)
-      );
+  const toRows = (rows: AccountStats[]) => rows.map(stat => ({
+    ...stat,
+    id: `${stat.account_type}_${stat.account_id}`,
+    onDelete: (accountId: number) => handleDeleteAccount(accountId)
+  }));
 
-      setStats(latestStats);
-
-      // Idősorozat adatok frissítése
-      const currentTotal = latestStats.reduce((sum, stat) => sum + stat.total_messages, 0);
-      const currentUnread = latestStats.reduce((sum, stat) => sum + stat.unread_messages, 0);
-      
-      setTimeSeriesData(prevData => {
-        const newData = [...prevData];
-        const timestamp = new Date().toISOString();
-        const previousTotal = prevData.length > 0 ? prevData[prevData.length - 1].total_messages : 0;
-        
-        newData.push({
-          timestamp,
-          total_messages: currentTotal,
-          unread_messages: currentUnread,
-          new_messages: currentTotal - previousTotal
-        });
-
-        // Csak az utolsó 24 óra adatait tartjuk meg
-        const twentyFourHoursAgo = new Date(Date.now() - 24 * 60 * 60 * 1000);
-        return newData.filter(data => new Date(data.timestamp) > twentyFourHoursAgo);
+  const fetchHistory = useCallback(async () => {
+    try {
+      // Az utolsó 24 óra idősora a szerverről, vödrözve
+      const from = new Date(Date.now() - 24 * 60 * 60 * 1000).toISOString();
+      const historyResponse = await api.get<StatsHistory>('/stats/history', {
+        params: { from, bucket: '5m' }
       });
-
+      const points = historyResponse.data.points;
+      setTimeSeriesData(points.map((point, index) => ({
+        timestamp: point.timestamp,
+        total_messages: point.total_messages.last,
+        unread_messages: point.unread_messages.last,
+        new_messages: index > 0
+          ? Math.max(point.total_messages.last - points[index - 1].total_messages.last, 0)
+          : 0
+      })));
     } catch (error) {
-      console.error('Error fetching stats:', error);
+      console.error('Error fetching history:', error);
       setError('Error fetching data');
-    } finally {
-      setLoading(false);
     }
   }, []);
 
   const handleDeleteAccount = useCallback(async (accountId: number) => {
     try {
       await api.delete(`/accounts/${accountId}`);
+      // A stream is elküldi a törlést, de a táblát azonnal frissítjük
       setStats(prevStats => prevStats.filter(stat => stat.account_id !== accountId));
-      await fetchStats();
     } catch (error) {
       console.error('Error deleting account:', error);
       setError('Error deleting account');
     }
-  }, [fetchStats]);
+  }, []);
 
   useEffect(() => {
-    fetchStats();
-    const interval = setInterval(fetchStats, 60000);
-    return () => clearInterval(interval);
-  }, [fetchStats]);
+    // A szerver push-olja a változásokat: csatlakozáskor snapshot, utána fiókonkénti delta
+    const source = new EventSource(`${API_URL}/stats/stream`);
+    let historyTimer: ReturnType<typeof setTimeout> | undefined;
+    // Több fiók egymás utáni frissítése egyetlen idősor lekérést okozzon
+    const scheduleHistory = () => {
+      clearTimeout(historyTimer);
+      historyTimer = setTimeout(fetchHistory, 5000);
+    };
+
+    source.addEventListener('snapshot', (event) => {
+      const rows: AccountStats[] = JSON.parse((event as MessageEvent).data);
+      setStats(toRows(rows));
+      setError(null);
+      setLoading(false);
+      fetchHistory();
+    });
+    source.addEventListener('delta', (event) => {
+      const delta: { updated: AccountStats[]; removed: number[] } = JSON.parse((event as MessageEvent).data);
+      setStats(prevStats => {
+        const updated = new Map(toRows(delta.updated).map(stat => [stat.account_id, stat]));
+        const next = prevStats
+          .filter(stat => !delta.removed.includes(stat.account_id))
+          .map(stat => updated.get(stat.account_id) || stat);
+        const known = new Set(next.map(stat => stat.account_id));
+        return [...next, ...Array.from(updated.values()).filter(stat => !known.has(stat.account_id))];
+      });
+      scheduleHistory();
+    });
+    // Kapcsolat megszakadásakor az EventSource magától újracsatlakozik és új snapshotot kap
+    source.onerror = () => {
+      console.error('Stats stream disconnected, reconnecting...');
+      setLoading(false);
+    };
+
+    return () => {
+      clearTimeout(historyTimer);
+      source.close();
+    };
+  // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [fetchHistory]);
 
   const handleRefresh = async () => {
     try {
       setLoading(true);
       console.log("Starting refresh...");
-      const response = await api.post('/stats/refresh');
+      const response = await api.post<RefreshJob>('/stats/refresh');
       console.log("Refresh response:", response.data);
-      await fetchStats();
-      console.log("Stats fetched after refresh");
+      // Az új értékek a stats streamen érkeznek
+      await waitForRefresh(response.data.job_id);
+      console.log("Refresh finished");
     } catch (error) {
       console.error("Error during refresh:", error);
       setError('Error during refresh');
@@ -355,8 +425,10 @@ function App() {
       });
 
       console.log("Starting immediate refresh after account creation...");
-      await api.post('/stats/refresh');
-      await fetchStats();
+      const refreshResponse = await api.post<RefreshJob>('/stats/refresh', null, {
+        params: { account_id: response.data.id }
+      });
+      await waitForRefresh(refreshResponse.data.job_id);
       
     } catch (error: any) {
       console.error('Error details:', error.response?.data || error);
@@ -523,13 +595,16 @@ function App() {
                   sx={{ mt: 2 }}
                 />
 
-                {ACCOUNT_TYPES[formData.account_type as keyof typeof ACCOUNT_TYPES].fields.map((field) => (
+                {[
+                  ...ACCOUNT_TYPES[formData.account_type as keyof typeof ACCOUNT_TYPES].fields,
+                  ...ACCOUNT_TYPES[formData.account_type as keyof typeof ACCOUNT_TYPES].optionalFields
+                ].map((field) => (
                   <TextField
                     key={field}
                     fullWidth
-                    required
+                    required={ACCOUNT_TYPES[formData.account_type as keyof typeof ACCOUNT_TYPES].fields.includes(field)}
                     label={field}
-                    type={field === 'password' ? 'password' : 'text'}
+                    type={field === 'password' || field === 'webhook_secret' ? 'password' : 'text'}
                     value={formData.credentials[field] || ''}
                     onChange={(e) => setFormData({
                       ...formData,